@@ -40,6 +40,8 @@ for msg in __MESSAGES:
 
 import lastuserapp.assets
 import lastuserapp.mailclient
+# Rate limits are checked before any other request handler, so this must be imported before views
+import lastuserapp.ratelimit
 import lastuserapp.models
 import lastuserapp.forms
 import lastuserapp.views
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for code paths whose cost should not grow with the data behind
+them.
+
+Each benchmark seeds a scratch database with sets of rows of growing size,
+runs the code path once per size and reports the number of SQL statements
+it sent. A count that grows with the size means queries are being issued
+per row, and the benchmark fails. The search benchmark also reports how
+long searches take as the number of users grows. Run them with ``manage.py benchmark``,
+which uses a temporary SQLite database unless given another with
+``--database``. Never point it at a database with real data: it adds rows
+and leaves them there.
+"""
+
+import atexit
+import os
+import random
+import sys
+import tempfile
+import time
+
+from sqlalchemy import event
+
+from lastuserapp import app
+from lastuserapp.models import (db, User, Organization, Team, Client, Resource, ResourceAction,
+    UserClientPermissions, TeamClientPermissions)
+
+#: Statement counters currently counting
+_counting = []
+
+
+def _count_statement(connection, cursor, statement, parameters, context, executemany):
+    for counter in _counting:
+        counter.count += 1
+
+
+class StatementCounter(object):
+    """
+    Counts the statements sent to the database within a ``with`` block.
+    Only statements on the database set up by :func:`use_database` are
+    counted.
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        _counting.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _counting.remove(self)
+
+
+def use_database(uri=None):
+    """
+    Point the app at a scratch database and bring it up to the latest
+    schema. Must be called before anything else uses the database. Without
+    a URI, a temporary SQLite file is created and removed at exit. Returns
+    the URI.
+    """
+    from lastuserapp.migrations import migrate
+    if uri is None:
+        handle, path = tempfile.mkstemp(suffix='.db', prefix='lastuser-benchmark-')
+        os.close(handle)
+        atexit.register(os.remove, path)
+        uri = 'sqlite:///' + path
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    migrate(log=open(os.devnull, 'w'))
+    # Connections only see listeners that were there when they were opened,
+    # and listeners can't be removed, so one is registered for good here
+    event.listen(db.engine, 'before_cursor_execute', _count_statement)
+    return uri
+
+
+def make_user(name):
+    user = User(username=name, fullname=name.title())
+    db.session.add(user)
+    return user
+
+
+def percentile(values, fraction):
+    """
+    Return the value below which a fraction of the values fall.
+
+    >>> percentile([4, 1, 3, 2], 0.5)
+    3
+    """
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def report(name, counts, log):
+    """
+    Print statement counts by size and return True if they did not grow.
+    """
+    steady = len(set(counts.values())) == 1
+    print >> log, "%s  %s: %s" % ("ok  " if steady else "FAIL", name,
+        ", ".join("%d statements with %d" % (counts[size], size) for size in sorted(counts)))
+    return steady
+
+
+# --- Benchmarks --------------------------------------------------------------
+
+def bench_organizations(sizes, log):
+    """
+    Organizations a user owns and belongs to, as listed in the information
+    returned to client apps with the organizations scope.
+    """
+    from lastuserapp.userinfo import build_userinfo
+    owner = make_user(u'benchorgs')
+    client = Client(title=u"Benchmark", user=owner, website=u'https://example.com/')
+    db.session.add(client)
+    counts = {}
+    for size in sizes:
+        user = make_user(u'benchorgs%d' % size)
+        for index in range(size):
+            org = Organization(name=u'benchorgs%d-%d' % (size, index), title=u"Organization %d" % index)
+            org.owners.users.append(user)
+            Team(title=u"Members", org=org).users.append(user)
+        db.session.commit()
+        user_id, client_id = user.id, client.id
+        db.session.remove()
+        with app.test_request_context():
+            user, client = User.query.get(user_id), Client.query.get(client_id)
+            with StatementCounter() as counter:
+                build_userinfo(user, client, ['organizations'])
+                user.organizations_owned_ids()
+            counts[size] = counter.count
+        db.session.remove()
+    return report("User organizations", counts, log)
+
+
+def bench_client_info(sizes, log):
+    """
+    The client app page as its owner sees it, with all its resources, actions
+    and permission assignments, for apps owned by a user and by an
+    organization.
+    """
+    owner = make_user(u'benchapps')
+    org = Organization(name=u'benchapps-org', title=u"Benchmark apps")
+    org.owners.users.append(owner)
+    db.session.commit()
+    owner_userid = owner.userid
+    steady = True
+    for kind in ('user', 'org'):
+        counts = {}
+        for size in sizes:
+            if kind == 'user':
+                client = Client(title=u"Benchmark", user=owner, website=u'https://example.com/')
+            else:
+                client = Client(title=u"Benchmark", org=org, website=u'https://example.com/')
+            for index in range(size):
+                resource = Resource(name=u'bench%s%d-%d' % (kind, size, index), title=u"Resource", client=client)
+                for action in (u'read', u'write'):
+                    db.session.add(ResourceAction(name=action, title=action.title(), resource=resource))
+                if kind == 'user':
+                    assignment = UserClientPermissions(user=make_user(u'benchapps%d-%d' % (size, index)),
+                        client=client)
+                else:
+                    assignment = TeamClientPermissions(team=Team(title=u"Team %d" % index, org=org), client=client)
+                db.session.add(assignment)
+                assignment.permissions = [u'view', u'edit']
+            db.session.commit()
+            key = client.key
+            db.session.remove()
+            with app.test_client() as browser:
+                with browser.session_transaction() as session:
+                    session['userid'] = owner_userid
+                with StatementCounter() as counter:
+                    response = browser.get('/apps/' + key)
+                assert response.status_code == 200
+            counts[size] = counter.count
+            db.session.remove()
+        steady = report("App page, owned by %s" % ('a user' if kind == 'user' else 'an organization'),
+            counts, log) and steady
+    return steady
+
+
+#: Syllables that seeded names are made of
+SYLLABLES = [u'an', u'bel', u'cor', u'da', u'el', u'fin', u'gar', u'hal', u'is', u'jo', u'ka', u'lin',
+    u'mar', u'nor', u'os', u'pra', u'qui', u'ro', u'sa', u'tor', u'ul', u'ven', u'wil', u'ya', u'zen']
+
+#: Users seeded per unit of benchmark size, and searches timed per size
+SEARCH_USERS_PER_SIZE = 200
+SEARCH_QUERIES = 200
+
+
+def bench_search(sizes, log):
+    """
+    Searches through the search page, with growing numbers of users. Users
+    are inserted directly and indexed in bulk, as an import would.
+    """
+    from lastuserapp.models.search import index_users
+    rng = random.Random(0)
+    word = lambda: u''.join(rng.choice(SYLLABLES) for i in range(rng.randint(2, 3)))
+    searcher = make_user(u'benchsearch')
+    db.session.commit()
+    searcher_userid = searcher.userid
+    table = User.__table__
+    seeded = 0
+    counts = {}
+    for size in sizes:
+        connection = db.session.connection()
+        while seeded < size * SEARCH_USERS_PER_SIZE:
+            batch = min(1000, size * SEARCH_USERS_PER_SIZE - seeded)
+            first = connection.execute(db.select([db.func.max(table.c.id)])).scalar()
+            connection.execute(table.insert(), [{'fullname': (word() + u' ' + word()).title(),
+                'username': u'benchsearch%d' % (seeded + index)} for index in range(batch)])
+            index_users(connection, [row[0] for row in connection.execute(
+                db.select([table.c.id], table.c.id > first))])
+            seeded += batch
+        db.session.commit()
+        queries = [word() if rng.random() < 0.5 else word()[:3] for i in range(SEARCH_QUERIES)]
+        timings = []
+        statements = set()
+        with app.test_client() as browser:
+            with browser.session_transaction() as session:
+                session['userid'] = searcher_userid
+            # The first request looks up the user's avatar for the session
+            browser.get('/search')
+            for query in queries:
+                with StatementCounter() as counter:
+                    started = time.time()
+                    response = browser.get('/search', query_string={'q': query})
+                    timings.append((time.time() - started) * 1000)
+                assert response.status_code == 200
+                statements.add(counter.count)
+        db.session.remove()
+        print >> log, "      Search with %d users: p50 %.1f ms, p99 %.1f ms" % (seeded,
+            percentile(timings, 0.5), percentile(timings, 0.99))
+        # Searches that find nothing skip loading users, so take the most
+        counts[size] = max(statements)
+    return report("Search", counts, log)
+
+
+#: Benchmarks, as (name, function taking sizes and a log file)
+BENCHMARKS = [
+    ('organizations', bench_organizations),
+    ('client-info', bench_client_info),
+    ('search', bench_search),
+    ]
+
+
+def run_benchmarks(names=None, sizes=(1, 10, 50), log=sys.stdout):
+    """
+    Run the named benchmarks, or all of them. Returns the number that
+    failed.
+    """
+    failures = 0
+    for name, benchmark in BENCHMARKS:
+        if not names or name in names:
+            failures += not benchmark(sizes, log)
+    return failures
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""
+Bulk export of users with their email addresses, phone numbers, external ids
+and team memberships, as JSON lines. The output can be read back by the
+importer in :mod:`lastuserapp.bulkimport`.
+
+Users are read with a server-side cursor. Related rows are fetched for one
+batch of users at a time with IN queries, so memory use stays constant no
+matter how many users there are.
+"""
+
+import json
+import zlib
+from itertools import islice
+
+from lastuserapp.models import db, User, UserEmail, UserPhone, UserExternalId, Team
+from lastuserapp.models.user import team_membership
+
+
+def related_rows(query, user_id_column, ids):
+    """
+    Group the rows of a query by user id for the given batch of ids.
+    """
+    grouped = {}
+    for row in query.filter(user_id_column.in_(ids)):
+        grouped.setdefault(row[0], []).append(row[1:])
+    return grouped
+
+
+def export_users(batch_size=1000, passwords=False):
+    """
+    Yield a dictionary for each user, in order of creation. Password hashes
+    are only included if passwords is True.
+    """
+    users = db.session.query(User.id, User.userid, User._username.label('username'), User.fullname,
+        User.description, User.pw_hash, User.created_at).order_by(User.id).yield_per(batch_size)
+    users = iter(users)
+    while True:
+        batch = list(islice(users, batch_size))
+        if not batch:
+            break
+        ids = [row.id for row in batch]
+        emails = related_rows(db.session.query(UserEmail.user_id, UserEmail.email, UserEmail.primary),
+            UserEmail.user_id, ids)
+        phones = related_rows(db.session.query(UserPhone.user_id, UserPhone.phone, UserPhone.primary),
+            UserPhone.user_id, ids)
+        extids = related_rows(db.session.query(UserExternalId.user_id, UserExternalId.service,
+            UserExternalId.userid, UserExternalId.username), UserExternalId.user_id, ids)
+        teams = related_rows(db.session.query(team_membership.c.user_id, Team.userid).join(
+            Team, Team.id == team_membership.c.team_id), team_membership.c.user_id, ids)
+
+        for row in batch:
+            record = {
+                'userid': row.userid,
+                'username': row.username,
+                'fullname': row.fullname,
+                'description': row.description,
+                'created_at': row.created_at.isoformat(),
+                'emails': [{'email': email, 'primary': primary} for email, primary in emails.get(row.id, [])],
+                'phones': [{'phone': phone, 'primary': primary} for phone, primary in phones.get(row.id, [])],
+                'externalids': [{'service': service, 'userid': userid, 'username': username}
+                    for service, userid, username in extids.get(row.id, [])],
+                'teams': [teamid for (teamid,) in teams.get(row.id, [])],
+                }
+            if passwords:
+                record['pw_hash'] = row.pw_hash
+            yield record
+
+
+def jsonl_lines(records):
+    """
+    Encode records as JSON lines.
+    """
+    for record in records:
+        yield json.dumps(record) + '\n'
+
+
+def gzip_stream(chunks):
+    """
+    Compress a stream of strings into a gzip stream.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
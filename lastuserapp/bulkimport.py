@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+"""
+Bulk import of users from another system.
+
+Input is a stream of records, one per user, read from JSON lines or CSV.
+A JSON record looks like this (all keys but fullname are optional)::
+
+    {"userid": "...", "username": "jdoe", "fullname": "Jane Doe",
+     "password": "plaintext" or "pw_hash": "sha1$...",
+     "emails": ["jane@example.com", ...],
+     "externalids": [{"service": "twitter", "userid": "123", "username": "jdoe"}, ...],
+     "teams": ["<team userid>", ...]}
+
+CSV files have the columns userid, username, fullname, password, pw_hash,
+description, emails, externalids and teams. Multiple emails and teams are
+separated by spaces. External ids are listed as service:userid.
+
+Records are inserted in batches with executemany and committed once per
+batch. Records that conflict with existing users (or with each other) on
+any unique column are skipped and counted.
+"""
+
+import csv
+import json
+import os
+import sys
+import time
+from hashlib import md5
+from itertools import islice
+from multiprocessing import Pool
+
+from werkzeug import generate_password_hash
+
+from lastuserapp import RESERVED_USERNAMES
+from lastuserapp.models import db, User, UserEmail, UserExternalId, Team, Name
+from lastuserapp.models.user import team_membership
+from lastuserapp.models.search import index_users
+from lastuserapp.utils import newid, valid_username, chunks
+
+
+def read_jsonl(stream):
+    """
+    Read records from a JSON lines stream.
+    """
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def read_csv(stream):
+    """
+    Read records from a CSV stream with a header row.
+    """
+    for row in csv.DictReader(stream):
+        row = dict((key, (value or '').decode('utf-8').strip()) for key, value in row.items() if key)
+        record = dict((key, row[key]) for key in
+            ('userid', 'username', 'fullname', 'password', 'pw_hash', 'description') if row.get(key))
+        record['emails'] = row.get('emails', u'').split()
+        record['externalids'] = [dict(zip(('service', 'userid'), item.split(u':', 1)))
+            for item in row.get('externalids', u'').split() if u':' in item]
+        record['teams'] = row.get('teams', u'').split()
+        yield record
+
+
+def existing_values(column, values):
+    """
+    Return the subset of values already present in the given column.
+    """
+    found = set()
+    for chunk in chunks(set(values)):
+        found.update(row[0] for row in db.session.query(column).filter(column.in_(chunk)))
+    return found
+
+
+def email_list(record):
+    """
+    Return email addresses in a record as a list of strings, primary first.
+    Accepts plain strings or dictionaries as produced by the exporter.
+    """
+    emails = []
+    for item in record.get('emails') or []:
+        if isinstance(item, dict):
+            if item.get('primary'):
+                emails.insert(0, item['email'])
+            else:
+                emails.append(item['email'])
+        else:
+            emails.append(item)
+    return emails
+
+
+def valid_externalids(externalids):
+    """
+    Check that external ids are a list of dictionaries, each with a service
+    and a userid.
+    """
+    return isinstance(externalids, list) and all(isinstance(item, dict) and
+        item.get('service') and isinstance(item['service'], basestring) and
+        item.get('userid') and isinstance(item['userid'], basestring) for item in externalids)
+
+
+class UserImporter(object):
+    """
+    Imports users in batches. Call :meth:`run` with an iterable of records.
+
+    :param batch_size: Number of records inserted and committed together
+    :param processes: Size of the password hashing process pool (default: one per CPU)
+    :param statefile: Path of a file recording how many records have been committed,
+        used to resume an interrupted import
+    :param log: Stream for progress reports
+    """
+    def __init__(self, batch_size=1000, processes=None, statefile=None, log=sys.stderr):
+        self.batch_size = batch_size
+        self.processes = processes
+        self.statefile = statefile
+        self.log = log
+        self.pool = None
+        self.committed = 0
+        self.imported = 0
+        self.skipped = {}
+        self.unknown_teams = 0
+
+    def resume_position(self):
+        """
+        Return the number of records committed by a previous run.
+        """
+        if self.statefile and os.path.exists(self.statefile):
+            with open(self.statefile) as f:
+                return json.load(f).get('committed', 0)
+        return 0
+
+    def save_position(self):
+        if self.statefile:
+            tempfile = self.statefile + '.tmp'
+            with open(tempfile, 'w') as f:
+                json.dump({'committed': self.committed}, f)
+            os.rename(tempfile, self.statefile)
+
+    def skip(self, reason):
+        self.skipped[reason] = self.skipped.get(reason, 0) + 1
+
+    def hash_passwords(self, passwords):
+        if not passwords:
+            return []
+        if self.pool is None:
+            self.pool = Pool(self.processes)
+        return self.pool.map(generate_password_hash, passwords, chunksize=max(1, len(passwords) // 32))
+
+    def run(self, records, resume=False):
+        """
+        Import all records. If resume is True, records committed by a previous
+        run with the same state file are skipped.
+        """
+        records = iter(records)
+        if resume:
+            self.committed = self.resume_position()
+            for record in islice(records, self.committed):
+                pass
+        started = time.time()
+        try:
+            while True:
+                batch = list(islice(records, self.batch_size))
+                if not batch:
+                    break
+                self.import_batch(batch)
+                db.session.commit()
+                self.committed += len(batch)
+                self.save_position()
+                self.report(started)
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+        self.report(started, final=True)
+
+    def report(self, started, final=False):
+        elapsed = max(time.time() - started, 0.001)
+        skipped = sum(self.skipped.values())
+        print >> self.log, "%s%d records committed, %d imported, %d skipped in %.1fs (%.0f records/s)" % (
+            "Done. " if final else "", self.committed, self.imported, skipped, elapsed,
+            (self.imported + skipped) / elapsed)
+        if final:
+            for reason, count in sorted(self.skipped.items()):
+                print >> self.log, "  skipped for conflicting or invalid %s: %d" % (reason, count)
+            if self.unknown_teams:
+                print >> self.log, "  team memberships ignored for unknown teams: %d" % self.unknown_teams
+
+    def import_batch(self, batch):
+        # Step 1: Normalize records and drop those that conflict within the batch
+        seen_userids, seen_names, seen_emails, seen_extids = set(), set(), set(), set()
+        candidates = []
+        for record in batch:
+            username = record.get('username') or None
+            emails = email_list(record)
+            externalids = record.get('externalids') or []
+            if not valid_externalids(externalids):
+                self.skip('externalid')
+                continue
+            extids = [(e['service'], e['userid']) for e in externalids]
+            if not record.get('fullname'):
+                self.skip('fullname')
+            elif username and (username in RESERVED_USERNAMES or not valid_username(username)):
+                self.skip('username')
+            elif record.get('userid') in seen_userids:
+                self.skip('userid')
+            elif username in seen_names:
+                self.skip('username')
+            elif seen_emails.intersection(emails) or len(set(emails)) != len(emails):
+                self.skip('email')
+            elif seen_extids.intersection(extids):
+                self.skip('externalid')
+            else:
+                record = dict(record, userid=record.get('userid') or newid(), username=username,
+                    emails=emails, externalids=externalids)
+                seen_userids.add(record['userid'])
+                if username:
+                    seen_names.add(username)
+                seen_emails.update(emails)
+                seen_extids.update(extids)
+                candidates.append(record)
+
+        # Step 2: Check the batch against existing rows, one query per unique index
+        taken_userids = existing_values(User.userid, seen_userids)
+        taken_names = existing_values(Name.name, seen_names)
+        taken_emails = existing_values(UserEmail.email, seen_emails)
+        taken_extids = set()
+        for chunk in chunks(set(userid for service, userid in seen_extids)):
+            taken_extids.update(db.session.query(UserExternalId.service, UserExternalId.userid).filter(
+                UserExternalId.userid.in_(chunk)))
+
+        accepted = []
+        for record in candidates:
+            if record['userid'] in taken_userids:
+                self.skip('userid')
+            elif record['username'] in taken_names:
+                self.skip('username')
+            elif taken_emails.intersection(record['emails']):
+                self.skip('email')
+            elif taken_extids.intersection((e['service'], e['userid']) for e in record['externalids']):
+                self.skip('externalid')
+            else:
+                accepted.append(record)
+        if not accepted:
+            return
+
+        # Step 3: Hash plaintext passwords in the process pool
+        plaintext = [record for record in accepted if record.get('password')]
+        for record, pw_hash in zip(plaintext, self.hash_passwords([r['password'] for r in plaintext])):
+            record['pw_hash'] = pw_hash
+
+        # Step 4: Insert users and look up their new ids
+        db.session.execute(User.__table__.insert(), [{
+            'userid': record['userid'],
+            'username': record['username'],
+            'fullname': record['fullname'],
+            'pw_hash': record.get('pw_hash'),
+            'description': record.get('description', u''),
+            } for record in accepted])
+        ids = {}
+        for chunk in chunks(record['userid'] for record in accepted):
+            ids.update((userid, id) for id, userid in
+                db.session.query(User.id, User.userid).filter(User.userid.in_(chunk)))
+
+        teams = {}
+        for chunk in chunks(set(teamid for record in accepted for teamid in record.get('teams') or [])):
+            teams.update((userid, id) for id, userid in
+                db.session.query(Team.id, Team.userid).filter(Team.userid.in_(chunk)))
+
+        # Step 5: Insert dependent rows
+        names, emails, extids, memberships = [], [], [], []
+        for record in accepted:
+            user_id = ids[record['userid']]
+            if record['username']:
+                names.append({'name': record['username'], 'user_id': user_id})
+            for index, email in enumerate(record['emails']):
+                emails.append({'user_id': user_id, 'email': email, 'primary': index == 0,
+                    'md5sum': md5(email.encode('utf-8')).hexdigest()})
+            for extid in record['externalids']:
+                extids.append({'user_id': user_id, 'service': extid['service'], 'userid': extid['userid'],
+                    'username': extid.get('username')})
+            for teamid in set(record.get('teams') or []):
+                if teamid in teams:
+                    memberships.append({'user_id': user_id, 'team_id': teams[teamid]})
+                else:
+                    self.unknown_teams += 1
+
+        for table, rows in [(Name.__table__, names), (UserEmail.__table__, emails),
+                (UserExternalId.__table__, extids), (team_membership, memberships)]:
+            if rows:
+                db.session.execute(table.insert(), rows)
+        index_users(db.session.connection(), ids.values())
+        self.imported += len(accepted)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""
+Shared cache for rendered pages and computed data.
+
+Uses memcached if CACHE_MEMCACHED_SERVERS is set in settings (this needs the
+python-memcached package), otherwise an in-process cache. The in-process
+cache is not shared between worker processes, so invalidation only reaches
+the process that made the change; entries elsewhere expire after
+CACHE_TIMEOUT seconds.
+
+Groups of entries are invalidated together by including a generation marker
+in their keys. Call :func:`bump` to move a group to a new generation, or
+:func:`bump_after_commit` when the change is part of a database transaction,
+so that other processes do not cache data from before the commit under the
+new generation.
+"""
+
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from werkzeug.contrib.cache import SimpleCache, MemcachedCache
+
+from lastuserapp import app
+from lastuserapp.utils import newid
+
+#: Whether the cache is shared between processes, so that bumping a generation
+#: invalidates entries everywhere
+shared = bool(app.config.get('CACHE_MEMCACHED_SERVERS'))
+
+if shared:
+    cache = MemcachedCache(app.config['CACHE_MEMCACHED_SERVERS'],
+        default_timeout=app.config.get('CACHE_TIMEOUT', 300), key_prefix='lastuser/')
+else:
+    cache = SimpleCache(default_timeout=app.config.get('CACHE_TIMEOUT', 300))
+
+
+def generation(group):
+    """
+    Return the current generation marker for a group of cache entries.
+    """
+    key = 'generation/' + group
+    value = cache.get(key)
+    if value is None:
+        value = newid()
+        cache.set(key, value, timeout=86400)
+    return value
+
+
+def bump(group):
+    """
+    Invalidate all entries in a group by moving it to a new generation.
+    """
+    cache.set('generation/' + group, newid(), timeout=86400)
+
+
+def generations(*groups):
+    """
+    Return the generation markers for several groups, with one cache lookup.
+    """
+    values = cache.get_many(*['generation/' + group for group in groups])
+    return [value if value is not None else generation(group) for group, value in zip(groups, values)]
+
+
+# Groups to bump when each session commits
+_pending = WeakKeyDictionary()
+
+
+def bump_after_commit(session, *groups):
+    """
+    Bump groups when the session's current transaction commits. Nothing is
+    bumped if it is rolled back.
+    """
+    _pending.setdefault(session, set()).update(groups)
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_pending(session):
+    for group in _pending.pop(session, ()):
+        bump(group)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_pending(session):
+    _pending.pop(session, None)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+"""
+Feed of changes to users, organizations, teams and team memberships, for
+client apps that keep a copy of them.
+
+Changed rows are found through their updated_at columns (team memberships
+are never updated, only created and deleted) and deletions through the
+tombstone table. Each kind is read in (updated_at, id) order from where the
+previous call left off, as recorded in an opaque cursor. A client starts
+with no cursor, which returns everything, and then asks for what changed
+after the cursor it was last given.
+
+A transaction may commit some time after the timestamps in it were taken,
+so rows changed in the last CHANGE_FEED_LAG seconds are held back until
+they are older than that. Otherwise a slow transaction's rows could land
+behind a cursor that has already moved past them. Timestamps are written
+with the database's clock, so the lag is measured against that clock too.
+"""
+
+from datetime import datetime, timedelta
+
+from lastuserapp.models import db, User, Organization, Team, Tombstone
+from lastuserapp.models.user import team_membership
+from lastuserapp.utils import encode_cursor, decode_cursor
+
+#: Kinds of rows in the feed, in the order of their positions in a cursor
+KINDS = ('users', 'organizations', 'teams', 'memberships', 'deleted')
+
+
+def after(columns, values):
+    """
+    Return a condition for rows that come after values in the order of columns.
+    """
+    clauses = []
+    for index, column in enumerate(columns):
+        clauses.append(db.and_(*[columns[i] == values[i] for i in range(index)] + [column > values[index]]))
+    return db.or_(*clauses)
+
+
+def parse_timestamp(value):
+    for format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError("Invalid timestamp: %s" % value)
+
+
+def parse_cursor(cursor):
+    """
+    Return the position of each kind from a cursor, or None if the cursor is
+    invalid. Positions are None for kinds not read yet.
+    """
+    if not cursor:
+        return dict((kind, None) for kind in KINDS)
+    values = decode_cursor(cursor)
+    if not values or len(values) != len(KINDS):
+        return None
+    positions = dict(zip(KINDS, values))
+    for kind in KINDS[:-1]:
+        position = positions[kind]
+        if position is None:
+            continue
+        # A timestamp followed by the ids the kind is ordered by
+        if not isinstance(position, list) or len(position) != (3 if kind == 'memberships' else 2):
+            return None
+        if not isinstance(position[0], basestring) or not all(isinstance(id, (int, long)) for id in position[1:]):
+            return None
+        try:
+            positions[kind] = [parse_timestamp(position[0])] + position[1:]
+        except ValueError:
+            return None
+    deleted = positions['deleted']
+    if deleted is not None and not isinstance(deleted, (int, long)):
+        return None
+    return positions
+
+
+def page(query, columns, position, horizon, limit):
+    """
+    Return up to limit rows of a query after position, changed before the
+    horizon, and whether there are more.
+    """
+    query = query.filter(columns[0] <= horizon)
+    if position is not None:
+        query = query.filter(after(columns, position))
+    rows = query.order_by(*columns).limit(limit + 1).all()
+    return rows[:limit], len(rows) > limit
+
+
+def changes(cursor, limit, lag):
+    """
+    Return up to limit changes of each kind after the cursor, as a dictionary
+    of lists keyed by kind, with the cursor to continue from and a flag
+    telling if there are more changes waiting. Returns None if the cursor is
+    invalid.
+    """
+    positions = parse_cursor(cursor)
+    if positions is None:
+        return None
+    horizon = db.session.query(db.func.now()).scalar() - timedelta(seconds=lag)
+    result = {}
+    more = False
+
+    rows, partial = page(db.session.query(User.updated_at, User.id, User.userid, User._username, User.fullname),
+        [User.updated_at, User.id], positions['users'], horizon, limit)
+    result['users'] = [{'userid': userid, 'name': username, 'title': fullname}
+        for updated_at, id, userid, username, fullname in rows]
+    if rows:
+        positions['users'] = [rows[-1][0], rows[-1][1]]
+    more = more or partial
+
+    rows, partial = page(db.session.query(Organization.updated_at, Organization.id, Organization.userid,
+        Organization._name, Organization.title), [Organization.updated_at, Organization.id],
+        positions['organizations'], horizon, limit)
+    result['organizations'] = [{'userid': userid, 'name': name, 'title': title}
+        for updated_at, id, userid, name, title in rows]
+    if rows:
+        positions['organizations'] = [rows[-1][0], rows[-1][1]]
+    more = more or partial
+
+    rows, partial = page(db.session.query(Team.updated_at, Team.id, Team.userid, Team.title,
+        Organization.userid).join(Organization, Team.org_id == Organization.id), [Team.updated_at, Team.id],
+        positions['teams'], horizon, limit)
+    result['teams'] = [{'userid': userid, 'title': title, 'org': org}
+        for updated_at, id, userid, title, org in rows]
+    if rows:
+        positions['teams'] = [rows[-1][0], rows[-1][1]]
+    more = more or partial
+
+    columns = [team_membership.c.updated_at, team_membership.c.team_id, team_membership.c.user_id]
+    rows, partial = page(db.session.query(*columns + [Team.userid, User.userid]).join(
+        Team, Team.id == team_membership.c.team_id).join(User, User.id == team_membership.c.user_id),
+        columns, positions['memberships'], horizon, limit)
+    result['memberships'] = [{'team': team, 'user': user} for updated_at, team_id, user_id, team, user in rows]
+    if rows:
+        positions['memberships'] = list(rows[-1][:3])
+    more = more or partial
+
+    query = db.session.query(Tombstone.id, Tombstone.kind, Tombstone.userid, Tombstone.member).filter(
+        Tombstone.created_at <= horizon)
+    if positions['deleted'] is not None:
+        query = query.filter(Tombstone.id > positions['deleted'])
+    rows = query.order_by(Tombstone.id).limit(limit + 1).all()
+    more = more or len(rows) > limit
+    rows = rows[:limit]
+    result['deleted'] = [{'type': kind, 'team': userid, 'user': member} if kind == 'membership'
+        else {'type': kind, 'userid': userid} for id, kind, userid, member in rows]
+    if rows:
+        positions['deleted'] = rows[-1][0]
+
+    for kind in KINDS[:-1]:
+        if positions[kind] is not None:
+            positions[kind] = [positions[kind][0].isoformat()] + positions[kind][1:]
+    return result, encode_cursor([positions[kind] for kind in KINDS]), more
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+"""
+Deletion of users, organizations, teams and client apps with everything that
+belongs to them.
+
+Deleting through the ORM loads every dependent row and deletes them one at a
+time. Here we walk a fixed dependency graph instead and remove rows with bulk
+DELETE statements, children before parents, at most ``batch_size`` rows per
+statement.
+
+Small deletions are carried out immediately. Larger ones are recorded as a
+:class:`DeletionJob` and carried out by the deletion worker (``manage.py
+deletion-worker``), which commits after every batch so that progress is
+visible and an interrupted job resumes where it stopped. Users,
+organizations and client apps queued for deletion are marked inactive in
+the same transaction, along with the client apps they own, so that they
+cannot log in or use their tokens while they wait.
+"""
+
+import sys
+import time
+import traceback
+
+from lastuserapp import app
+from lastuserapp.cache import bump_after_commit
+from lastuserapp.models import db, User, Organization, Team, Client, Tombstone, DeletionJob, DELETION_STATUS
+from lastuserapp.models.search import delete_documents
+
+#: Models that are deleted through this module
+DELETABLE = (User, Organization, Team, Client)
+
+#: Rows that belong to a row of each table and are deleted with it,
+#: as (table, foreign key column). Tables not listed here have no dependents.
+DEPENDENTS = {
+    'user': [
+        ('client', 'user_id'),
+        ('useremail', 'user_id'),
+        ('useremailclaim', 'user_id'),
+        ('userphone', 'user_id'),
+        ('userphoneclaim', 'user_id'),
+        ('passwordresetrequest', 'user_id'),
+        ('userexternalid', 'user_id'),
+        ('userflashmessage', 'user_id'),
+        ('team_membership', 'user_id'),
+        ('authcode', 'user_id'),
+        ('authtoken', 'user_id'),
+        ('permission', 'user_id'),
+        ('userclientpermissions', 'user_id'),
+        ('noticetype', 'user_id'),
+        ('name', 'user_id'),
+        ],
+    'organization': [
+        ('client', 'org_id'),
+        ('team', 'org_id'),
+        ('permission', 'org_id'),
+        ('name', 'org_id'),
+        ],
+    'team': [
+        ('team_membership', 'team_id'),
+        ('teamclientpermissions', 'team_id'),
+        ],
+    'client': [
+        ('resource', 'client_id'),
+        ('authcode', 'client_id'),
+        ('authtoken', 'client_id'),
+        ('userclientpermissions', 'client_id'),
+        ('teamclientpermissions', 'client_id'),
+        ('notification', 'client_id'),
+        ],
+    'resource': [('resourceaction', 'resource_id')],
+    'userclientpermissions': [('userclientpermission', 'assignment_id')],
+    'teamclientpermissions': [('teamclientpermission', 'assignment_id')],
+    }
+
+#: Columns that refer to a row of each table without belonging to it. They are
+#: set to NULL before the row is deleted.
+REFERENCES = {
+    'user': [('deletionjob', 'user_id')],
+    'team': [('organization', 'owners_id')],
+    }
+
+#: Search document kinds, for tables that are indexed for search
+SEARCH_KINDS = {'user': 'user', 'organization': 'org'}
+
+#: Tables whose deletions are recorded for the change feed
+TOMBSTONE_KINDS = ('user', 'organization', 'team')
+
+
+def _table(name):
+    return db.metadata.tables[name]
+
+
+def count_rows(name, ids, limit):
+    """
+    Count the rows that deleting the given rows of a table would remove,
+    including the rows themselves. Stops counting once limit is passed, so
+    the cost is bounded by limit.
+    """
+    total = len(ids)
+    for child, column in DEPENDENTS.get(name, []):
+        if total > limit:
+            break
+        table = _table(child)
+        key = table.c.id if 'id' in table.c else table.c[column]
+        child_ids = [row[0] for row in db.session.execute(
+            db.select([key], table.c[column].in_(ids)).limit(limit - total + 1))]
+        if child_ids:
+            if 'id' in table.c:
+                total += count_rows(child, child_ids, limit - total)
+            else:
+                total += len(child_ids)
+    return total
+
+
+def delete_rows(name, ids, batch_size=500, progress=None):
+    """
+    Delete rows of a table by id, with everything that belongs to them. At
+    most batch_size rows are deleted per statement. If given, progress is
+    called with the number of rows deleted after each statement.
+    """
+    for child, column in DEPENDENTS.get(name, []):
+        _delete_children(child, column, ids, batch_size, progress)
+    for referrer, column in REFERENCES.get(name, []):
+        table = _table(referrer)
+        db.session.execute(table.update().where(table.c[column].in_(ids)).values({column: None}))
+    if name in SEARCH_KINDS:
+        delete_documents(db.session.connection(), SEARCH_KINDS[name], ids)
+    table = _table(name)
+    if name in TOMBSTONE_KINDS:
+        Tombstone.record(name, [row[0] for row in db.session.execute(
+            db.select([table.c.userid], table.c.id.in_(ids)))])
+    result = db.session.execute(table.delete().where(table.c.id.in_(ids)))
+    if name == 'client':
+        bump_after_commit(db.session(), 'clients')
+    elif name in ('organization', 'team'):
+        # Cached user information lists organizations and teams
+        bump_after_commit(db.session(), 'organizations')
+    if progress:
+        progress(result.rowcount)
+
+
+def _delete_children(name, column, parent_ids, batch_size, progress):
+    table = _table(name)
+    if 'id' in table.c:
+        while True:
+            ids = [row[0] for row in db.session.execute(
+                db.select([table.c.id], table.c[column].in_(parent_ids)).limit(batch_size))]
+            if not ids:
+                break
+            delete_rows(name, ids, batch_size, progress)
+    else:
+        # Association table: delete by the other primary key column
+        key = [c for c in table.primary_key.columns if c.name != column][0]
+        while True:
+            rows = db.session.execute(db.select([table.c[column], key],
+                table.c[column].in_(parent_ids)).limit(batch_size)).fetchall()
+            if not rows:
+                break
+            grouped = {}
+            for parent_id, key_id in rows:
+                grouped.setdefault(parent_id, []).append(key_id)
+            for parent_id, key_ids in grouped.items():
+                db.session.execute(table.delete().where(db.and_(
+                    table.c[column] == parent_id, key.in_(key_ids))))
+            if progress:
+                progress(len(rows))
+
+
+def delete(ob, title, user=None):
+    """
+    Delete a user, organization, team or client app with everything that
+    belongs to it. If no more than DELETION_INLINE_LIMIT rows are affected,
+    they are deleted and committed immediately and None is returned.
+    Otherwise a :class:`DeletionJob` is queued, committed and returned.
+    """
+    name = ob.__table__.name
+    limit = app.config.get('DELETION_INLINE_LIMIT', 1000)
+    if count_rows(name, [ob.id], limit) <= limit:
+        delete_rows(name, [ob.id])
+        db.session.commit()
+        return None
+    deactivate(ob)
+    job = DeletionJob(user=user, kind=name, ref_id=ob.id, title=title)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def deactivate(ob):
+    """
+    Mark a user, organization or client app and the client apps it owns as
+    inactive. Changes are not committed.
+    """
+    if isinstance(ob, (User, Organization, Client)):
+        ob.active = False
+    if isinstance(ob, (User, Organization)):
+        owner = Client.user_id if isinstance(ob, User) else Client.org_id
+        Client.query.filter(owner == ob.id).update({'active': False}, synchronize_session=False)
+        bump_after_commit(db.session(), 'clients')
+
+
+def run_job(job, batch_size=500):
+    """
+    Carry out a queued deletion, committing after every batch.
+    """
+    job.status = DELETION_STATUS.RUNNING
+    db.session.commit()
+
+    def progress(count):
+        job.deleted += count
+        db.session.commit()
+
+    try:
+        delete_rows(job.kind, [job.ref_id], batch_size, progress)
+        job.status = DELETION_STATUS.DONE
+        db.session.commit()
+    except Exception, e:
+        db.session.rollback()
+        job.status = DELETION_STATUS.FAILED
+        job.error = unicode(e)
+        db.session.commit()
+        traceback.print_exc()
+
+
+def run_worker(batch_size=500, poll_interval=5, once=False, log=sys.stderr):
+    """
+    Carry out queued deletions, oldest first. Jobs left running by an
+    interrupted worker are resumed. Only one worker should run at a time.
+    """
+    while True:
+        job = DeletionJob.query.filter(DeletionJob.status.in_(
+            [DELETION_STATUS.QUEUED, DELETION_STATUS.RUNNING])).order_by(DeletionJob.id).first()
+        if job is None:
+            db.session.rollback()
+            if once:
+                break
+            time.sleep(poll_interval)
+            continue
+        print >> log, "Deleting %s %d (%s)" % (job.kind, job.ref_id, job.title)
+        run_job(job, batch_size)
+        print >> log, "  %d rows deleted" % job.deleted
@@ -39,8 +39,8 @@ class RegisterClientForm(wtf.Form):
     notification_uri = wtf.html5.URLField('Notification URI', validators=[wtf.Optional(), wtf.URL()],
         description="LastUser resource provider Notification URI. When another application requests access to "
             "resources provided by this app, LastUser will post a notice to this URI with a copy of the access "
-            "token that was provided to the other application. Other notices may be posted too "
-            "(not yet implemented)")
+            "token that was provided to the other application. Notices are signed with this app's client "
+            "secret. Must be an https URI")
     iframe_uri = wtf.html5.URLField('IFrame URI', validators=[wtf.Optional(), wtf.URL()],
         description="Front-end notifications URL. This is loaded in a hidden iframe to notify the app that the "
             "user updated their profile in some way (not yet implemented)")
@@ -61,6 +61,11 @@ class RegisterClientForm(wtf.Form):
             self.user = None
             self.org = orgs[0]
 
+    def validate_notification_uri(self, field):
+        # Notices carry access tokens
+        if field.data and not field.data.startswith('https://'):
+            raise wtf.ValidationError("The notification URI must use https")
+
 
 class PermissionForm(wtf.Form):
     """
@@ -4,7 +4,7 @@ from flask import Markup, url_for
 import flask.ext.wtf as wtf
 
 from lastuserapp import RESERVED_USERNAMES
-from lastuserapp.models import User, UserEmail, getuser
+from lastuserapp.models import UserEmail, Name, getuser
 from lastuserapp.utils import valid_username
 
 
@@ -15,12 +15,12 @@ class LoginForm(wtf.Form):
 
     def validate_username(self, field):
         existing = getuser(field.data)
-        if existing is None:
+        if existing is None or not existing.active:
             raise wtf.ValidationError, "User does not exist"
 
     def validate_password(self, field):
         user = getuser(self.username.data)
-        if user is None or not user.password_is(field.data):
+        if user is None or not user.active or not user.password_is(field.data):
             raise wtf.ValidationError, "Incorrect password"
         self.user = user
 
@@ -45,8 +45,7 @@ class RegisterForm(wtf.Form):
             raise wtf.ValidationError, "That name is reserved"
         if not valid_username(field.data):
             raise wtf.ValidationError, u"Invalid characters in name. Names must be made of ‘a-z’, ‘0-9’ and ‘-’, without trailing dashes"
-        existing = User.query.filter_by(username=field.data).first()
-        if existing is not None:
+        if not Name.is_available(field.data):
             raise wtf.ValidationError, "That username is taken"
 
     def validate_email(self, field):
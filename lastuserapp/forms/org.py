@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
 
+from flask import url_for, json
 import flask.ext.wtf as wtf
 
 from lastuserapp import RESERVED_USERNAMES
-from lastuserapp.utils import valid_username
-from lastuserapp.models import User, Organization
+from lastuserapp.utils import valid_username, chunks
+from lastuserapp.models import User, Name
 
 
 class OrganizationForm(wtf.Form):
@@ -17,25 +18,51 @@ class OrganizationForm(wtf.Form):
             raise wtf.ValidationError, "Invalid characters in name"
         if field.data in RESERVED_USERNAMES:
             raise wtf.ValidationError, "That name is reserved"
-        existing = User.query.filter_by(username=field.data).first()
-        if existing is not None:
+        if not Name.is_available(field.data, self.edit_obj):
             raise wtf.ValidationError, "That name is taken"
-        existing = Organization.query.filter_by(name=field.data).first()
-        if self.edit_obj:
-            if existing is not None and existing.id != self.edit_obj.id:
-                raise wtf.ValidationError, "That name is taken"
-        else:
-            if existing is not None:
-                raise wtf.ValidationError, "That name is taken"
 
 
-# FIXME: This will have too many users in production. Use some form of lookup instead
-def sorted_users():
-    return User.query.order_by('fullname')
+class UserPickerInput(wtf.widgets.TextInput):
+    """
+    Text input for a list of userids, enhanced with a typeahead user picker by
+    scripts.js. The currently selected users are passed along with their names.
+    """
+    def __call__(self, field, **kwargs):
+        kwargs.setdefault('data-autocomplete', url_for('user_autocomplete'))
+        kwargs['data-users'] = json.dumps([{'userid': user.userid, 'label': user.pickername}
+            for user in field.data or []])
+        return super(UserPickerInput, self).__call__(field, **kwargs)
+
+
+class UserSelectMultipleField(wtf.Field):
+    """
+    Select multiple users by their userids. Submitted userids are resolved a
+    chunk at a time, in one query per chunk, so the cost of the field does not
+    depend on the number of users in the system.
+    """
+    widget = UserPickerInput()
+
+    def _value(self):
+        return u','.join(user.userid for user in self.data or [])
+
+    def process_formdata(self, valuelist):
+        userids = []
+        for value in valuelist:
+            for userid in value.replace(u',', u' ').split():
+                if userid not in userids:
+                    userids.append(userid)
+        users = {}
+        for chunk in chunks(userids):
+            users.update((user.userid, user) for user in User.query.filter(User.userid.in_(chunk)))
+        self.unknown_userids = [userid for userid in userids if userid not in users]
+        self.data = [users[userid] for userid in userids if userid in users]
+
+    def pre_validate(self, form):
+        if getattr(self, 'unknown_userids', None):
+            raise ValueError("Unknown user")
 
 
 class TeamForm(wtf.Form):
     title = wtf.TextField('Team name', validators=[wtf.Required()])
-    users = wtf.QuerySelectMultipleField('Users', validators=[wtf.Required()],
-        query_factory=sorted_users, get_label='pickername',
+    users = UserSelectMultipleField('Users', validators=[wtf.Required()],
         description=u"Select users who are part of this team")
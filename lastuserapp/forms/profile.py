@@ -5,7 +5,7 @@ import flask.ext.wtf as wtf
 
 from lastuserapp import RESERVED_USERNAMES
 from lastuserapp.utils import valid_username, strip_phone, valid_phone
-from lastuserapp.models import User, UserEmail, UserEmailClaim, UserPhone, UserPhoneClaim, Organization, getuser
+from lastuserapp.models import UserEmail, UserEmailClaim, UserPhone, UserPhoneClaim, Name, getuser
 
 
 class PasswordResetRequestForm(wtf.Form):
@@ -47,11 +47,7 @@ class ProfileForm(wtf.Form):
             raise wtf.ValidationError, "Invalid characters in username"
         if field.data in RESERVED_USERNAMES:
             raise wtf.ValidationError, "That name is reserved"
-        existing = User.query.filter_by(username=field.data).first()
-        if existing is not None and existing.id != self.edit_obj.id:
-            raise wtf.ValidationError, "That username is taken"
-        existing = Organization.query.filter_by(name=field.data).first()
-        if existing is not None:
+        if not Name.is_available(field.data, self.edit_obj):
             raise wtf.ValidationError, "That username is taken"
 
 
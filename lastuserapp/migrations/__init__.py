@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+"""
+Versioned schema migrations.
+
+Each module in this package named ``vNNN_description.py`` upgrades the
+database from version NNN-1 to NNN with an ``upgrade(connection)`` function.
+The module docstring describes the change. The version a database is at is
+recorded in the schema_version table.
+
+Run ``manage.py migrate`` after upgrading the code. An empty database is
+created from the models and marked as being at the latest version. A
+database created before migrations were introduced is treated as being at
+version 0.
+
+SQLite commits before every DDL statement, so migrations cannot rely on
+being rolled back if they fail. They are written to be safe to run again.
+"""
+
+import os
+import sys
+import pkgutil
+
+from sqlalchemy.engine.reflection import Inspector
+
+from lastuserapp.models import db
+
+schema_version = db.Table('schema_version', db.Model.metadata,
+    db.Column('version', db.Integer, nullable=False))
+
+
+def migrations():
+    """
+    Return a list of (version, module) for all migrations, in order.
+    """
+    result = []
+    for loader, name, ispkg in pkgutil.iter_modules([os.path.dirname(__file__)]):
+        if name.startswith('v') and name[1:4].isdigit():
+            result.append((int(name[1:4]), __import__('lastuserapp.migrations.' + name, fromlist=['upgrade'])))
+    return sorted(result)
+
+
+def current_version(connection):
+    """
+    Return the database's schema version, or None if it is not versioned.
+    """
+    if not connection.dialect.has_table(connection, 'schema_version'):
+        return None
+    return connection.execute(db.select([db.func.max(schema_version.c.version)])).scalar() or 0
+
+
+def set_version(connection, version):
+    connection.execute(schema_version.delete())
+    connection.execute(schema_version.insert(), version=version)
+
+
+def migrate(log=sys.stderr):
+    """
+    Bring the database up to the latest version.
+    """
+    available = migrations()
+    latest = available[-1][0] if available else 0
+    connection = db.engine.connect()
+    try:
+        version = current_version(connection)
+        if version is None:
+            if not connection.dialect.has_table(connection, 'user'):
+                db.metadata.create_all(connection)
+                set_version(connection, latest)
+                print >> log, "Created database at version %d" % latest
+                return
+            schema_version.create(connection)
+            version = 0
+        for number, module in available:
+            if number <= version:
+                continue
+            print >> log, "Migrating to version %d: %s" % (number, module.__doc__.strip().splitlines()[0])
+            transaction = connection.begin()
+            try:
+                module.upgrade(connection)
+                set_version(connection, number)
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
+        print >> log, "Database is at version %d" % max(version, latest)
+    finally:
+        connection.close()
+
+
+# --- Helpers for migrations --------------------------------------------------
+
+def quote(connection, name):
+    return connection.dialect.identifier_preparer.quote_identifier(name)
+
+
+def column_names(connection, table_name):
+    return [column['name'] for column in Inspector.from_engine(connection).get_columns(table_name)]
+
+
+def index_names(connection, table_name):
+    return [index['name'] for index in Inspector.from_engine(connection).get_indexes(table_name)]
+
+
+def create_table(connection, table_name):
+    """
+    Create a table as defined in the models, with its indexes, unless it exists.
+    """
+    db.metadata.tables[table_name].create(connection, checkfirst=True)
+
+
+def create_index(connection, table_name, index_name):
+    """
+    Create an index as defined in the models, unless it exists.
+    """
+    if index_name in index_names(connection, table_name):
+        return
+    for index in db.metadata.tables[table_name].indexes:
+        if index.name == index_name:
+            index.create(connection)
+            return
+    raise KeyError("No index named %s on table %s" % (index_name, table_name))
+
+
+def add_column(connection, table_name, column_name):
+    """
+    Add a column as defined in the models, unless it exists. The column is
+    added without its constraints or default, so the migration must fill it
+    in for existing rows.
+    """
+    if column_name in column_names(connection, table_name):
+        return
+    column = db.metadata.tables[table_name].c[column_name]
+    connection.execute('ALTER TABLE %s ADD COLUMN %s %s' % (quote(connection, table_name),
+        quote(connection, column_name), column.type.compile(dialect=connection.dialect)))
+
+
+def rebuild_table(connection, table_name, distinct=False):
+    """
+    Recreate a table from its model definition and copy its rows across,
+    for changes that SQLite's ALTER TABLE cannot make, such as dropping a
+    column or adding a primary key. Columns not in the model are dropped.
+    If distinct is True, duplicate rows are dropped as well.
+    """
+    table = db.metadata.tables[table_name]
+    old_name = table_name + '_old'
+    existing = column_names(connection, table_name)
+    # Index names are global in SQLite and would clash with the new table's
+    for index_name in index_names(connection, table_name):
+        if not index_name.startswith('sqlite_autoindex_'):
+            connection.execute('DROP INDEX %s' % quote(connection, index_name))
+    if connection.dialect.name == 'sqlite':
+        # Keep foreign keys in other tables pointing at this table's name
+        connection.execute('PRAGMA legacy_alter_table = ON')
+    connection.execute('ALTER TABLE %s RENAME TO %s' % (quote(connection, table_name), quote(connection, old_name)))
+    table.create(connection)
+    columns = ', '.join(quote(connection, column.name) for column in table.c if column.name in existing)
+    connection.execute('INSERT INTO %s (%s) SELECT %s%s FROM %s' % (quote(connection, table_name), columns,
+        'DISTINCT ' if distinct else '', columns, quote(connection, old_name)))
+    connection.execute('DROP TABLE %s' % quote(connection, old_name))
+
+
+def drop_column(connection, table_name, column_name):
+    """
+    Drop a column that has been removed from the model, if it is present.
+    """
+    if column_name not in column_names(connection, table_name):
+        return
+    if connection.dialect.name == 'sqlite':
+        rebuild_table(connection, table_name)
+    else:
+        connection.execute('ALTER TABLE %s DROP COLUMN %s' % (
+            quote(connection, table_name), quote(connection, column_name)))
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+"""
+Add the shared name registry for usernames and organization names.
+
+Existing usernames are registered first. An organization whose name is
+already held by a user is left without a registry entry and must be
+renamed.
+"""
+
+from lastuserapp.models import db
+from lastuserapp.migrations import create_table
+from lastuserapp.utils import chunks
+
+
+def upgrade(connection):
+    create_table(connection, 'name')
+    tables = db.metadata.tables
+    name = tables['name']
+    taken = set(row[0] for row in connection.execute(db.select([name.c.name])))
+    rows = []
+    for table_name, column_name, key in [('user', 'username', 'user_id'), ('organization', 'name', 'org_id')]:
+        table = tables[table_name]
+        column = table.c[column_name]
+        for id, value in connection.execute(db.select([table.c.id, column], column != None).order_by(table.c.id)):
+            if value not in taken:
+                taken.add(value)
+                row = {'name': value, 'user_id': None, 'org_id': None}
+                row[key] = id
+                rows.append(row)
+    for chunk in chunks(rows, 1000):
+        connection.execute(name.insert(), chunk)
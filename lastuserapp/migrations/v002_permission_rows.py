@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+"""
+Store permission assignments as one row per permission.
+
+The space-separated permissions column of userclientpermissions and
+teamclientpermissions is split into rows of userclientpermission and
+teamclientpermission, and then dropped.
+"""
+
+from lastuserapp.models import db
+from lastuserapp.migrations import create_table, column_names, drop_column, quote
+from lastuserapp.utils import chunks
+
+
+def upgrade(connection):
+    for assignments, items in [('userclientpermissions', 'userclientpermission'),
+            ('teamclientpermissions', 'teamclientpermission')]:
+        create_table(connection, items)
+        if 'permissions' not in column_names(connection, assignments):
+            continue
+        rows = []
+        for id, client_id, permissions in connection.execute('SELECT id, client_id, permissions FROM %s' %
+                quote(connection, assignments)):
+            for permission in set((permissions or u'').split()):
+                rows.append({'assignment_id': id, 'client_id': client_id, 'name': permission})
+        for chunk in chunks(rows, 1000):
+            connection.execute(db.metadata.tables[items].insert(), chunk)
+        drop_column(connection, assignments, 'permissions')
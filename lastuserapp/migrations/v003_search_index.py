@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+"""
+Add the search index over users and organizations, and fill it.
+"""
+
+from lastuserapp.models import db
+from lastuserapp.models.search import index_users, index_orgs
+from lastuserapp.migrations import create_table
+
+
+def upgrade(connection):
+    create_table(connection, 'searchdocument')
+    for table_name, indexer in [('user', index_users), ('organization', index_orgs)]:
+        table = db.metadata.tables[table_name]
+        last_id = 0
+        while True:
+            ids = [row[0] for row in connection.execute(db.select([table.c.id], table.c.id > last_id).order_by(
+                table.c.id).limit(1000))]
+            if not ids:
+                break
+            indexer(connection, ids)
+            last_id = ids[-1]
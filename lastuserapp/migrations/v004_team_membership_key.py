@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+"""
+Give team_membership a primary key on (team_id, user_id) and an index on
+user_id. Duplicate memberships are removed.
+"""
+
+from sqlalchemy.engine.reflection import Inspector
+
+from lastuserapp.migrations import create_index, rebuild_table
+
+
+def upgrade(connection):
+    if Inspector.from_engine(connection).get_primary_keys('team_membership'):
+        return
+    if connection.dialect.name == 'postgresql':
+        connection.execute("DELETE FROM team_membership a USING team_membership b "
+            "WHERE a.ctid < b.ctid AND a.team_id = b.team_id AND a.user_id = b.user_id")
+        connection.execute("ALTER TABLE team_membership ADD PRIMARY KEY (team_id, user_id)")
+        create_index(connection, 'team_membership', 'ix_team_membership_user_id')
+    else:
+        rebuild_table(connection, 'team_membership', distinct=True)
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+
+"""
+Add the queue of deletion jobs.
+"""
+
+from lastuserapp.migrations import create_table
+
+
+def upgrade(connection):
+    create_table(connection, 'deletionjob')
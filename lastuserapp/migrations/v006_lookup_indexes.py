@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+"""
+Add indexes for frequent lookups.
+"""
+
+from lastuserapp.migrations import create_index
+
+INDEXES = [
+    ('user', 'ix_user_fullname'),
+    ('useremail', 'ix_useremail_user_id'),
+    ('useremailclaim', 'ix_useremailclaim_email'),
+    ('useremailclaim', 'ix_useremailclaim_md5sum'),
+    ('userexternalid', 'ix_userexternalid_user_id'),
+    ('userexternalid', 'ix_userexternalid_service_username'),
+    ('passwordresetrequest', 'ix_passwordresetrequest_user_id_reset_code'),
+    ('team', 'ix_team_org_id'),
+    ('client', 'ix_client_user_id'),
+    ('client', 'ix_client_org_id'),
+    ('client', 'ix_client_title_id'),
+    ('userflashmessage', 'ix_userflashmessage_user_id'),
+    ('resource', 'ix_resource_client_id'),
+    ('authcode', 'ix_authcode_code_client_id'),
+    ]
+
+
+def upgrade(connection):
+    for table_name, index_name in INDEXES:
+        create_index(connection, table_name, index_name)
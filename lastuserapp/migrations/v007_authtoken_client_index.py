@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+
+"""
+Index auth tokens by client, for revoking all tokens of a client.
+"""
+
+from lastuserapp.migrations import create_index
+
+
+def upgrade(connection):
+    create_index(connection, 'authtoken', 'ix_authtoken_client_id')
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+
+"""
+Record when access tokens were last used.
+"""
+
+from lastuserapp.migrations import add_column, create_index
+
+
+def upgrade(connection):
+    add_column(connection, 'authtoken', 'last_used')
+    # Existing tokens count as used when last changed, so none are pruned right away
+    connection.execute('UPDATE authtoken SET last_used = updated_at WHERE last_used IS NULL')
+    create_index(connection, 'authtoken', 'ix_authtoken_last_used')
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+
+"""
+Add the outbox of notices for client apps.
+"""
+
+from lastuserapp.migrations import create_table
+
+
+def upgrade(connection):
+    create_table(connection, 'notification')
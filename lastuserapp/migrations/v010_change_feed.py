@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+
+"""
+Add timestamps to team memberships and the tombstone table for the change feed.
+"""
+
+from lastuserapp.migrations import add_column, create_index, create_table
+
+INDEXES = [
+    ('user', 'ix_user_updated_at_id'),
+    ('organization', 'ix_organization_updated_at_id'),
+    ('team', 'ix_team_updated_at_id'),
+    ('team_membership', 'ix_team_membership_updated_at'),
+    ]
+
+
+def upgrade(connection):
+    add_column(connection, 'team_membership', 'updated_at')
+    # Existing memberships date from when their team last changed
+    connection.execute('UPDATE team_membership SET updated_at = (SELECT team.updated_at FROM team '
+        'WHERE team.id = team_membership.team_id) WHERE updated_at IS NULL')
+    for table_name, index_name in INDEXES:
+        create_index(connection, table_name, index_name)
+    create_table(connection, 'tombstone')
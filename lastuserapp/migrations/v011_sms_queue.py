@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+"""
+Track send attempts of queued text messages.
+"""
+
+from lastuserapp.migrations import add_column, column_names, create_index
+
+
+def upgrade(connection):
+    # Messages saved with the default status before sends were queued were
+    # never sent. They are too old to send now.
+    if 'attempts' not in column_names(connection, 'smsmessage'):
+        connection.execute("UPDATE smsmessage SET status = 3, fail_reason = 'Not sent' WHERE status = 0")
+    add_column(connection, 'smsmessage', 'attempts')
+    add_column(connection, 'smsmessage', 'next_attempt_at')
+    connection.execute('UPDATE smsmessage SET attempts = 0 WHERE attempts IS NULL')
+    connection.execute('UPDATE smsmessage SET next_attempt_at = created_at WHERE next_attempt_at IS NULL')
+    create_index(connection, 'smsmessage', 'ix_smsmessage_status_next_attempt_at')
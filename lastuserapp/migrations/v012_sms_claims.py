@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+
+"""
+Let SMS workers claim the messages they send.
+"""
+
+from lastuserapp.migrations import add_column, create_index
+
+
+def upgrade(connection):
+    add_column(connection, 'smsmessage', 'claimed_by')
+    create_index(connection, 'smsmessage', 'ix_smsmessage_claimed_by')
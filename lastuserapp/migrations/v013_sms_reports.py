@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+
+"""
+Stage SMS delivery reports in a table for the SMS worker to apply.
+"""
+
+from lastuserapp.migrations import create_table
+
+
+def upgrade(connection):
+    create_table(connection, 'smsreport')
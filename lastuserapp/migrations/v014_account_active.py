@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+"""
+Mark users and organizations queued for deletion as inactive.
+"""
+
+from lastuserapp.models import db, User, Organization, Client, DeletionJob, DELETION_STATUS
+from lastuserapp.migrations import add_column
+
+
+def upgrade(connection):
+    add_column(connection, 'user', 'active')
+    add_column(connection, 'organization', 'active')
+    jobs = DeletionJob.__table__
+    clients = Client.__table__
+    for table, owner in [(User.__table__, clients.c.user_id), (Organization.__table__, clients.c.org_id)]:
+        queued = db.select([jobs.c.ref_id], db.and_(jobs.c.kind == table.name,
+            jobs.c.status.in_([DELETION_STATUS.QUEUED, DELETION_STATUS.RUNNING])))
+        # Leave updated_at alone, so that the change feed doesn't list every row again
+        connection.execute(table.update().where(table.c.active == None).values(active=True,
+            updated_at=table.c.updated_at))
+        connection.execute(table.update().where(table.c.id.in_(queued)).values(active=False))
+        connection.execute(clients.update().where(owner.in_(queued)).values(active=False))
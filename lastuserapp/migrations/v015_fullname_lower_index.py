@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+
+"""
+Index lower-cased user names for the user picker.
+"""
+
+from lastuserapp.models import User
+from lastuserapp.models.user import fullname_lower_index
+from lastuserapp.migrations import index_names
+
+
+def upgrade(connection):
+    if 'ix_user_fullname_lower' not in index_names(connection, 'user'):
+        fullname_lower_index.execute(connection, User.__table__)
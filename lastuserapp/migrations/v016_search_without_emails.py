@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+"""
+Remove email addresses from the search index.
+"""
+
+from lastuserapp.models import db
+from lastuserapp.models.search import index_users
+
+
+def upgrade(connection):
+    table = db.metadata.tables['user']
+    last_id = 0
+    while True:
+        ids = [row[0] for row in connection.execute(db.select([table.c.id], table.c.id > last_id).order_by(
+            table.c.id).limit(1000))]
+        if not ids:
+            break
+        index_users(connection, ids)
+        last_id = ids[-1]
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+from functools import wraps
+from flask import g, has_request_context
 from flask.ext.sqlalchemy import SQLAlchemy
 from lastuserapp import app
 
@@ -22,27 +24,109 @@ class BaseMixin(IdMixin, TimestampMixin):
     pass
 
 
+def request_cache():
+    """
+    Return a dictionary that lives for the duration of the current request,
+    or None if there is no request context (such as in a script).
+    """
+    if not has_request_context():
+        return None
+    cache = getattr(g, 'model_cache', None)
+    if cache is None:
+        cache = g.model_cache = {}
+    return cache
+
+
+def cached_per_request(f):
+    """
+    Decorator for model methods whose results can be reused for the rest of
+    the request. Results are keyed on the method, the instance's id and the
+    positional arguments. Unsaved instances are not cached.
+    """
+    @wraps(f)
+    def decorated_function(self, *args):
+        cache = request_cache()
+        if cache is None or self.id is None:
+            return f(self, *args)
+        key = (self.__class__.__name__, f.__name__, self.id) + args
+        if key not in cache:
+            cache[key] = f(self, *args)
+        return cache[key]
+    return decorated_function
+
+
 from lastuserapp.models.user import *
 from lastuserapp.models.client import *
 from lastuserapp.models.sms import *
+from lastuserapp.models.search import *
+from lastuserapp.models.deletion import *
+from lastuserapp.models.notification import *
 
 
 def getuser(name):
+    """
+    Return the user with the given username, email address or Twitter handle
+    (prefixed with '@'). A verified email address takes precedence over an
+    unverified claim. Each lookup is a single query and its result is reused
+    for the rest of the request.
+    """
+    cache = request_cache()
+    if cache is not None and ('getuser', name) in cache:
+        return cache[('getuser', name)]
+
     if '@' in name:
         if name.startswith('@'):
-            extid = UserExternalId.query.filter_by(service='twitter', username=name[1:]).first()
-            if extid:
-                return extid.user
-            else:
-                return None
+            user = User.query.join(UserExternalId, UserExternalId.user_id == User.id).filter(
+                UserExternalId.service == 'twitter', UserExternalId.username == name[1:]).first()
         else:
-            useremail = UserEmail.query.filter_by(email=name).first()
-            if useremail:
-                return useremail.user
-            # No verified email id. Look for an unverified id; return first found
-            useremail = UserEmailClaim.query.filter_by(email=name).first()
-            if useremail:
-                return useremail.user
-            return None
+            # Verified addresses rank ahead of claims. Of multiple claims, return the first found
+            candidates = db.union_all(
+                db.select([UserEmail.user_id.label('user_id'), db.literal_column('1').label('rank')],
+                    UserEmail.email == name),
+                db.select([UserEmailClaim.user_id.label('user_id'), db.literal_column('2').label('rank')],
+                    UserEmailClaim.email == name),
+                ).alias('candidates')
+            user = User.query.join(candidates, candidates.c.user_id == User.id).order_by(
+                candidates.c.rank).first()
     else:
-        return User.query.filter_by(username=name).first()
+        user = User.query.filter_by(username=name).first()
+
+    if cache is not None:
+        cache[('getuser', name)] = user
+    return user
+
+
+def getusers(names):
+    """
+    Batch version of :func:`getuser`. Returns a dictionary of {name: user} for
+    the names that match a user, using one query per kind of name (plus one
+    for email claims). Results are added to the request cache for getuser.
+    """
+    names = set(names)
+    usernames = [name for name in names if '@' not in name]
+    handles = [name[1:] for name in names if name.startswith('@')]
+    emails = [name for name in names if '@' in name and not name.startswith('@')]
+    found = {}
+    if usernames:
+        for user in User.query.filter(User._username.in_(usernames)):
+            found[user.username] = user
+    if handles:
+        for handle, user in db.session.query(UserExternalId.username, User).join(
+                User, User.id == UserExternalId.user_id).filter(
+                UserExternalId.service == 'twitter', UserExternalId.username.in_(handles)):
+            found['@' + handle] = user
+    if emails:
+        for email, user in db.session.query(UserEmail._email, User).join(
+                User, User.id == UserEmail.user_id).filter(UserEmail._email.in_(emails)):
+            found[email] = user
+        claims = [email for email in emails if email not in found]
+        if claims:
+            for email, user in db.session.query(UserEmailClaim._email, User).join(
+                    User, User.id == UserEmailClaim.user_id).filter(UserEmailClaim._email.in_(claims)):
+                found.setdefault(email, user)
+
+    cache = request_cache()
+    if cache is not None:
+        for name in names:
+            cache[('getuser', name)] = found.get(name)
+    return found
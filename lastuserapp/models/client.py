@@ -1,18 +1,24 @@
 # -*- coding: utf-8 -*-
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from lastuserapp.cache import bump_after_commit
 from lastuserapp.models import db, BaseMixin
-from lastuserapp.models.user import User, Organization, Team
-from lastuserapp.utils import newid, newsecret
+from lastuserapp.models.user import User, Organization, Team, team_membership
+from lastuserapp.utils import newid, newsecret, chunks
 
 
 class Client(db.Model, BaseMixin):
     """OAuth client applications"""
     __tablename__ = 'client'
     #: User who owns this client
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)
     user = db.relationship(User, primaryjoin=user_id == User.id,
         backref=db.backref('clients', cascade="all, delete-orphan"))
     #: Organization that owns this client. Only one of this or user must be set
-    org_id = db.Column(db.Integer, db.ForeignKey('organization.id'), nullable=True)
+    org_id = db.Column(db.Integer, db.ForeignKey('organization.id'), nullable=True, index=True)
     org = db.relationship(Organization, primaryjoin=org_id == Organization.id,
         backref=db.backref('clients', cascade="all, delete-orphan"))
     #: Human-readable title
@@ -43,6 +49,9 @@ class Client(db.Model, BaseMixin):
     #: as a trusted client to provide single sign-in across the services
     trusted = db.Column(db.Boolean, nullable=False, default=False)
 
+    # For listings ordered by title
+    __table_args__ = (db.Index('ix_client_title_id', 'title', 'id'), {})
+
     def secret_is(self, candidate):
         """
         Check if the provided client secret is valid.
@@ -62,7 +71,125 @@ class Client(db.Model, BaseMixin):
             raise AttributeError("This client has no owner")
 
     def owner_is(self, user):
-        return self.user == user or (self.org and self.org in user.organizations_owned())
+        if user is None:
+            return False
+        return self.user == user or (self.org_id is not None and self.org_id in user.organizations_owned_ids())
+
+    def permissions_for(self, user_ids):
+        """
+        Return the permissions assigned on this client to each of the given
+        users, directly or through their teams, as a dictionary of
+        {user_id: set of permission names}. Uses one query for direct
+        assignments and one for team assignments, regardless of the number of
+        users.
+        """
+        result = dict((user_id, set()) for user_id in user_ids)
+        if not result:
+            return result
+        direct = db.session.query(UserClientPermissions.user_id, UserClientPermission.name).join(
+            UserClientPermission, UserClientPermission.assignment_id == UserClientPermissions.id).filter(
+            UserClientPermission.client_id == self.id, UserClientPermissions.user_id.in_(result.keys()))
+        via_teams = db.session.query(team_membership.c.user_id, TeamClientPermission.name).join(
+            TeamClientPermissions, TeamClientPermissions.team_id == team_membership.c.team_id).join(
+            TeamClientPermission, TeamClientPermission.assignment_id == TeamClientPermissions.id).filter(
+            TeamClientPermission.client_id == self.id, team_membership.c.user_id.in_(result.keys()))
+        for query in (direct, via_teams):
+            for user_id, name in query:
+                result[user_id].add(name)
+        return result
+
+    def available_permissions(self):
+        """
+        Return the names of permissions that may be assigned on this client.
+        """
+        if self.user_id is not None:
+            owner = Permission.user_id == self.user_id
+        else:
+            owner = Permission.org_id == self.org_id
+        return set(name for (name,) in db.session.query(Permission.name).filter(
+            db.or_(Permission.allusers == True, owner)))
+
+    def apply_permissions(self, operations):
+        """
+        Apply a list of (subject_id, action, names) operations to the
+        permissions assigned on this client, where subject_id is a user id for
+        clients owned by a user and a team id for clients owned by an
+        organization, action is one of 'add', 'remove' or 'set', and names is
+        a set of permission names. Operations on the same subject are applied
+        in order.
+
+        Returns a list of (names, changed) tuples with the resulting
+        permissions after each operation. Changes are written with bulk
+        inserts and deletes, but are not committed. Unique constraints keep
+        concurrent calls for the same subjects from writing the same rows
+        twice; the one that loses raises IntegrityError, and applying the
+        operations again in a new transaction completes it.
+        """
+        if self.user_id is not None:
+            assignment, item, subject = UserClientPermissions, UserClientPermission, 'user_id'
+        else:
+            assignment, item, subject = TeamClientPermissions, TeamClientPermission, 'team_id'
+        subject_column = getattr(assignment, subject)
+        subject_ids = set(operation[0] for operation in operations)
+
+        # Load current assignments as {subject_id: {name: item id}}
+        assignments = {}
+        current = dict((subject_id, {}) for subject_id in subject_ids)
+        for chunk in chunks(subject_ids):
+            for subject_id, assignment_id, item_id, name in db.session.query(subject_column, assignment.id,
+                    item.id, item.name).outerjoin(item, item.assignment_id == assignment.id).filter(
+                    assignment.client_id == self.id, subject_column.in_(chunk)):
+                assignments[subject_id] = assignment_id
+                if name is not None:
+                    current[subject_id][name] = item_id
+
+        state = dict((subject_id, set(names)) for subject_id, names in current.items())
+        outcomes = []
+        for subject_id, action, names in operations:
+            before = state[subject_id]
+            if action == 'add':
+                after = before | names
+            elif action == 'remove':
+                after = before - names
+            elif action == 'set':
+                after = set(names)
+            else:
+                raise ValueError("Unknown action: %s" % action)
+            state[subject_id] = after
+            outcomes.append((after, after != before))
+
+        # Write the difference between the original and final states
+        created = [subject_id for subject_id in subject_ids if state[subject_id] and subject_id not in assignments]
+        if created:
+            db.session.execute(assignment.__table__.insert(),
+                [{subject: subject_id, 'client_id': self.id} for subject_id in created])
+            for chunk in chunks(created):
+                assignments.update(db.session.query(subject_column, assignment.id).filter(
+                    assignment.client_id == self.id, subject_column.in_(chunk)))
+        removed = [item_id for subject_id in subject_ids for name, item_id in current[subject_id].items()
+            if name not in state[subject_id]]
+        added = [{'assignment_id': assignments[subject_id], 'client_id': self.id, 'name': name}
+            for subject_id in subject_ids for name in state[subject_id].difference(current[subject_id])]
+        emptied = [assignments[subject_id] for subject_id in subject_ids
+            if not state[subject_id] and subject_id in assignments]
+        for chunk in chunks(removed):
+            db.session.execute(item.__table__.delete().where(item.__table__.c.id.in_(chunk)))
+        if added:
+            db.session.execute(item.__table__.insert(), added)
+        for chunk in chunks(emptied):
+            db.session.execute(assignment.__table__.delete().where(assignment.__table__.c.id.in_(chunk)))
+        if removed or added:
+            # Cached user information includes permissions
+            bump_after_commit(db.session(), 'client/%d' % self.id)
+        return outcomes
+
+
+@event.listens_for(Client, 'after_insert')
+@event.listens_for(Client, 'after_update')
+@event.listens_for(Client, 'after_delete')
+def _client_changed(mapper, connection, target):
+    # Cached client listings are out of date once this commits
+    bump_after_commit(object_session(target), 'clients')
 
 
 class UserFlashMessage(db.Model, BaseMixin):
@@ -70,7 +197,7 @@ class UserFlashMessage(db.Model, BaseMixin):
     Saved messages for a user, to be relayed to trusted clients.
     """
     __tablename__ = 'userflashmessage'
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     user = db.relationship(User, primaryjoin=user_id == User.id,
         backref=db.backref("flashmessages", cascade="delete, delete-orphan"))
     seq = db.Column(db.Integer, default=0, nullable=False)
@@ -87,7 +214,7 @@ class Resource(db.Model, BaseMixin):
     __tablename__ = 'resource'
     # Resource names are unique across client apps
     name = db.Column(db.Unicode(20), unique=True, nullable=False)
-    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False, index=True)
     client = db.relationship(Client, primaryjoin=client_id == Client.id,
         backref=db.backref('resources', cascade="all, delete-orphan"))
     title = db.Column(db.Unicode(250), nullable=False)
@@ -126,6 +253,9 @@ class AuthCode(db.Model, BaseMixin):
     redirect_uri = db.Column(db.Unicode(250), nullable=False)
     used = db.Column(db.Boolean, default=False, nullable=False)
 
+    # Codes are looked up with their client at /token
+    __table_args__ = (db.Index('ix_authcode_code_client_id', 'code', 'client_id'), {})
+
     @property
     def scope(self):
         return self._scope.split(u' ')
@@ -147,7 +277,7 @@ class AuthToken(db.Model, BaseMixin):
     __tablename__ = 'authtoken'
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # Null for client-only tokens
     user = db.relationship(User, primaryjoin=user_id == User.id)
-    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False, index=True)
     client = db.relationship(Client, primaryjoin=client_id == Client.id,
         backref=db.backref("authtokens", cascade="all, delete-orphan"))
     token = db.Column(db.String(22), default=newid, nullable=False, unique=True)
@@ -157,6 +287,8 @@ class AuthToken(db.Model, BaseMixin):
     _scope = db.Column('scope', db.Unicode(250), nullable=False)
     validity = db.Column(db.Integer, nullable=False, default=0)  # Validity period in seconds
     refresh_token = db.Column(db.String(22), nullable=True, unique=True)
+    #: When the token was last used (UTC), rounded down. Written by lastuserapp.tokenusage
+    last_used = db.Column(db.DateTime, default=datetime.utcnow, nullable=True, index=True)
 
     # Only one authtoken per user and client. Add to scope as needed
     __table_args__ = (db.UniqueConstraint("user_id", "client_id"), {})
@@ -168,6 +300,28 @@ class AuthToken(db.Model, BaseMixin):
             self.refresh_token = newid()
         self.secret = newsecret()
 
+    @classmethod
+    def revoke(cls, client=None, user=None):
+        """
+        Revoke all tokens issued to a client, all tokens issued for a user, or
+        a user's tokens on one client, along with their unused auth codes.
+        Each is a single DELETE statement. Returns the number of tokens
+        revoked. Changes are not committed. Call
+        :func:`lastuserapp.notifications.notify_revoked` first to tell
+        resource provider apps.
+        """
+        if client is None and user is None:
+            raise ValueError("A client or user is required")
+        count = 0
+        for table in (AuthCode.__table__, cls.__table__):
+            clauses = []
+            if client is not None:
+                clauses.append(table.c.client_id == client.id)
+            if user is not None:
+                clauses.append(table.c.user_id == user.id)
+            count = db.session.execute(table.delete().where(db.and_(*clauses))).rowcount
+        return count
+
     def refresh(self):
         """
         Create a new token while retaining the refresh token.
@@ -227,7 +381,9 @@ class Permission(db.Model, BaseMixin):
     allusers = db.Column(db.Boolean, default=False, nullable=False)
 
     def owner_is(self, user):
-        return self.user == user or (self.org and self.org in user.organizations_owned())
+        if user is None:
+            return False
+        return self.user == user or (self.org_id is not None and self.org_id in user.organizations_owned_ids())
 
     def owner_name(self):
         if self.user:
@@ -247,8 +403,6 @@ class UserClientPermissions(db.Model, BaseMixin):
     client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
     client = db.relationship(Client, primaryjoin=client_id == Client.id,
         backref=db.backref('permissions_users', cascade="all, delete-orphan"))
-    # The permissions as a string of tokens
-    permissions = db.Column(db.Unicode(250), default=u'', nullable=False)
 
     # Only one assignment per user and client
     # TODO: Also define context for permission:
@@ -258,6 +412,23 @@ class UserClientPermissions(db.Model, BaseMixin):
     # such as permission:context/subpath.
     __table_args__ = (db.UniqueConstraint("user_id", "client_id"), {})
 
+    @property
+    def permissions(self):
+        """
+        Names of the permissions in this assignment, sorted.
+        """
+        return sorted(item.name for item in self.items)
+
+    @permissions.setter
+    def permissions(self, value):
+        value = set(value)
+        for item in list(self.items):
+            if item.name not in value:
+                self.items.remove(item)
+        existing = set(item.name for item in self.items)
+        for name in sorted(value - existing):
+            self.items.append(UserClientPermission(name=name, client=self.client))
+
     @property
     def pickername(self):
         return self.user.pickername
@@ -278,8 +449,6 @@ class TeamClientPermissions(db.Model, BaseMixin):
     client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
     client = db.relationship(Client, primaryjoin=client_id == Client.id,
         backref=db.backref('permissions_teams', cascade="all, delete-orphan"))
-    # The permissions as a string of tokens
-    permissions = db.Column(db.Unicode(250), default=u'', nullable=False)
 
     # Only one assignment per team and client
     # TODO: Also define context for permission:
@@ -289,6 +458,23 @@ class TeamClientPermissions(db.Model, BaseMixin):
     # such as permission:context/subpath.
     __table_args__ = (db.UniqueConstraint("team_id", "client_id"), {})
 
+    @property
+    def permissions(self):
+        """
+        Names of the permissions in this assignment, sorted.
+        """
+        return sorted(item.name for item in self.items)
+
+    @permissions.setter
+    def permissions(self, value):
+        value = set(value)
+        for item in list(self.items):
+            if item.name not in value:
+                self.items.remove(item)
+        existing = set(item.name for item in self.items)
+        for name in sorted(value - existing):
+            self.items.append(TeamClientPermission(name=name, client=self.client))
+
     @property
     def pickername(self):
         return self.team.pickername
@@ -298,6 +484,46 @@ class TeamClientPermissions(db.Model, BaseMixin):
         return self.team.userid
 
 
+class UserClientPermission(db.Model, BaseMixin):
+    """
+    A single permission within a :class:`UserClientPermissions` assignment.
+    The client is repeated here so that the holders of a permission can be
+    found from the index on (client_id, name, assignment_id) alone.
+    """
+    __tablename__ = 'userclientpermission'
+    #: Assignment this permission is part of
+    assignment_id = db.Column(db.Integer, db.ForeignKey('userclientpermissions.id'), nullable=False)
+    assignment = db.relationship(UserClientPermissions, primaryjoin=assignment_id == UserClientPermissions.id,
+        backref=db.backref('items', cascade='all, delete-orphan'))
+    #: Client app the permission is assigned on
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
+    client = db.relationship(Client, primaryjoin=client_id == Client.id)
+    #: Permission name
+    name = db.Column(db.Unicode(80), nullable=False)
+
+    __table_args__ = (db.UniqueConstraint('assignment_id', 'name'),
+        db.Index('ix_userclientpermission_client_name', 'client_id', 'name', 'assignment_id'), {})
+
+
+class TeamClientPermission(db.Model, BaseMixin):
+    """
+    A single permission within a :class:`TeamClientPermissions` assignment.
+    """
+    __tablename__ = 'teamclientpermission'
+    #: Assignment this permission is part of
+    assignment_id = db.Column(db.Integer, db.ForeignKey('teamclientpermissions.id'), nullable=False)
+    assignment = db.relationship(TeamClientPermissions, primaryjoin=assignment_id == TeamClientPermissions.id,
+        backref=db.backref('items', cascade='all, delete-orphan'))
+    #: Client app the permission is assigned on
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
+    client = db.relationship(Client, primaryjoin=client_id == Client.id)
+    #: Permission name
+    name = db.Column(db.Unicode(80), nullable=False)
+
+    __table_args__ = (db.UniqueConstraint('assignment_id', 'name'),
+        db.Index('ix_teamclientpermission_client_name', 'client_id', 'name', 'assignment_id'), {})
+
+
 class NoticeType(db.Model, BaseMixin):
     __tablename__ = 'noticetype'
     #: User who created this notice type
@@ -315,4 +541,5 @@ class NoticeType(db.Model, BaseMixin):
 
 
 __all__ = ['Client', 'UserFlashMessage', 'Resource', 'ResourceAction', 'AuthCode', 'AuthToken',
-    'Permission', 'UserClientPermissions', 'TeamClientPermissions', 'NoticeType']
+    'Permission', 'UserClientPermissions', 'TeamClientPermissions', 'UserClientPermission',
+    'TeamClientPermission', 'NoticeType']
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+from lastuserapp.models import db, BaseMixin
+from lastuserapp.models.user import User
+
+__all__ = ['DeletionJob', 'DELETION_STATUS']
+
+
+class DELETION_STATUS:
+    QUEUED = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+
+
+class DeletionJob(db.Model, BaseMixin):
+    """
+    A queued deletion of a user, organization, team or client app along with
+    everything that belongs to it. Jobs are carried out in batches by the
+    deletion worker. See :mod:`lastuserapp.deletion`.
+    """
+    __tablename__ = 'deletionjob'
+    #: User who asked for the deletion
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    user = db.relationship(User, primaryjoin=user_id == User.id)
+    #: Table of the row being deleted
+    kind = db.Column(db.String(30), nullable=False)
+    #: Id of the row being deleted
+    ref_id = db.Column(db.Integer, nullable=False)
+    #: Human-readable description of what is being deleted
+    title = db.Column(db.Unicode(250), nullable=False)
+    #: One of the DELETION_STATUS values
+    status = db.Column(db.Integer, default=DELETION_STATUS.QUEUED, nullable=False)
+    #: Number of rows deleted so far
+    deleted = db.Column(db.Integer, default=0, nullable=False)
+    #: Error message, if the job failed
+    error = db.Column(db.UnicodeText, nullable=True)
+
+    @property
+    def finished(self):
+        return self.status in (DELETION_STATUS.DONE, DELETION_STATUS.FAILED)
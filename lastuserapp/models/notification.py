@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+
+from lastuserapp.models import db, BaseMixin
+from lastuserapp.models.client import Client
+
+__all__ = ['Notification', 'NOTIFICATION_STATUS']
+
+
+class NOTIFICATION_STATUS:
+    PENDING = 0
+    DEAD = 1
+
+
+class Notification(db.Model, BaseMixin):
+    """
+    A notice waiting to be posted to a client app's notification URI. Notices
+    are delivered by the notification dispatcher and removed once delivered.
+    See :mod:`lastuserapp.notifications`.
+    """
+    __tablename__ = 'notification'
+    #: Client app the notice is for
+    client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
+    client = db.relationship(Client, primaryjoin=client_id == Client.id)
+    #: Type of notice, such as 'token'
+    type = db.Column(db.String(30), nullable=False)
+    #: Contents of the notice, as JSON
+    payload = db.Column(db.UnicodeText, nullable=False)
+    #: One of the NOTIFICATION_STATUS values
+    status = db.Column(db.Integer, default=NOTIFICATION_STATUS.PENDING, nullable=False)
+    #: Number of failed delivery attempts
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    #: Time after which the next attempt may be made, in UTC
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    #: Error from the last failed attempt
+    error = db.Column(db.UnicodeText, nullable=True)
+
+    # The dispatcher looks for pending notices that are due
+    __table_args__ = (db.Index('ix_notification_status_next_attempt_at', 'status', 'next_attempt_at'),
+        db.Index('ix_notification_client_id', 'client_id'), {})
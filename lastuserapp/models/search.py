@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+"""
+Search index over users and organizations.
+
+Each user and organization has a :class:`SearchDocument` holding its
+searchable text (name and username for users; title and name for
+organizations). Email addresses are not indexed, since matching parts of
+them would let anyone discover addresses; the search view looks up whole
+addresses instead. Documents are kept in sync by mapper events when users
+and organizations are written through the ORM. Code that writes these
+tables directly must call :func:`index_users` or :func:`index_orgs`.
+
+On SQLite, documents are indexed in an FTS5 table and ranked with bm25. On
+PostgreSQL, they are indexed with a pg_trgm GIN index and ranked by
+similarity. Other databases fall back to unindexed LIKE matches.
+"""
+
+from sqlalchemy import event, DDL
+from sqlalchemy.orm.attributes import get_history
+
+from lastuserapp.models import db, BaseMixin
+from lastuserapp.models.user import User, Organization
+from lastuserapp.utils import escape_like
+
+__all__ = ['SearchDocument']
+
+
+class SearchDocument(db.Model, BaseMixin):
+    __tablename__ = 'searchdocument'
+    #: Type of document: 'user' or 'org'
+    kind = db.Column(db.String(4), nullable=False)
+    #: Id of the user or organization
+    ref_id = db.Column(db.Integer, nullable=False)
+    #: Searchable text
+    body = db.Column(db.UnicodeText, default=u'', nullable=False)
+
+    __table_args__ = (db.UniqueConstraint('kind', 'ref_id'), {})
+
+
+# --- Index DDL ---------------------------------------------------------------
+
+for statement in [
+        # External content FTS5 table, kept in sync with searchdocument by triggers
+        "CREATE VIRTUAL TABLE searchdocument_fts USING fts5(body, content='searchdocument', "
+            "content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        "CREATE TRIGGER searchdocument_ai AFTER INSERT ON searchdocument BEGIN "
+            "INSERT INTO searchdocument_fts(rowid, body) VALUES (new.id, new.body); END",
+        "CREATE TRIGGER searchdocument_ad AFTER DELETE ON searchdocument BEGIN "
+            "INSERT INTO searchdocument_fts(searchdocument_fts, rowid, body) VALUES ('delete', old.id, old.body); END",
+        "CREATE TRIGGER searchdocument_au AFTER UPDATE ON searchdocument BEGIN "
+            "INSERT INTO searchdocument_fts(searchdocument_fts, rowid, body) VALUES ('delete', old.id, old.body); "
+            "INSERT INTO searchdocument_fts(rowid, body) VALUES (new.id, new.body); END",
+        ]:
+    event.listen(SearchDocument.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+event.listen(SearchDocument.__table__, 'before_drop',
+    DDL("DROP TABLE IF EXISTS searchdocument_fts").execute_if(dialect='sqlite'))
+
+for statement in [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        "CREATE INDEX ix_searchdocument_body_trgm ON searchdocument USING gin (body gin_trgm_ops)",
+        ]:
+    event.listen(SearchDocument.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+
+
+# --- Indexing ----------------------------------------------------------------
+
+def store_documents(connection, kind, bodies):
+    """
+    Insert or update documents, given a dictionary of {ref_id: body}.
+    """
+    if not bodies:
+        return
+    table = SearchDocument.__table__
+    existing = set(row[0] for row in connection.execute(db.select([table.c.ref_id],
+        db.and_(table.c.kind == kind, table.c.ref_id.in_(bodies.keys())))))
+    updates = [{'b_ref_id': ref_id, 'b_body': body} for ref_id, body in bodies.items() if ref_id in existing]
+    inserts = [{'kind': kind, 'ref_id': ref_id, 'body': body} for ref_id, body in bodies.items()
+        if ref_id not in existing]
+    if updates:
+        connection.execute(table.update().where(db.and_(table.c.kind == kind,
+            table.c.ref_id == db.bindparam('b_ref_id'))).values(body=db.bindparam('b_body')), updates)
+    if inserts:
+        connection.execute(table.insert(), inserts)
+
+
+def delete_documents(connection, kind, ids):
+    table = SearchDocument.__table__
+    connection.execute(table.delete().where(db.and_(table.c.kind == kind, table.c.ref_id.in_(ids))))
+
+
+def index_users(connection, ids):
+    """
+    Rebuild the search documents for the given user ids.
+    """
+    if not ids:
+        return
+    usertable = User.__table__
+    store_documents(connection, 'user', dict((row.id, u' '.join([row.fullname, row.username or u'']).strip())
+        for row in connection.execute(db.select([usertable.c.id, usertable.c.fullname, usertable.c.username],
+            usertable.c.id.in_(ids)))))
+
+
+def index_orgs(connection, ids):
+    """
+    Rebuild the search documents for the given organization ids.
+    """
+    if not ids:
+        return
+    orgtable = Organization.__table__
+    store_documents(connection, 'org', dict((row.id, u' '.join([row.title, row.name or u'']).strip())
+        for row in connection.execute(db.select([orgtable.c.id, orgtable.c.title, orgtable.c.name],
+            orgtable.c.id.in_(ids)))))
+
+
+def rebuild_index(batch_size=1000):
+    """
+    Rebuild the search documents for all users and organizations.
+    """
+    connection = db.session.connection()
+    for model, indexer in [(User, index_users), (Organization, index_orgs)]:
+        last_id = 0
+        while True:
+            ids = [row[0] for row in db.session.query(model.id).filter(model.id > last_id).order_by(
+                model.id).limit(batch_size)]
+            if not ids:
+                break
+            indexer(connection, ids)
+            db.session.commit()
+            connection = db.session.connection()
+            last_id = ids[-1]
+
+
+def _changed(target, *attrs):
+    return any(get_history(target, attr).has_changes() for attr in attrs)
+
+
+@event.listens_for(User, 'after_insert')
+def _user_inserted(mapper, connection, target):
+    index_users(connection, [target.id])
+
+
+@event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, target):
+    if _changed(target, 'fullname', '_username'):
+        index_users(connection, [target.id])
+
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, target):
+    delete_documents(connection, 'user', [target.id])
+
+
+@event.listens_for(Organization, 'after_insert')
+def _org_inserted(mapper, connection, target):
+    index_orgs(connection, [target.id])
+
+
+@event.listens_for(Organization, 'after_update')
+def _org_updated(mapper, connection, target):
+    if _changed(target, 'title', '_name'):
+        index_orgs(connection, [target.id])
+
+
+@event.listens_for(Organization, 'after_delete')
+def _org_deleted(mapper, connection, target):
+    delete_documents(connection, 'org', [target.id])
+
+
+# --- Searching ---------------------------------------------------------------
+
+def fts_query(terms):
+    """
+    Make an FTS5 query matching documents that have words starting with each term.
+    """
+    return u' '.join(u'"%s"*' % term.replace(u'"', u'""') for term in terms)
+
+
+def search(query, kind=None, limit=20, after=None):
+    """
+    Search users and organizations. Returns a list of (kind, ref_id, rank, id)
+    rows, best match first. Pass the last row's (rank, id) as after to get the
+    next page.
+    """
+    terms = query.split()
+    if not terms:
+        return []
+    dialect = db.engine.dialect.name
+    params = {'limit': limit}
+    if dialect == 'sqlite':
+        clauses = ["searchdocument_fts MATCH :match"]
+        params['match'] = fts_query(terms)
+        rank = "searchdocument_fts.rank"
+        source = "searchdocument_fts JOIN searchdocument ON searchdocument.id = searchdocument_fts.rowid"
+    else:
+        clauses = []
+        for index, term in enumerate(terms):
+            clauses.append("searchdocument.body %s :term%d" % ('ILIKE' if dialect == 'postgresql' else 'LIKE', index))
+            params['term%d' % index] = u'%' + escape_like(term) + u'%'
+        if dialect == 'postgresql':
+            rank = "(1 - similarity(searchdocument.body, :query))"
+            params['query'] = query
+        else:
+            rank = "0"
+        source = "searchdocument"
+    if kind:
+        clauses.append("searchdocument.kind = :kind")
+        params['kind'] = kind
+    if after:
+        clauses.append("(%s > :after_rank OR (%s = :after_rank AND searchdocument.id > :after_id))" % (rank, rank))
+        params['after_rank'], params['after_id'] = after
+    statement = ("SELECT searchdocument.kind, searchdocument.ref_id, %s AS rank, searchdocument.id FROM %s "
+        "WHERE %s ORDER BY rank, searchdocument.id LIMIT :limit") % (rank, source, ' AND '.join(clauses))
+    return db.session.execute(db.text(statement), params).fetchall()
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
-from lastuserapp.models import db, BaseMixin
+from datetime import datetime
 
-__all__ = ['SMSMessage', 'SMS_STATUS']
+from lastuserapp.models import db, IdMixin, BaseMixin
+
+__all__ = ['SMSMessage', 'SMSReport', 'SMS_STATUS']
 
 
 class SMS_STATUS:
@@ -11,6 +13,7 @@ class SMS_STATUS:
     DELIVERED = 2
     FAILED = 3
     UNKNOWN = 4
+    SENDING = 5
 
 
 class SMSMessage(db.Model, BaseMixin):
@@ -24,3 +27,27 @@ class SMSMessage(db.Model, BaseMixin):
     status = db.Column(db.Integer, default=0, nullable=False)
     status_at = db.Column(db.DateTime, nullable=True)
     fail_reason = db.Column(db.Unicode(25), nullable=True)
+    # Sending, for queued messages. See lastuserapp.smsdispatch
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    # Compared with the worker's clock, so set in UTC from Python
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    # Worker sending the message, while its status is SENDING
+    claimed_by = db.Column(db.String(22), nullable=True, index=True)
+
+    # The SMS worker looks for queued messages that are due
+    __table_args__ = (db.Index('ix_smsmessage_status_next_attempt_at', 'status', 'next_attempt_at'), {})
+
+
+class SMSReport(db.Model, IdMixin):
+    """
+    A delivery report received from a gateway, waiting to be applied to its
+    message by the SMS worker. See lastuserapp.smsdispatch
+    """
+    __tablename__ = 'smsreport'
+    transaction_id = db.Column(db.Unicode(40), nullable=False)
+    phone_number = db.Column(db.String(15), nullable=False)
+    status = db.Column(db.Integer, nullable=False)
+    status_at = db.Column(db.DateTime, nullable=False)
+    fail_reason = db.Column(db.Unicode(25), nullable=True)
+    # Reports for messages not known yet are dropped after a while
+    received_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
@@ -2,22 +2,42 @@
 
 from hashlib import md5
 from werkzeug import generate_password_hash, check_password_hash
+from sqlalchemy import event, DDL
 from sqlalchemy.ext.hybrid import hybrid_property
 
-from lastuserapp.models import db, BaseMixin
-from lastuserapp.utils import newid, newsecret, newpin
+from lastuserapp.cache import bump_after_commit
+from lastuserapp.models import db, BaseMixin, cached_per_request
+from lastuserapp.utils import newid, newsecret, newpin, escape_like, chunks
 
 __all__ = ['User', 'UserEmail', 'UserEmailClaim', 'PasswordResetRequest', 'UserExternalId',
-           'UserPhone', 'UserPhoneClaim', 'Team', 'Organization']
+           'UserPhone', 'UserPhoneClaim', 'Team', 'Organization', 'Name', 'Tombstone']
+
+
+def starts_with(column, prefix):
+    """
+    Return a condition for values of column that start with prefix. The range
+    comparison lets an index on the column (or expression) narrow the rows
+    down; LIKE, whose prefix matches most databases can't serve from an
+    index on an expression, only confirms the match.
+    """
+    clauses = [column >= prefix, column.like(escape_like(prefix) + u'%', escape=u'\\')]
+    if ord(prefix[-1]) < 0xffff:
+        clauses.append(column < prefix[:-1] + unichr(ord(prefix[-1]) + 1))
+    return db.and_(*clauses)
 
 
 class User(db.Model, BaseMixin):
     __tablename__ = 'user'
     userid = db.Column(db.String(22), unique=True, nullable=False, default=newid)
-    fullname = db.Column(db.Unicode(80), default=u'', nullable=False)
+    fullname = db.Column(db.Unicode(80), default=u'', nullable=False, index=True)
     _username = db.Column('username', db.Unicode(80), unique=True, nullable=True)
     pw_hash = db.Column(db.String(80), nullable=True)
     description = db.Column(db.UnicodeText, default=u'', nullable=False)
+    #: Inactive users are queued for deletion and cannot log in or use tokens
+    active = db.Column(db.Boolean, nullable=False, default=True)
+
+    # For the change feed
+    __table_args__ = (db.Index('ix_user_updated_at_id', 'updated_at', 'id'), {})
 
     def __init__(self, password=None, **kwargs):
         self.password = password
@@ -39,15 +59,10 @@ class User(db.Model, BaseMixin):
     def username(self, value):
         if self.valid_username(value):
             self._username = value
+            Name.assign(self, value)
 
     def valid_username(self, value):
-        existing = User.query.filter_by(username=value).first()
-        if existing and existing.id != self.id:
-            return False
-        existing = Organization.query.filter_by(name=value).first()
-        if existing:
-            return False
-        return True
+        return Name.is_available(value, self)
 
     def password_is(self, password):
         if self.pw_hash is None:
@@ -116,29 +131,82 @@ class User(db.Model, BaseMixin):
         # to get the email address as a string.
         return u''
 
+    @classmethod
+    def autocomplete(cls, prefix):
+        """
+        Return a query for active users whose name or username starts with the
+        given prefix, or with the prefix as their verified email address,
+        ordered by name. Each is looked up through its own index and the
+        results combined with UNION. Email addresses must match in full, so
+        that addresses can't be discovered a letter at a time.
+        """
+        lower = prefix.lower()
+        ids = db.union(
+            db.select([cls.id], starts_with(db.func.lower(cls.fullname), lower)),
+            db.select([cls.id], starts_with(cls._username, lower)),
+            db.select([UserEmail.user_id], UserEmail._email.in_(set([prefix, lower]))))
+        return cls.query.filter(cls.id.in_(ids), cls.active == True).order_by(cls.fullname, cls.id)
+
+    @classmethod
+    def ids_for(cls, userids):
+        """
+        Return a dictionary of {userid: id} for the given userids. Unknown
+        userids are left out.
+        """
+        result = {}
+        for chunk in chunks(set(userids)):
+            result.update((userid, id) for id, userid in
+                db.session.query(cls.id, cls.userid).filter(cls.userid.in_(chunk)))
+        return result
+
+    @classmethod
+    def userids_for(cls, ids):
+        """
+        Return the userids of the users with the given ids.
+        """
+        result = []
+        for chunk in chunks(set(ids)):
+            result.extend(userid for (userid,) in db.session.query(cls.userid).filter(cls.id.in_(chunk)))
+        return result
+
+    @cached_per_request
     def organizations(self):
         """
         Return the organizations this user is a member of.
         """
-        return list(set([team.org for team in self.teams]))
+        return Organization.query.join(Team, Team.org_id == Organization.id).join(
+            team_membership, team_membership.c.team_id == Team.id).filter(
+            team_membership.c.user_id == self.id).distinct().all()
 
+    @cached_per_request
     def organizations_owned(self):
         """
         Return the organizations this user is an owner of.
         """
-        return list(set([team.org for team in self.teams if team.org.owners == team]))
+        return Organization.query.join(
+            team_membership, team_membership.c.team_id == Organization.owners_id).filter(
+            team_membership.c.user_id == self.id).all()
 
+    @cached_per_request
     def organizations_owned_ids(self):
         """
         Return the database ids of the organizations this user is an owner of. This is used
         for database queries.
         """
-        return list(set([team.org.id for team in self.teams if team.org.owners == team]))
+        return [row[0] for row in db.session.query(Organization.id).join(
+            team_membership, team_membership.c.team_id == Organization.owners_id).filter(
+            team_membership.c.user_id == self.id).all()]
+
+
+#: Index for case-insensitive name lookups. SQLAlchemy can't declare indexes
+#: on expressions, so this one is created with DDL.
+fullname_lower_index = DDL('CREATE INDEX ix_user_fullname_lower ON %(table)s (lower(fullname))')
+event.listen(User.__table__, 'after_create', fullname_lower_index)
 
 
 class UserEmail(db.Model, BaseMixin):
     __tablename__ = 'useremail'
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     user = db.relationship(User, primaryjoin=user_id == User.id,
         backref=db.backref('emails', cascade="all, delete-orphan"))
     _email = db.Column('email', db.Unicode(80), unique=True, nullable=False)
@@ -172,9 +240,9 @@ class UserEmailClaim(db.Model, BaseMixin):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     user = db.relationship(User, primaryjoin=user_id == User.id,
         backref=db.backref('emailclaims', cascade="all, delete-orphan"))
-    _email = db.Column('email', db.Unicode(80), nullable=True)
+    _email = db.Column('email', db.Unicode(80), nullable=True, index=True)
     verification_code = db.Column(db.String(44), nullable=False, default=newsecret)
-    md5sum = db.Column(db.String(32), nullable=False)
+    md5sum = db.Column(db.String(32), nullable=False, index=True)
 
     def __init__(self, email, **kwargs):
         super(UserEmailClaim, self).__init__(**kwargs)
@@ -264,6 +332,8 @@ class PasswordResetRequest(db.Model, BaseMixin):
     user = db.relationship(User, primaryjoin=user_id == User.id)
     reset_code = db.Column(db.String(44), nullable=False, default=newsecret)
 
+    __table_args__ = (db.Index('ix_passwordresetrequest_user_id_reset_code', 'user_id', 'reset_code'), {})
+
     def __init__(self, **kwargs):
         super(PasswordResetRequest, self).__init__(**kwargs)
         self.reset_code = newsecret()
@@ -271,7 +341,7 @@ class PasswordResetRequest(db.Model, BaseMixin):
 
 class UserExternalId(db.Model, BaseMixin):
     __tablename__ = 'userexternalid'
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     user = db.relationship(User, primaryjoin=user_id == User.id,
         backref=db.backref('externalids', cascade="all, delete-orphan"))
     service = db.Column(db.String(20), nullable=False)
@@ -281,7 +351,9 @@ class UserExternalId(db.Model, BaseMixin):
     oauth_token_secret = db.Column(db.String(250), nullable=True)
     oauth_token_type = db.Column(db.String(250), nullable=True)
 
-    __table_args__ = (db.UniqueConstraint("service", "userid"), {})
+    # Twitter handles are looked up by username
+    __table_args__ = (db.UniqueConstraint("service", "userid"),
+        db.Index('ix_userexternalid_service_username', 'service', 'username'), {})
 
 
 # --- Organizations and teams -------------------------------------------------
@@ -289,8 +361,13 @@ class UserExternalId(db.Model, BaseMixin):
 
 team_membership = db.Table(
     'team_membership', db.Model.metadata,
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), nullable=False),
-    db.Column('team_id', db.Integer, db.ForeignKey('team.id'), nullable=False)
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), nullable=False, index=True),
+    db.Column('team_id', db.Integer, db.ForeignKey('team.id'), nullable=False),
+    #: When the membership was created, for the change feed
+    db.Column('updated_at', db.DateTime, default=db.func.now(), nullable=True),
+    # Membership checks and member lists look up by team first
+    db.PrimaryKeyConstraint('team_id', 'user_id'),
+    db.Index('ix_team_membership_updated_at', 'updated_at', 'team_id', 'user_id'),
     )
 
 
@@ -307,6 +384,11 @@ class Organization(db.Model, BaseMixin):
     _name = db.Column('name', db.Unicode(80), unique=True, nullable=True)
     title = db.Column(db.Unicode(80), default=u'', nullable=False)
     description = db.Column(db.UnicodeText, default=u'', nullable=False)
+    #: Inactive organizations are queued for deletion, along with their client apps
+    active = db.Column(db.Boolean, nullable=False, default=True)
+
+    # For the change feed
+    __table_args__ = (db.Index('ix_organization_updated_at_id', 'updated_at', 'id'), {})
 
     def __init__(self, *args, **kwargs):
         super(Organization, self).__init__(*args, **kwargs)
@@ -321,15 +403,10 @@ class Organization(db.Model, BaseMixin):
     def name(self, value):
         if self.valid_name(value):
             self._name = value
+            Name.assign(self, value)
 
     def valid_name(self, value):
-        existing = Organization.query.filter_by(name=value).first()
-        if existing and existing.id != self.id:
-            return False
-        existing = User.query.filter_by(username=value).first()
-        if existing:
-            return False
-        return True
+        return Name.is_available(value, self)
 
     def __repr__(self):
         return '<Organization %s "%s">' % (self.name or self.userid, self.title)
@@ -341,6 +418,24 @@ class Organization(db.Model, BaseMixin):
         else:
             return self.title
 
+    def owner_is(self, user):
+        """
+        Check if the user is an owner of this organization.
+        """
+        if user is None or self.owners_id is None:
+            return False
+        return db.session.execute(db.select([db.exists().where(db.and_(
+            team_membership.c.team_id == self.owners_id, team_membership.c.user_id == user.id))])).scalar()
+
+    def team_member_counts(self):
+        """
+        Return a dictionary of {team id: number of members} for this
+        organization's teams.
+        """
+        return dict(db.session.query(team_membership.c.team_id, db.func.count(team_membership.c.user_id)).join(
+            Team, Team.id == team_membership.c.team_id).filter(Team.org_id == self.id).group_by(
+            team_membership.c.team_id))
+
 
 class Team(db.Model, BaseMixin):
     __tablename__ = 'team'
@@ -349,15 +444,167 @@ class Team(db.Model, BaseMixin):
     #: Displayed name
     title = db.Column(db.Unicode(250), nullable=False)
     #: Organization
-    org_id = db.Column(db.Integer, db.ForeignKey('organization.id'), nullable=False)
+    org_id = db.Column(db.Integer, db.ForeignKey('organization.id'), nullable=False, index=True)
     org = db.relationship(Organization, primaryjoin=org_id == Organization.id,
         backref=db.backref('teams', order_by=title, cascade='all, delete-orphan'))
     users = db.relationship(User, secondary='team_membership',
         backref='teams')  # No cascades here! Cascades will delete users
 
+    # For the change feed
+    __table_args__ = (db.Index('ix_team_updated_at_id', 'updated_at', 'id'), {})
+
     def __repr__(self):
         return '<Team %s of %s>' % (self.title, self.org.title)
 
+    def members(self):
+        """
+        Return a query for the team's members, ordered by name.
+        """
+        return User.query.join(team_membership, team_membership.c.user_id == User.id).filter(
+            team_membership.c.team_id == self.id).order_by(User.fullname, User.id)
+
+    def sync_members(self, user_ids):
+        """
+        Make the given user ids the team's members. Only the ids of current
+        members are read, through the primary key, and only additions and
+        removals are written: one executemany INSERT and a DELETE per chunk
+        of removed ids. Returns the sets of (added, removed) user ids. Changes
+        are not committed.
+        """
+        connection = db.session.connection()
+        user_ids = set(user_ids)
+        current = set(row[0] for row in connection.execute(db.select([team_membership.c.user_id],
+            team_membership.c.team_id == self.id)))
+        added, removed = user_ids - current, current - user_ids
+        if added:
+            connection.execute(team_membership.insert().values(team_id=self.id, updated_at=db.func.now()),
+                [{'user_id': user_id} for user_id in added])
+            Tombstone.restore_members(self, User.userids_for(added))
+        if removed:
+            for chunk in chunks(removed):
+                connection.execute(team_membership.delete().where(db.and_(
+                    team_membership.c.team_id == self.id, team_membership.c.user_id.in_(chunk))))
+            Tombstone.record('membership', User.userids_for(removed), team=self)
+        if added or removed:
+            self.updated_at = db.func.now()
+            bump_after_commit(db.session(), *['user/%d' % user_id for user_id in added | removed])
+        db.session.expire(self, ['users'])
+        return added, removed
+
     @property
     def pickername(self):
         return self.title
+
+
+class Name(db.Model, BaseMixin):
+    """
+    Usernames and organization names share a single namespace. Every name in
+    use is recorded here, where a unique index guarantees that no two users or
+    organizations can hold the same name.
+    """
+    __tablename__ = 'name'
+    name = db.Column(db.Unicode(80), unique=True, nullable=False)
+    #: User who holds this name. Only one of this or org must be set
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), unique=True, nullable=True)
+    user = db.relationship(User, primaryjoin=user_id == User.id,
+        backref=db.backref('name_entry', uselist=False, cascade='all, delete-orphan'))
+    #: Organization that holds this name
+    org_id = db.Column(db.Integer, db.ForeignKey('organization.id'), unique=True, nullable=True)
+    org = db.relationship(Organization, primaryjoin=org_id == Organization.id,
+        backref=db.backref('name_entry', uselist=False, cascade='all, delete-orphan'))
+
+    def __repr__(self):
+        return '<Name %s>' % self.name
+
+    def is_owned_by(self, owner):
+        """
+        Check if this name belongs to the given user or organization.
+        """
+        if owner is None or owner.id is None:
+            return False
+        if isinstance(owner, User):
+            return self.user_id == owner.id
+        else:
+            return self.org_id == owner.id
+
+    @classmethod
+    def is_available(cls, value, owner=None):
+        """
+        Check if a name is free to be used by the given user or organization.
+        A name already held by the owner is considered available to them.
+        """
+        if not value:
+            return True
+        existing = cls.query.filter_by(name=value).first()
+        return existing is None or existing.is_owned_by(owner)
+
+    @staticmethod
+    def assign(owner, value):
+        """
+        Record the name held by a user or organization, replacing any previous
+        name. A blank value releases the name.
+        """
+        if not value:
+            owner.name_entry = None
+        elif owner.name_entry is None:
+            owner.name_entry = Name(name=value)
+        else:
+            owner.name_entry.name = value
+
+
+class Tombstone(db.Model, BaseMixin):
+    """
+    A record of a deleted user, organization or team, or of a user's removal
+    from a team, for the change feed. See :mod:`lastuserapp.changefeed`.
+    """
+    __tablename__ = 'tombstone'
+    #: One of 'user', 'organization', 'team' or 'membership'
+    kind = db.Column(db.String(20), nullable=False)
+    #: userid of what was deleted, or of the team for memberships
+    userid = db.Column(db.String(22), nullable=False)
+    #: userid of the user removed from the team, for memberships
+    member = db.Column(db.String(22), nullable=True)
+
+    # Tombstones of memberships are removed when the user is added back
+    __table_args__ = (db.Index('ix_tombstone_userid_member', 'userid', 'member'), {})
+
+    @classmethod
+    def record(cls, kind, userids, team=None, connection=None):
+        """
+        Record the deletion of the users, organizations or teams with the
+        given userids, or, with a team, the removal of those users from it.
+        """
+        if team is not None:
+            rows = [{'kind': kind, 'userid': team.userid, 'member': userid} for userid in userids]
+        else:
+            rows = [{'kind': kind, 'userid': userid, 'member': None} for userid in userids]
+        if rows:
+            (connection or db.session).execute(cls.__table__.insert(), rows)
+
+    @classmethod
+    def restore_members(cls, team, userids):
+        """
+        Forget earlier removals of these users from the team.
+        """
+        for chunk in chunks(userids):
+            db.session.execute(cls.__table__.delete().where(db.and_(cls.kind == 'membership',
+                cls.userid == team.userid, cls.member.in_(chunk))))
+
+
+@event.listens_for(Team.users, 'append')
+def _member_added(target, value, initiator):
+    if target.id is not None and value.id is not None:
+        Tombstone.restore_members(target, [value.userid])
+
+
+@event.listens_for(Team.users, 'remove')
+def _member_removed(target, value, initiator):
+    if target.id is not None and value.id is not None:
+        db.session.add(Tombstone(kind='membership', userid=target.userid, member=value.userid))
+
+
+@event.listens_for(User, 'after_delete')
+@event.listens_for(Organization, 'after_delete')
+@event.listens_for(Team, 'after_delete')
+def _deleted(mapper, connection, target):
+    Tombstone.record(target.__tablename__, [target.userid], connection=connection)
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+"""
+Notices posted to client apps at their notification URI.
+
+When a token is issued with access to resources provided by other client
+apps, each of those apps is sent a copy of the token, so that it can prepare
+for or cache the token before it is first presented. When tokens are revoked
+in bulk, the same apps are told which client and user the revoked tokens
+belonged to, so that they can drop their copies. Notices are written to
+an outbox table in the same transaction as the change they describe, and
+posted later by the dispatcher (``manage.py notification-dispatcher``), so
+that requests never wait on other servers.
+
+The dispatcher posts all due notices for an app in one request, with a JSON
+body of the form ``{"notices": [{"type": "token", ...}, ...]}``. The body is
+signed with the app's client secret using HMAC-SHA256, and the signature is
+sent in the X-Lastuser-Signature header as ``sha256=<hex digest>``.
+Connections are kept open between requests to the same host. Notices carry
+live access tokens, so they are only posted to https URIs.
+
+A failed delivery is retried after NOTIFICATION_RETRY_DELAY seconds, doubling
+each time up to NOTIFICATION_RETRY_MAX_DELAY. After NOTIFICATION_MAX_ATTEMPTS
+failures the notices are marked dead and left in the table for inspection,
+with their access tokens removed. Dead notices are deleted with
+``manage.py notification-dispatcher --purge-dead``.
+"""
+
+import hmac
+import json
+import random
+import socket
+import sys
+import time
+import urlparse
+from datetime import datetime, timedelta
+from hashlib import sha256
+from httplib import HTTPSConnection, HTTPException
+
+from lastuserapp import app, __version__
+from lastuserapp.models import db, AuthToken, Client, Resource, Notification, NOTIFICATION_STATUS
+
+
+def providers(scope, exclude=None):
+    """
+    Return the client apps with an https notification URI that provide
+    resources in a scope, other than exclude, as {client: [resource name]}.
+    """
+    names = set(item.split('/')[0] for item in scope)
+    if not names:
+        return {}
+    result = {}
+    query = db.session.query(Resource.name, Client).join(Client, Resource.client_id == Client.id).filter(
+        Resource.name.in_(names), Client.notification_uri.like(u'https://%'))
+    if exclude is not None:
+        query = query.filter(Client.id != exclude.id)
+    for name, client in query:
+        result.setdefault(client, []).append(name)
+    return result
+
+
+def notify_token(token):
+    """
+    Queue notices of a token to the client apps that provide resources in its
+    scope. Changes are not committed.
+    """
+    for client, resources in providers(token.scope, exclude=token.client).items():
+        db.session.add(Notification(client=client, type='token', payload=json.dumps({
+            'type': 'token',
+            'access_token': token.token,
+            'token_type': token.token_type,
+            'scope': token.scope,
+            'resources': sorted(resources),
+            'client': token.client.key,
+            'userid': token.user.userid if token.user else None,
+            })))
+
+
+def notify_revoked(client=None, user=None):
+    """
+    Queue notices of the revocation of all tokens issued to a client, for a
+    user, or both, to the client apps that provide resources in their
+    scopes. Call before revoking the tokens. Changes are not committed.
+    """
+    table = AuthToken.__table__
+    clauses = []
+    if client is not None:
+        clauses.append(table.c.client_id == client.id)
+    if user is not None:
+        clauses.append(table.c.user_id == user.id)
+    scope = set()
+    for (value,) in db.session.execute(db.select([table.c.scope], db.and_(*clauses)).distinct()):
+        scope.update(value.split(u' '))
+    for provider, resources in providers(scope, exclude=client).items():
+        db.session.add(Notification(client=provider, type='revoked', payload=json.dumps({
+            'type': 'revoked',
+            'resources': sorted(resources),
+            'client': client.key if client else None,
+            'userid': user.userid if user else None,
+            })))
+
+
+def sign(secret, body):
+    """
+    Return the signature for a notification body.
+    """
+    return 'sha256=' + hmac.new(secret.encode('utf-8'), body, sha256).hexdigest()
+
+
+class Dispatcher(object):
+    """
+    Posts queued notices, keeping one open connection per host.
+    """
+    def __init__(self, batch_size=500, log=sys.stderr):
+        self.batch_size = batch_size
+        self.log = log
+        self.timeout = app.config.get('NOTIFICATION_TIMEOUT', 10)
+        self.retry_delay = app.config.get('NOTIFICATION_RETRY_DELAY', 30)
+        self.retry_max_delay = app.config.get('NOTIFICATION_RETRY_MAX_DELAY', 21600)
+        self.max_attempts = app.config.get('NOTIFICATION_MAX_ATTEMPTS', 12)
+        self.connections = {}
+
+    def connection(self, scheme, netloc):
+        key = (scheme, netloc)
+        if key not in self.connections:
+            self.connections[key] = HTTPSConnection(netloc, timeout=self.timeout)
+        return self.connections[key]
+
+    def post(self, uri, secret, body):
+        """
+        Post a body to a URI. Raises an exception if the app did not accept it.
+        """
+        parts = urlparse.urlsplit(uri)
+        if parts.scheme != 'https':
+            raise ValueError("Unsupported notification URI: %s" % uri)
+        path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        connection = self.connection(parts.scheme, parts.netloc)
+        try:
+            connection.request('POST', path, body, {
+                'Content-Type': 'application/json',
+                'User-Agent': 'LastUser/%s' % __version__,
+                'X-Lastuser-Signature': sign(secret, body),
+                })
+            response = connection.getresponse()
+            response.read()
+        except (HTTPException, socket.error):
+            # Start afresh with this host next time
+            connection.close()
+            del self.connections[(parts.scheme, parts.netloc)]
+            raise
+        if response.getheader('connection', '').lower() == 'close':
+            connection.close()
+            del self.connections[(parts.scheme, parts.netloc)]
+        if not 200 <= response.status < 300:
+            raise ValueError("HTTP status %d" % response.status)
+
+    def dead(self, notice):
+        """
+        Give up on a notice. Its access token is removed, so that undeliverable
+        tokens do not pile up in the table.
+        """
+        notice.status = NOTIFICATION_STATUS.DEAD
+        payload = json.loads(notice.payload)
+        payload.pop('access_token', None)
+        notice.payload = json.dumps(payload)
+
+    def failed(self, notices, error, retry=True):
+        now = datetime.utcnow()
+        for notice in notices:
+            notice.attempts += 1
+            notice.error = unicode(error)
+            if not retry or notice.attempts >= self.max_attempts:
+                self.dead(notice)
+            else:
+                delay = min(self.retry_delay * 2 ** (notice.attempts - 1), self.retry_max_delay)
+                # Spread retries so that notices for a server that was down do not all arrive at once
+                notice.next_attempt_at = now + timedelta(seconds=delay * random.uniform(1, 1.25))
+
+    def dispatch(self):
+        """
+        Post all due notices, up to batch_size of them, one request per app.
+        Returns the number of notices processed.
+        """
+        notices = Notification.query.filter(Notification.status == NOTIFICATION_STATUS.PENDING,
+            Notification.next_attempt_at <= datetime.utcnow()).order_by(
+            Notification.next_attempt_at).limit(self.batch_size).all()
+        grouped = {}
+        for notice in notices:
+            grouped.setdefault(notice.client_id, []).append(notice)
+        clients = dict((client.id, client) for client in Client.query.filter(Client.id.in_(grouped.keys())))
+        for client_id, group in grouped.items():
+            client = clients[client_id]
+            if not (client.notification_uri or u'').startswith(u'https://'):
+                self.failed(group, u"No https notification URI", retry=False)
+                continue
+            body = json.dumps({'notices': [json.loads(notice.payload) for notice in group]})
+            try:
+                self.post(client.notification_uri, client.secret, body)
+            except Exception, e:
+                print >> self.log, "Could not notify %s (%s): %s" % (client.key, client.notification_uri, e)
+                self.failed(group, e)
+            else:
+                for notice in group:
+                    db.session.delete(notice)
+            db.session.commit()
+        return len(notices)
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+        self.connections = {}
+
+
+def purge_dead():
+    """
+    Delete all dead notices. Returns the number deleted.
+    """
+    count = Notification.query.filter_by(status=NOTIFICATION_STATUS.DEAD).delete(synchronize_session=False)
+    db.session.commit()
+    return count
+
+
+def run_dispatcher(batch_size=500, poll_interval=5, once=False, log=sys.stderr):
+    """
+    Post queued notices as they become due. Only one dispatcher should run at
+    a time.
+    """
+    dispatcher = Dispatcher(batch_size, log)
+    try:
+        while True:
+            if dispatcher.dispatch() < batch_size:
+                db.session.rollback()
+                if once:
+                    break
+                time.sleep(poll_interval)
+    finally:
+        dispatcher.close()
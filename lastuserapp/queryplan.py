@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+"""
+Check that frequent queries are served by indexes.
+
+Each query in :data:`HOT_QUERIES` is run through the database's EXPLAIN and
+reported as failing if its plan scans a whole table. Run it with
+``manage.py explain`` against a database with realistic data, after
+``manage.py migrate``. On PostgreSQL, sequential scans are disabled for the
+check so that small tables do not hide missing indexes.
+"""
+
+import sys
+from datetime import datetime
+
+from lastuserapp.models import (db, User, UserEmail, UserEmailClaim, UserExternalId, PasswordResetRequest,
+    Organization, Team, Name, Client, AuthCode, AuthToken, UserFlashMessage, Resource, UserClientPermission,
+    Notification, NOTIFICATION_STATUS, Tombstone, SMSMessage, SMS_STATUS)
+from lastuserapp.models.user import team_membership, starts_with
+
+#: Frequent queries, as (description, function returning a query)
+HOT_QUERIES = [
+    ("User by userid", lambda: User.query.filter_by(userid='x')),
+    ("User by username", lambda: User.query.filter(User._username == u'x')),
+    ("User picker by name", lambda: db.session.query(User.id).filter(
+        starts_with(db.func.lower(User.fullname), u'x'))),
+    ("User picker by username", lambda: db.session.query(User.id).filter(starts_with(User._username, u'x'))),
+    ("Name registry lookup", lambda: Name.query.filter_by(name=u'x')),
+    ("Verified email", lambda: UserEmail.query.filter(UserEmail._email == u'x')),
+    ("Verified email by md5sum", lambda: UserEmail.query.filter_by(md5sum='x')),
+    ("Emails of a user", lambda: UserEmail.query.filter_by(user_id=1)),
+    ("Email claim by email", lambda: UserEmailClaim.query.filter(UserEmailClaim._email == u'x')),
+    ("Email claim by md5sum", lambda: UserEmailClaim.query.filter_by(md5sum='x')),
+    ("External id by service and userid", lambda: UserExternalId.query.filter_by(service='x', userid='x')),
+    ("Twitter handle", lambda: UserExternalId.query.filter_by(service='twitter', username=u'x')),
+    ("External ids of a user", lambda: UserExternalId.query.filter_by(user_id=1)),
+    ("Password reset request", lambda: PasswordResetRequest.query.filter_by(user_id=1, reset_code='x')),
+    ("Organization by name", lambda: Organization.query.filter(Organization._name == u'x')),
+    ("Teams of an organization", lambda: Team.query.filter_by(org_id=1)),
+    ("Team membership check", lambda: db.session.query(team_membership.c.team_id).filter(
+        team_membership.c.team_id == 1, team_membership.c.user_id == 1)),
+    ("Teams of a user", lambda: db.session.query(team_membership.c.team_id).filter(
+        team_membership.c.user_id == 1)),
+    ("Client by key", lambda: Client.query.filter_by(key='x')),
+    ("Clients of a user", lambda: Client.query.filter_by(user_id=1)),
+    ("Clients of an organization", lambda: Client.query.filter_by(org_id=1)),
+    ("Resources of a client", lambda: Resource.query.filter_by(client_id=1)),
+    ("Auth code at /token", lambda: AuthCode.query.filter_by(code='x', client_id=1)),
+    ("Auth token by token", lambda: AuthToken.query.filter_by(token='x')),
+    ("Auth token by user and client", lambda: AuthToken.query.filter_by(user_id=1, client_id=1)),
+    ("Auth tokens of a client", lambda: AuthToken.query.filter_by(client_id=1)),
+    ("Auth tokens of a user", lambda: AuthToken.query.filter_by(user_id=1)),
+    ("Idle auth tokens", lambda: AuthToken.query.filter(AuthToken.last_used < datetime(2012, 1, 1))),
+    ("Flash messages of a user", lambda: UserFlashMessage.query.filter_by(user_id=1)),
+    ("Holders of a permission", lambda: UserClientPermission.query.filter_by(client_id=1, name=u'x')),
+    ("Changed users", lambda: User.query.filter(User.updated_at > datetime(2012, 1, 1)).order_by(
+        User.updated_at, User.id)),
+    ("Changed organizations", lambda: Organization.query.filter(
+        Organization.updated_at > datetime(2012, 1, 1)).order_by(Organization.updated_at, Organization.id)),
+    ("Changed teams", lambda: Team.query.filter(Team.updated_at > datetime(2012, 1, 1)).order_by(
+        Team.updated_at, Team.id)),
+    ("Changed team memberships", lambda: db.session.query(team_membership.c.team_id).filter(
+        team_membership.c.updated_at > datetime(2012, 1, 1))),
+    ("Removed team member", lambda: Tombstone.query.filter_by(kind='membership', userid='x', member='x')),
+    ("Queued text messages", lambda: SMSMessage.query.filter(
+        SMSMessage.status.in_([SMS_STATUS.QUEUED, SMS_STATUS.SENDING]),
+        SMSMessage.next_attempt_at <= datetime(2012, 1, 1))),
+    ("Claimed text messages", lambda: SMSMessage.query.filter(SMSMessage.claimed_by == 'x')),
+    ("Due notifications", lambda: Notification.query.filter(Notification.status == NOTIFICATION_STATUS.PENDING,
+        Notification.next_attempt_at <= datetime(2012, 1, 1))),
+    ]
+
+
+def explain(connection, query):
+    """
+    Return the lines of the database's plan for a query.
+    """
+    compiled = query.statement.compile(dialect=connection.dialect)
+    params = compiled.construct_params()
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    if connection.dialect.name == 'sqlite':
+        return [tuple(row)[-1] for row in connection.execute('EXPLAIN QUERY PLAN ' + unicode(compiled), params)]
+    else:
+        return [row[0] for row in connection.execute('EXPLAIN ' + unicode(compiled), params)]
+
+
+def is_full_scan(dialect, line):
+    if dialect == 'sqlite':
+        return line.startswith('SCAN') and 'VIRTUAL TABLE' not in line
+    else:
+        return 'Seq Scan' in line
+
+
+def check_plans(log=sys.stdout):
+    """
+    Explain every hot query and report those that scan a whole table.
+    Returns the number of failing queries.
+    """
+    connection = db.session.connection()
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        connection.execute('SET enable_seqscan = off')
+    failures = 0
+    for description, query in HOT_QUERIES:
+        plan = explain(connection, query())
+        failed = any(is_full_scan(dialect, line) for line in plan)
+        failures += failed
+        print >> log, "%s  %s" % ("FAIL" if failed else "ok  ", description)
+        if failed:
+            for line in plan:
+                print >> log, "        " + line
+    db.session.rollback()
+    return failures
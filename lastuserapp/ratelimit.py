@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+"""
+Rate limiting for expensive endpoints: password logins, the token endpoint
+and user lookup APIs.
+
+Each limit allows a number of requests per window of seconds, counted
+separately for each remote address, client app or target username. Counts
+use a sliding window estimated from the current and previous fixed windows.
+Behind reverse proxies, set RATELIMIT_PROXIES to their number so that the
+remote address is read from the X-Forwarded-For header they add to.
+
+Counters are kept in a memory-mapped file shared by all worker processes on
+the host, with a lock per group of slots. Keys are hashed into a fixed number
+of slots, so memory use is constant; when all slots for a key are busy, the
+one hit least recently is taken over. The file is kept in the instance
+folder unless RATELIMIT_FILE says otherwise. Set RATELIMIT_BACKEND = 'memcached' to
+share counters between hosts through the memcached servers in
+CACHE_MEMCACHED_SERVERS instead.
+
+The check runs before any other request handler and does not use the
+database, so rejected requests are cheap.
+"""
+
+import os
+import mmap
+import fcntl
+import struct
+import time
+from hashlib import md5
+
+from flask import request, Response
+
+from lastuserapp import app
+
+#: Default limits, as {name: (requests, seconds)}. Override in settings
+#: with RATELIMITS; set a limit to None to disable it.
+DEFAULT_LIMITS = {
+    'login_ip': (30, 60),
+    'login_username': (10, 300),
+    'reset_ip': (10, 300),
+    'token_client': (600, 60),
+    'token_username': (10, 300),
+    'lookup_client': (300, 60),
+    }
+
+#: Limits applied to each endpoint, as (limit name, key) pairs, where key is
+#: 'ip', 'client' or 'username'
+ENDPOINT_LIMITS = {
+    'login': [('login_ip', 'ip'), ('login_username', 'username')],
+    'reset': [('reset_ip', 'ip')],
+    'oauth_token': [('token_client', 'client'), ('token_username', 'username')],
+    'user_get': [('lookup_client', 'client')],
+    'user_getall': [('lookup_client', 'client')],
+    'user_get_by_userid': [('lookup_client', 'client')],
+    'user_get_by_userids': [('lookup_client', 'client')],
+    'changes': [('lookup_client', 'client')],
+    }
+
+# Slot layout: key hash, window number, count in this window, count in the previous window,
+# time of the last hit
+SLOT = struct.Struct('<QIIId')
+# Number of adjacent slots a key may occupy
+PROBES = 4
+
+
+class SharedMemoryCounters(object):
+    """
+    Sliding window counters in a memory-mapped file.
+    """
+    def __init__(self, path, slots=65536):
+        self.slots = slots
+        size = slots * SLOT.size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+
+    def hit(self, key, limit, window, now=None):
+        """
+        Count a request for key if it is within limit requests per window
+        seconds. Returns 0 if allowed, otherwise the number of seconds after
+        which to retry.
+        """
+        now = now or time.time()
+        number = int(now // window)
+        keyhash = struct.unpack('<Q', md5(key).digest()[:8])[0] or 1
+        first = keyhash % (self.slots - PROBES + 1)
+        offset, length = first * SLOT.size, PROBES * SLOT.size
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, length, offset)
+        try:
+            slots = [SLOT.unpack_from(self.map, offset + index * SLOT.size) for index in range(PROBES)]
+            index = None
+            for candidate, (slothash, slotnumber, current, previous, hit_at) in enumerate(slots):
+                if slothash == keyhash:
+                    index = candidate
+                    break
+            if index is None:
+                # Take over the slot hit least recently. Window numbers can't be compared
+                # for this, since each limit has its own window length
+                index = min(range(PROBES), key=lambda candidate: slots[candidate][4])
+                slots[index] = (keyhash, number, 0, 0, now)
+            slothash, slotnumber, current, previous, hit_at = slots[index]
+            if slotnumber == number - 1:
+                current, previous = 0, current
+            elif slotnumber != number:
+                current, previous = 0, 0
+            estimate = previous * (1 - (now % window) / window) + current
+            if estimate >= limit:
+                return int(window - now % window) + 1
+            SLOT.pack_into(self.map, offset + index * SLOT.size, keyhash, number, current + 1, previous, now)
+            return 0
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, length, offset)
+
+
+class MemcachedCounters(object):
+    """
+    Sliding window counters in memcached, shared between hosts.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+
+    def hit(self, key, limit, window, now=None):
+        now = now or time.time()
+        number = int(now // window)
+        key = 'ratelimit/' + md5(key).hexdigest()
+        current = self.cache.get('%s/%d' % (key, number)) or 0
+        previous = self.cache.get('%s/%d' % (key, number - 1)) or 0
+        if previous * (1 - (now % window) / window) + current >= limit:
+            return int(window - now % window) + 1
+        self.cache.add('%s/%d' % (key, number), 0, timeout=window * 2)
+        self.cache.inc('%s/%d' % (key, number))
+        return 0
+
+
+def make_counters():
+    if app.config.get('RATELIMIT_BACKEND') == 'memcached':
+        from lastuserapp.cache import cache
+        return MemcachedCounters(cache)
+    path = app.config.get('RATELIMIT_FILE')
+    if not path:
+        if not os.path.isdir(app.instance_path):
+            os.makedirs(app.instance_path, 0700)
+        path = os.path.join(app.instance_path, 'ratelimit')
+    return SharedMemoryCounters(path, app.config.get('RATELIMIT_SLOTS', 65536))
+
+
+counters = make_counters()
+limits = dict(DEFAULT_LIMITS, **app.config.get('RATELIMITS', {}))
+
+
+def remote_addr():
+    """
+    Return the address of the client. With RATELIMIT_PROXIES trusted proxies in
+    front of the app, each appending the address it received the request from
+    to the forwarded-for header, that is the entry added by the outermost proxy.
+    Entries before it may have been sent by the client and are ignored.
+    """
+    proxies = app.config.get('RATELIMIT_PROXIES', 0)
+    if proxies:
+        header = request.headers.get(app.config.get('RATELIMIT_FORWARDED_FOR_HEADER', 'X-Forwarded-For'), '')
+        addresses = [address.strip() for address in header.split(',') if address.strip()]
+        if len(addresses) >= proxies:
+            return addresses[-proxies]
+    return request.remote_addr
+
+
+def request_key(key):
+    if key == 'ip':
+        return remote_addr()
+    elif key == 'client':
+        return request.authorization.username if request.authorization else None
+    elif key == 'username':
+        return request.form.get('username')
+
+
+@app.before_request
+def check_rate_limits():
+    if request.method != 'POST' or request.endpoint not in ENDPOINT_LIMITS:
+        return
+    for name, key in ENDPOINT_LIMITS[request.endpoint]:
+        value = request_key(key)
+        if not value or not limits.get(name):
+            continue
+        count, window = limits[name]
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        retry_after = counters.hit('%s:%s' % (name, value), count, float(window))
+        if retry_after:
+            return Response(u"Too many requests. Please try again later.", 429,
+                {'Retry-After': str(retry_after), 'Content-Type': 'text/plain; charset=utf-8'})
@@ -37,6 +37,28 @@ DEFAULT_MAIL_SENDER = ('LastUser', 'test@example.com')
 #: Logging: recipients of error emails
 ADMINS = []
 
+#: Cache: list of memcached servers as 'host:port' (leave empty to cache in-process)
+CACHE_MEMCACHED_SERVERS = []
+
+#: Cache: seconds before cached entries expire
+CACHE_TIMEOUT = 300
+
+#: Rate limits: 'mmap' to share counters between processes on this host
+#: through RATELIMIT_FILE, or 'memcached' to share them between hosts
+RATELIMIT_BACKEND = 'mmap'
+#: Rate limits: counters file for the 'mmap' backend, or None for a file in
+#: the instance folder. The file is created readable by this user only
+RATELIMIT_FILE = None
+
+#: Rate limits: number of reverse proxies in front of the app that add the
+#: client's address to X-Forwarded-For (or RATELIMIT_FORWARDED_FOR_HEADER).
+#: Leave at 0 if requests come straight from clients, or the header can be forged
+RATELIMIT_PROXIES = 0
+
+#: Rate limits: overrides for the defaults in lastuserapp/ratelimit.py,
+#: as {name: (requests, seconds)} or {name: None} to disable
+RATELIMITS = {}
+
 #: Log file
 LOGFILE = 'error.log'
 
@@ -61,6 +83,51 @@ RECAPTCHA_OPTIONS = ''
 SMS_SMSGUPSHUP_MASK = ''
 SMS_SMSGUPSHUP_USER = ''
 SMS_SMSGUPSHUP_PASS = ''
+#: Gateway URL (point this at manage.py sms-stub-gateway for load testing)
+#: and messages sent per second
+SMS_SMSGUPSHUP_URL = 'https://enterprise.smsgupshup.com/GatewayAPI/rest'
+SMS_SMSGUPSHUP_RATE = 20
+
+#: Seconds to wait for an SMS gateway, seconds before retrying a failed send
+#: (doubling after each failure), and attempts before giving up
+SMS_TIMEOUT = 10
+SMS_RETRY_DELAY = 30
+SMS_MAX_ATTEMPTS = 5
+#: Seconds after which messages claimed by an SMS worker that has not
+#: finished sending them are claimed by another
+SMS_CLAIM_TIMEOUT = 300
+
+#: Delivery reports are applied by the SMS worker in batches of this size,
+#: which is also the most the gateway may post at once. Reports for messages
+#: not yet recorded as sent are kept for SMS_REPORT_HOLD seconds
+SMS_REPORT_BATCH_SIZE = 500
+SMS_REPORT_HOLD = 120
+
+#: Maximum number of items in a batch API call or a page of API results
+API_BATCH_LIMIT = 100
+
+#: Seconds to hold back recent changes from the change feed, so that changes
+#: from slow transactions are not skipped
+CHANGE_FEED_LAG = 60
+
+#: Maximum number of members in a team sync API call
+API_TEAM_SYNC_LIMIT = 100000
+
+#: Deletions affecting more rows than this are queued for manage.py deletion-worker
+DELETION_INLINE_LIMIT = 1000
+
+#: Access token last-used times are rounded down to this many seconds, and
+#: written out by each worker process at most this often
+TOKEN_USAGE_GRANULARITY = 3600
+TOKEN_USAGE_FLUSH_INTERVAL = 60
+
+#: Notices to client apps: seconds to wait for a response, seconds before
+#: the first retry (doubling after each failure, up to the maximum), and the
+#: number of failed attempts after which a notice is given up
+NOTIFICATION_TIMEOUT = 10
+NOTIFICATION_RETRY_DELAY = 30
+NOTIFICATION_RETRY_MAX_DELAY = 21600
+NOTIFICATION_MAX_ATTEMPTS = 12
 
 #: Messages (in markdown)
 MESSAGE_FOOTER = 'Copyright &copy; [HasGeek](http://hasgeek.com/). Powered by [LastUser](https://github.com/hasgeek/lastuser "GitHub project page"), open source software from [HasGeek](https://github.com/hasgeek).'
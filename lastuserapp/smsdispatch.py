@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+
+"""
+Sending queued text messages.
+
+Messages are saved with the QUEUED status and sent later by the SMS worker
+(``manage.py sms-worker``), so that requests never wait on the gateway. The
+worker sends messages from a pool of threads, each keeping its own open
+connection to the gateway, and limits the rate at which messages are
+handed to each gateway. Before sending, the worker claims a batch of due
+messages by marking them SENDING under its own id and committing, so that
+several workers can run without sending a message twice. A claim lasts
+SMS_CLAIM_TIMEOUT seconds; messages still SENDING after that, because their
+worker died, are claimed again. Messages the gateway accepts are marked PENDING
+until their delivery report arrives. Failed sends are retried after
+SMS_RETRY_DELAY seconds, doubling each time, and marked FAILED after
+SMS_MAX_ATTEMPTS attempts.
+
+Delivery reports from gateways are saved to a staging table as they arrive
+and applied to their messages in batches by the same worker; see
+:func:`apply_reports`.
+
+For load testing, ``manage.py sms-stub-gateway`` runs a local server that
+accepts messages like SMS GupShup does. Point SMS_SMSGUPSHUP_URL at it.
+"""
+
+import random
+import socket
+import sys
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from datetime import datetime, timedelta
+from httplib import HTTPConnection, HTTPSConnection, HTTPException
+from multiprocessing.pool import ThreadPool
+from urllib import urlencode
+
+from lastuserapp import app
+from lastuserapp.models import db, SMSMessage, SMSReport, SMS_STATUS
+from lastuserapp.utils import newid, chunks
+
+
+class SendError(Exception):
+    """
+    The gateway did not accept a message.
+    """
+    pass
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls so that no more than rate happen per second, across
+    all threads.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_at = time.time()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            at = max(now, self.next_at)
+            self.next_at = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+
+class SMSGupShupGateway(object):
+    """
+    SMS GupShup, for Indian mobile numbers.
+    """
+    name = 'smsgupshup'
+
+    def __init__(self):
+        self.url = urlparse.urlsplit(app.config.get('SMS_SMSGUPSHUP_URL',
+            'https://enterprise.smsgupshup.com/GatewayAPI/rest'))
+        self.timeout = app.config.get('SMS_TIMEOUT', 10)
+        self.limiter = RateLimiter(app.config.get('SMS_SMSGUPSHUP_RATE', 20))
+        self.local = threading.local()
+
+    @staticmethod
+    def accepts(phone_number):
+        return phone_number.startswith('+91')
+
+    @staticmethod
+    def validate(phone_number):
+        if len(phone_number) != 13:
+            raise ValueError("Invalid Indian mobile number")
+
+    def connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            if self.url.scheme == 'https':
+                self.local.connection = HTTPSConnection(self.url.netloc, timeout=self.timeout)
+            else:
+                self.local.connection = HTTPConnection(self.url.netloc, timeout=self.timeout)
+        return self.local.connection
+
+    def send(self, phone_number, message):
+        """
+        Send a message. Returns the gateway's transaction id.
+        """
+        params = urlencode(dict(
+            method='SendMessage',
+            send_to=phone_number[1:],  # Number without leading +
+            msg=message.encode('utf-8'),
+            msg_type='TEXT',
+            format='text',
+            v='1.1',
+            auth_scheme='plain',
+            userid=app.config['SMS_SMSGUPSHUP_USER'],
+            password=app.config['SMS_SMSGUPSHUP_PASS'],
+            mask=app.config['SMS_SMSGUPSHUP_MASK']
+            ))
+        self.limiter.wait()
+        connection = self.connection()
+        try:
+            connection.request('GET', '%s?%s' % (self.url.path, params))
+            response = connection.getresponse()
+            body = response.read()
+        except (HTTPException, socket.error):
+            # Reconnect for the next message
+            connection.close()
+            self.local.connection = None
+            raise
+        if response.status != 200:
+            raise SendError("HTTP status %d" % response.status)
+        parts = [item.strip() for item in body.split('|')]
+        if len(parts) != 3 or parts[0] != 'success':
+            raise SendError(body.strip())
+        return parts[2]
+
+
+#: Gateways, tried in order for each phone number
+GATEWAYS = [SMSGupShupGateway()]
+
+
+def gateway_for(phone_number):
+    """
+    Return the gateway for a phone number, or raise ValueError if it cannot
+    be sent messages.
+    """
+    for gateway in GATEWAYS:
+        if gateway.accepts(phone_number):
+            gateway.validate(phone_number)
+            return gateway
+    raise ValueError("Unsupported phone number")
+
+
+def queue_message(phone_number, message):
+    """
+    Queue a message for the SMS worker. Raises ValueError if the number is not
+    supported. Changes are not committed.
+    """
+    gateway_for(phone_number)
+    msg = SMSMessage(phone_number=phone_number, message=message, status=SMS_STATUS.QUEUED)
+    db.session.add(msg)
+    return msg
+
+
+def _send(item):
+    """
+    Send one message in a worker thread. Returns (id, transaction id, error).
+    """
+    id, phone_number, message = item
+    try:
+        return id, gateway_for(phone_number).send(phone_number, message), None
+    except Exception, e:
+        return id, None, unicode(e) or e.__class__.__name__
+
+
+class Worker(object):
+    """
+    Sends queued messages from a pool of threads.
+    """
+    def __init__(self, threads=8, batch_size=200, log=sys.stderr):
+        self.batch_size = batch_size
+        self.log = log
+        self.pool = ThreadPool(threads)
+        self.retry_delay = app.config.get('SMS_RETRY_DELAY', 30)
+        self.max_attempts = app.config.get('SMS_MAX_ATTEMPTS', 5)
+        self.claim_timeout = app.config.get('SMS_CLAIM_TIMEOUT', 300)
+
+    def claim(self, now):
+        """
+        Claim up to batch_size due messages for this worker, in a transaction
+        of its own. Returns (id, phone number, message) for each message
+        claimed. Messages another worker claimed first are left out.
+        """
+        table = SMSMessage.__table__
+        due = db.and_(table.c.status.in_([SMS_STATUS.QUEUED, SMS_STATUS.SENDING]), table.c.next_attempt_at <= now)
+        ids = [row[0] for row in db.session.execute(db.select([table.c.id], due).order_by(
+            table.c.next_attempt_at).limit(self.batch_size))]
+        if not ids:
+            db.session.rollback()
+            return []
+        claim = newid()
+        db.session.execute(table.update().where(db.and_(table.c.id.in_(ids), due)).values(
+            status=SMS_STATUS.SENDING, claimed_by=claim,
+            next_attempt_at=now + timedelta(seconds=self.claim_timeout)))
+        db.session.commit()
+        items = db.session.query(SMSMessage.id, SMSMessage.phone_number, SMSMessage.message).filter(
+            SMSMessage.claimed_by == claim).all()
+        db.session.rollback()
+        return items
+
+    def send_due(self):
+        """
+        Claim and send up to batch_size due messages. Returns the number
+        attempted.
+        """
+        now = datetime.utcnow()
+        items = self.claim(now)
+        if not items:
+            return 0
+        table = SMSMessage.__table__
+        sent, failed = [], {}
+        for id, transaction_id, error in self.pool.imap_unordered(_send, items):
+            if error is None:
+                sent.append({'msg_id': id, 'msg_transaction_id': transaction_id})
+            else:
+                failed.setdefault(error, []).append(id)
+        if sent:
+            db.session.execute(table.update().where(table.c.id == db.bindparam('msg_id')).values(
+                status=SMS_STATUS.PENDING, transaction_id=db.bindparam('msg_transaction_id'), fail_reason=None,
+                claimed_by=None), sent)
+        for error, ids in failed.items():
+            print >> self.log, "Could not send %d messages: %s" % (len(ids), error)
+            for attempts, group in self._by_attempts(ids).items():
+                values = {'attempts': attempts, 'fail_reason': error[:25], 'claimed_by': None}
+                if attempts >= self.max_attempts:
+                    values['status'] = SMS_STATUS.FAILED
+                else:
+                    values['status'] = SMS_STATUS.QUEUED
+                    delay = self.retry_delay * 2 ** (attempts - 1) * random.uniform(1, 1.25)
+                    values['next_attempt_at'] = now + timedelta(seconds=delay)
+                db.session.execute(table.update().where(table.c.id.in_(group)).values(values))
+        db.session.commit()
+        return len(items)
+
+    def _by_attempts(self, ids):
+        grouped = {}
+        for id, attempts in db.session.query(SMSMessage.id, SMSMessage.attempts).filter(SMSMessage.id.in_(ids)):
+            grouped.setdefault(attempts + 1, []).append(id)
+        return grouped
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def run_worker(threads=8, batch_size=200, poll_interval=1, once=False, log=sys.stderr):
+    """
+    Send queued messages as they become due, and apply delivery reports.
+    """
+    worker = Worker(threads, batch_size, log)
+    report_batch_size = app.config.get('SMS_REPORT_BATCH_SIZE', 500)
+    hold = app.config.get('SMS_REPORT_HOLD', 120)
+    try:
+        while True:
+            sent = worker.send_due()
+            apply_reports(report_batch_size, hold)
+            if sent < batch_size:
+                if once:
+                    break
+                time.sleep(poll_interval)
+    finally:
+        worker.close()
+
+
+# --- Delivery reports --------------------------------------------------------
+
+def stage_reports(reports):
+    """
+    Save delivery reports for the SMS worker to apply. Reports are
+    dictionaries with the keys transaction_id, phone_number, status,
+    status_at and fail_reason. Changes are not committed.
+    """
+    if reports:
+        db.session.execute(SMSReport.__table__.insert(), reports)
+
+
+def apply_reports(batch_size=500, hold=120):
+    """
+    Apply staged delivery reports, batch_size at a time with one UPDATE
+    statement per batch, committing after each batch. Returns the number of
+    messages updated.
+
+    Applying a report only changes a message whose phone number matches and
+    whose status is not newer than the report, so duplicate and out of order
+    reports leave the message as it would be with the latest report alone.
+    A gateway may report delivery before the SMS worker has recorded the
+    message's transaction id, so reports for unknown messages are kept for
+    up to hold seconds before being dropped.
+    """
+    staged = SMSReport.__table__
+    table = SMSMessage.__table__
+    statement = table.update().where(db.and_(
+        table.c.transaction_id == db.bindparam('report_transaction_id'),
+        table.c.phone_number == db.bindparam('report_phone_number'),
+        db.or_(table.c.status_at == None, table.c.status_at <= db.bindparam('report_status_at')))).values(
+        status=db.bindparam('report_status'), status_at=db.bindparam('report_status_at'),
+        fail_reason=db.bindparam('report_fail_reason'))
+    expired = datetime.utcnow() - timedelta(seconds=hold)
+    updated = 0
+    last = 0
+    while True:
+        rows = db.session.execute(db.select([staged], staged.c.id > last).order_by(
+            staged.c.id).limit(batch_size)).fetchall()
+        if not rows:
+            break
+        last = rows[-1].id
+        # Of several reports for a message, only the latest matters
+        latest = {}
+        for row in rows:
+            if row.transaction_id not in latest or latest[row.transaction_id].status_at <= row.status_at:
+                latest[row.transaction_id] = row
+        known = set(row[0] for row in db.session.execute(
+            db.select([table.c.transaction_id], table.c.transaction_id.in_(latest.keys()))))
+        if known:
+            updated += db.session.execute(statement, [dict(('report_' + key, row[key])
+                for key in ('transaction_id', 'phone_number', 'status', 'status_at', 'fail_reason'))
+                for row in latest.values() if row.transaction_id in known]).rowcount
+        done = [row.id for row in rows if row.transaction_id in known or row.received_at < expired]
+        if done:
+            db.session.execute(staged.delete().where(staged.c.id.in_(done)))
+        db.session.commit()
+    db.session.rollback()
+    return updated
+
+
+# --- Stub gateway for load testing -------------------------------------------
+
+class StubGatewayHandler(BaseHTTPRequestHandler):
+    """
+    Accepts every message the way SMS GupShup does, after an optional delay.
+    """
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one write, not one per header
+    wbufsize = -1
+
+    def do_GET(self):
+        params = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        body = 'success | %s | %s\n' % (params.get('send_to', [''])[0], newid())
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubGateway(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    #: Seconds to wait before answering
+    delay = 0
+
+
+def run_stub_gateway(port=8025, delay=0):
+    """
+    Run the stub gateway on localhost until interrupted.
+    """
+    server = StubGateway(('127.0.0.1', port), StubGatewayHandler)
+    server.delay = delay
+    print >> sys.stderr, "Stub SMS gateway at http://127.0.0.1:%d/GatewayAPI/rest" % port
+    server.serve_forever()
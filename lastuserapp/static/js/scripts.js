@@ -22,3 +22,59 @@ $(function() {
     };
   });
 });
+
+// Typeahead user picker. Turns a text input holding comma-separated userids
+// into a list of selected users and a search box that queries the URL
+// in the input's data-autocomplete attribute.
+$(function() {
+  $("input[data-autocomplete]").each(function() {
+    var field = $(this).hide();
+    var selected = $('<ul class="picker-selected"></ul>').insertAfter(field);
+    var search = $('<input type="text" class="picker-search" autocomplete="off" />').insertAfter(selected);
+    var results = $('<ul class="picker-results"></ul>').insertAfter(search);
+    var userids = [];
+    var timer = null;
+
+    var addUser = function(user) {
+      if ($.inArray(user.userid, userids) != -1) return;
+      userids.push(user.userid);
+      field.val(userids.join(','));
+      var item = $('<li></li>').text(user.label + ' ');
+      $('<a href="#">remove</a>').click(function() {
+        userids.splice($.inArray(user.userid, userids), 1);
+        field.val(userids.join(','));
+        item.remove();
+        return false;
+      }).appendTo(item);
+      selected.append(item);
+    };
+
+    var lookup = function(page) {
+      var q = $.trim(search.val());
+      if (page == 1) results.empty();
+      if (!q) return;
+      $.getJSON(field.attr('data-autocomplete'), {q: q, page: page}, function(data) {
+        if (q != $.trim(search.val())) return; // Stale response
+        $.each(data.users, function(index, user) {
+          $('<li><a href="#"></a></li>').find('a').text(user.label).click(function() {
+            addUser(user);
+            return false;
+          }).end().appendTo(results);
+        });
+        if (data.more) {
+          $('<li class="more"><a href="#">More&hellip;</a></li>').find('a').click(function() {
+            $(this).parent().remove();
+            lookup(page + 1);
+            return false;
+          }).end().appendTo(results);
+        }
+      });
+    };
+
+    $.each($.parseJSON(field.attr('data-users') || '[]'), function(index, user) { addUser(user); });
+    search.keyup(function() {
+      clearTimeout(timer);
+      timer = setTimeout(function() { lookup(1); }, 250);
+    });
+  });
+});
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tracking when access tokens were last used, and pruning idle tokens.
+
+Writing to the token row on every API call would turn each read into a
+write. Instead, each worker process remembers the tokens it has seen in
+memory and writes them out together every TOKEN_USAGE_FLUSH_INTERVAL
+seconds. Times are rounded down to TOKEN_USAGE_GRANULARITY seconds, so a
+token in constant use is written at most once per step, and a token whose
+recorded time is already in the current step is not buffered at all.
+
+Recorded times may lag by up to one step plus one flush interval, and usage
+buffered in a worker that is killed is lost. Neither matters for deciding
+which tokens have been idle for weeks. Tokens idle for longer than a given
+number of days are removed with ``manage.py prune-tokens``.
+"""
+
+import atexit
+import json
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+from lastuserapp import app
+from lastuserapp.models import db, AuthToken
+from lastuserapp.utils import chunks
+
+
+def coarsen(when, granularity):
+    """
+    Round a datetime down to a multiple of granularity seconds.
+
+    >>> coarsen(datetime(2012, 1, 1, 10, 47, 12), 3600)
+    datetime.datetime(2012, 1, 1, 10, 0)
+    """
+    epoch = datetime(1970, 1, 1)
+    seconds = int((when - epoch).total_seconds())
+    return epoch + timedelta(seconds=seconds - seconds % granularity)
+
+
+class UsageBuffer(object):
+    """
+    Last-used times of tokens, buffered in memory until flushed.
+
+    :param granularity: Seconds to round times down to
+    :param flush_interval: Seconds between writes to the database
+    """
+    def __init__(self, granularity=3600, flush_interval=60):
+        self.granularity = granularity
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.flushed_at = time.time()
+
+    def record(self, authtoken):
+        """
+        Note that a token was used now.
+        """
+        step = coarsen(datetime.utcnow(), self.granularity)
+        if authtoken.last_used is not None and authtoken.last_used >= step:
+            return
+        with self.lock:
+            self.pending[authtoken.id] = step
+
+    def due(self):
+        return bool(self.pending) and time.time() - self.flushed_at >= self.flush_interval
+
+    def flush(self):
+        """
+        Write buffered times with one UPDATE per step and batch of tokens, in
+        a transaction of its own. Returns the number of tokens written.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.flushed_at = time.time()
+        steps = {}
+        for token_id, step in pending.items():
+            steps.setdefault(step, []).append(token_id)
+        table = AuthToken.__table__
+        connection = db.engine.connect()
+        transaction = connection.begin()
+        try:
+            for step, token_ids in steps.items():
+                for chunk in chunks(token_ids):
+                    # Keep updated_at as it is: it records changes to the token, not its use
+                    connection.execute(table.update().where(db.and_(table.c.id.in_(chunk),
+                        db.or_(table.c.last_used == None, table.c.last_used < step))).values(
+                        last_used=step, updated_at=table.c.updated_at))
+            transaction.commit()
+        except:
+            transaction.rollback()
+            with self.lock:
+                for token_id, step in pending.items():
+                    self.pending.setdefault(token_id, step)
+            raise
+        finally:
+            connection.close()
+        return len(pending)
+
+
+usage = UsageBuffer(app.config.get('TOKEN_USAGE_GRANULARITY', 3600),
+    app.config.get('TOKEN_USAGE_FLUSH_INTERVAL', 60))
+
+
+@app.teardown_request
+def flush_token_usage(exception=None):
+    if usage.due():
+        try:
+            usage.flush()
+        except Exception:
+            app.logger.exception("Could not record token usage")
+
+
+@atexit.register
+def flush_token_usage_at_exit():
+    if usage.pending:
+        usage.flush()
+
+
+def prune_tokens(days, batch_size=1000, archive=None, log=sys.stderr):
+    """
+    Delete tokens not used in the given number of days, batch_size at a
+    time, committing after each batch. If archive is a file, deleted tokens
+    are written to it as JSON lines first. Returns the number deleted.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    table = AuthToken.__table__
+    deleted = 0
+    while True:
+        rows = db.session.execute(db.select([table.c.id, table.c.user_id, table.c.client_id, table.c.scope,
+            table.c.created_at, table.c.last_used], table.c.last_used < cutoff).limit(batch_size)).fetchall()
+        if not rows:
+            break
+        if archive is not None:
+            for row in rows:
+                archive.write(json.dumps({
+                    'user_id': row.user_id,
+                    'client_id': row.client_id,
+                    'scope': row.scope,
+                    'created_at': row.created_at.isoformat(),
+                    'last_used': row.last_used.isoformat(),
+                    }) + '\n')
+            archive.flush()
+        db.session.execute(table.delete().where(table.c.id.in_([row.id for row in rows])))
+        db.session.commit()
+        deleted += len(rows)
+        print >> log, "%d tokens deleted" % deleted
+    return deleted
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""
+Information about a user, as returned to client apps at the token endpoint
+and in token verification.
+
+Building it walks the user's email addresses, organizations, teams and
+permissions, so results are cached per user, client and scope when the
+cache is shared between processes (memcached). An in-process cache would
+keep serving stale information in every process but the one that made a
+change, so without memcached it is built afresh each time. Cache keys
+include version stamps (cache generations) for the user, for the client's
+permissions and, where organizations or teams are involved, for all
+organizations. Stamps are bumped after commit by the mapper events below
+and by the bulk operations that bypass the ORM:
+
+* ``user/<id>``: the user's profile, email addresses and team memberships
+* ``client/<id>``: permissions assigned on the client
+* ``organizations``: names and titles of organizations and teams, and
+  deleted organizations and teams
+"""
+
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import get_history
+
+from lastuserapp.cache import cache, shared, generations, bump_after_commit
+from lastuserapp.models import (db, User, UserEmail, Organization, Team, UserClientPermissions,
+    UserClientPermission, TeamClientPermissions, TeamClientPermission)
+
+#: Scope items that change the information returned
+SCOPE_ITEMS = ('email', 'organizations')
+
+
+def build_userinfo(user, client, scope=[]):
+    userinfo = {'userid': user.userid,
+                'username': user.username,
+                'fullname': user.fullname}
+    if 'email' in scope:
+        userinfo['email'] = unicode(user.email)
+    if 'organizations' in scope:
+        userinfo['organizations'] = {
+            'owner': [{'userid': org.userid, 'name': org.name, 'title': org.title} for org in user.organizations_owned()],
+            'member': [{'userid': org.userid, 'name': org.name, 'title': org.title} for org in user.organizations()],
+            }
+        userinfo['teams'] = [{'userid': team.userid, 'title': team.title, 'org': team.org.userid} for team in user.teams]
+    if client.user_id is not None:
+        perms = UserClientPermissions.query.filter_by(user=user, client=client).first()
+        if perms:
+            userinfo['permissions'] = perms.permissions
+    else:
+        team_ids = [team.id for team in user.teams]
+        if team_ids:
+            perms = db.session.query(TeamClientPermission.name).join(TeamClientPermissions,
+                TeamClientPermissions.id == TeamClientPermission.assignment_id).filter(
+                TeamClientPermission.client_id == client.id, TeamClientPermissions.team_id.in_(team_ids)).distinct()
+            userinfo['permissions'] = sorted(name for (name,) in perms)
+        else:
+            userinfo['permissions'] = []
+    return userinfo
+
+
+def get_userinfo(user, client, scope=[]):
+    """
+    Return information about a user for a client app, from the cache if it
+    is shared and the information has not changed since it was built.
+    """
+    items = [item for item in SCOPE_ITEMS if item in scope]
+    if not shared:
+        return build_userinfo(user, client, items)
+    groups = ['user/%d' % user.id, 'client/%d' % client.id]
+    # Organization clients get permissions through teams
+    if 'organizations' in items or client.user_id is None:
+        groups.append('organizations')
+    key = 'userinfo/%d/%d/%s/%s' % (user.id, client.id, ','.join(items), '/'.join(generations(*groups)))
+    userinfo = cache.get(key)
+    if userinfo is None:
+        userinfo = build_userinfo(user, client, items)
+        cache.set(key, userinfo)
+    return userinfo
+
+
+def _stale(target, *groups):
+    session = object_session(target)
+    if session is not None:
+        bump_after_commit(session, *groups)
+
+
+@event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, target):
+    _stale(target, 'user/%d' % target.id)
+
+
+@event.listens_for(UserEmail, 'after_insert')
+@event.listens_for(UserEmail, 'after_update')
+@event.listens_for(UserEmail, 'after_delete')
+def _useremail_changed(mapper, connection, target):
+    _stale(target, 'user/%d' % target.user_id)
+
+
+@event.listens_for(Team.users, 'append')
+@event.listens_for(Team.users, 'remove')
+def _membership_changed(target, value, initiator):
+    # New users have no id yet, and nothing cached
+    if value.id is not None:
+        _stale(target if object_session(target) is not None else value, 'user/%d' % value.id)
+
+
+@event.listens_for(Organization, 'after_update')
+@event.listens_for(Team, 'after_update')
+def _org_updated(mapper, connection, target):
+    if any(get_history(target, name).has_changes() for name in ('_name', 'title') if hasattr(target, name)):
+        _stale(target, 'organizations')
+
+
+@event.listens_for(Organization, 'after_delete')
+@event.listens_for(Team, 'after_delete')
+def _org_deleted(mapper, connection, target):
+    _stale(target, 'organizations')
+
+
+@event.listens_for(UserClientPermission, 'after_insert')
+@event.listens_for(UserClientPermission, 'after_delete')
+@event.listens_for(TeamClientPermission, 'after_insert')
+@event.listens_for(TeamClientPermission, 'after_delete')
+def _permission_changed(mapper, connection, target):
+    _stale(target, 'client/%d' % target.client_id)
@@ -3,8 +3,9 @@
 # Id generation
 from random import randint
 import uuid
-from base64 import urlsafe_b64encode
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 import re
+import json
 import urlparse
 from urllib import urlencode as make_query_string
 
@@ -54,10 +55,63 @@ def make_redirect_url(url, **params):
     return urlparse.urlunsplit(urlparts)
 
 
+def encode_cursor(values):
+    """
+    Encode a list of values (from the last row of a page) into an opaque
+    cursor for keyset pagination.
+
+    >>> encode_cursor([u'Title', 42])
+    'WyJUaXRsZSIsIDQyXQ'
+    """
+    return urlsafe_b64encode(json.dumps(values)).rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor made by :func:`encode_cursor`. Returns None if the cursor
+    is invalid.
+
+    >>> decode_cursor('WyJUaXRsZSIsIDQyXQ')
+    [u'Title', 42]
+    >>> decode_cursor('invalid') is None
+    True
+    """
+    try:
+        values = json.loads(urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(values, list):
+        return None
+    return values
+
+
 def valid_username(candidate):
     return not USERNAME_VALID_RE.search(candidate) is None
 
 
+def escape_like(text, escape=u'\\'):
+    """
+    Escape wildcard characters in text for use in a SQL LIKE pattern.
+
+    >>> escape_like(u'50%_off')
+    u'50\\\\%\\\\_off'
+    """
+    return text.replace(escape, escape * 2).replace(u'%', escape + u'%').replace(u'_', escape + u'_')
+
+
+def chunks(values, size=500):
+    """
+    Split values into lists of at most size items, for use in IN clauses
+    that must stay within database parameter limits.
+
+    >>> list(chunks(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    """
+    values = list(values)
+    for index in range(0, len(values), size):
+        yield values[index:index + size]
+
+
 def strip_phone(candidate):
     return PHONE_STRIP_RE.sub('', candidate)
 
@@ -11,7 +11,9 @@ from flask import (g, request, session, flash, redirect, url_for, render_templat
 
 from lastuserapp import app
 from lastuserapp.models import db, User, AuthToken, Client
+from lastuserapp.tokenusage import usage
 from lastuserapp.forms import ConfirmDeleteForm
+from lastuserapp.deletion import DELETABLE, delete as delete_object
 
 # Mapping of resource handlers. Links to the internal, unwrapped function
 __resources = {}
@@ -61,6 +63,11 @@ def lookup_current_user():
     g.user = None
     if 'userid' in session:
         g.user = User.query.filter_by(userid=session['userid']).first()
+        if g.user is None or not g.user.active:
+            # The account was deleted or is being deleted
+            g.user = None
+            session.pop('userid', None)
+    if g.user is not None:
         if not 'avatar_url' in session:
             if g.user.email:
                 session['avatar_url'] = avatar_url_email(g.user.email)
@@ -138,10 +145,11 @@ def provides_resource(name):
                     # No token provided in Authorization header or in request parameters
                     return resource_auth_error(u"An access token is required to access this resource.")
             authtoken = AuthToken.query.filter_by(token=token).first()
-            if not authtoken:
+            if not authtoken or not authtoken.client.active or (authtoken.user and not authtoken.user.active):
                 return resource_auth_error(u"Unknown access token.")
             if name not in authtoken.scope:
                 return resource_auth_error(u"Token does not provide access to this resource.")
+            usage.record(authtoken)
             # All good. Return the result value
             try:
                 result = f(authtoken, args, request.files)
@@ -230,8 +238,14 @@ def render_delete(ob, title, message, success='', next=None):
     form = ConfirmDeleteForm()
     if form.validate_on_submit():
         if 'delete' in request.form:
-            db.session.delete(ob)
-            db.session.commit()
+            if isinstance(ob, DELETABLE):
+                job = delete_object(ob, title=unicode(getattr(ob, 'title', None) or ob.pickername), user=g.user)
+                if job is not None:
+                    flash(u"Deletion of '%s' has been queued and will complete shortly" % job.title, "info")
+                    return render_redirect(url_for('deletion_status', id=job.id), code=303)
+            else:
+                db.session.delete(ob)
+                db.session.commit()
             if success:
                 flash(success, "info")
         return render_redirect(next or url_for('index'))
@@ -282,4 +296,6 @@ import lastuserapp.views.httperror
 import lastuserapp.views.sms
 import lastuserapp.views.resource
 import lastuserapp.views.org
+import lastuserapp.views.search
+import lastuserapp.views.deletion
 import lastuserapp.views.profile
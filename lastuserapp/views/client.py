@@ -1,22 +1,57 @@
 # -*- coding: utf-8 -*-
 
-from flask import g, request, render_template, url_for, flash, abort
+from flask import g, request, session, render_template, url_for, flash, abort
 
 from lastuserapp import app
+from lastuserapp.cache import cache, generation
 from lastuserapp.views import requires_login, render_form, render_redirect, render_delete
 from lastuserapp.models import (db, User, Client, Team, Permission, UserClientPermissions, TeamClientPermissions,
     Resource, ResourceAction)
 from lastuserapp.forms import (RegisterClientForm, PermissionForm, UserPermissionAssignForm,
     TeamPermissionAssignForm, PermissionEditForm, ResourceForm, ResourceActionForm)
+from lastuserapp.utils import encode_cursor, decode_cursor
+
+#: Number of apps listed per page
+CLIENT_LIST_PAGE_SIZE = 50
 
 # --- Routes: client apps -----------------------------------------------------
 
 
+def page_cursor():
+    """
+    Return the (title, id) cursor in the request, or None if there is none or
+    it is invalid.
+    """
+    after = decode_cursor(request.args.get('after', ''))
+    if after and len(after) == 2 and isinstance(after[0], basestring) and isinstance(after[1], (int, long)):
+        return after
+    return None
+
+
+def client_page(query):
+    """
+    Return a page of clients from the query, ordered by title, starting after
+    the cursor in the request, and a cursor for the next page.
+    """
+    after = page_cursor()
+    if after:
+        query = query.filter(db.or_(Client.title > after[0],
+            db.and_(Client.title == after[0], Client.id > after[1])))
+    clients = query.options(db.joinedload(Client.user), db.joinedload(Client.org)).order_by(
+        Client.title, Client.id).limit(CLIENT_LIST_PAGE_SIZE + 1).all()
+    cursor = None
+    if len(clients) > CLIENT_LIST_PAGE_SIZE:
+        clients = clients[:CLIENT_LIST_PAGE_SIZE]
+        cursor = encode_cursor([clients[-1].title, clients[-1].id])
+    return clients, cursor
+
+
 @app.route('/apps')
 def client_list():
     if g.user:
-        return render_template('client_list.html', clients=Client.query.filter(db.or_(Client.user == g.user,
-            Client.org_id.in_(g.user.organizations_owned_ids()))).order_by('title').all())
+        clients, cursor = client_page(Client.query.filter(db.or_(Client.user == g.user,
+            Client.org_id.in_(g.user.organizations_owned_ids()))))
+        return render_template('client_list.html', clients=clients, cursor=cursor)
     else:
         # TODO: Show better UI for non-logged in users
         return render_template('client_list.html', clients=[])
@@ -24,7 +59,20 @@ def client_list():
 
 @app.route('/apps/all')
 def client_list_all():
-    return render_template('client_list.html', clients=Client.query.order_by('title').all())
+    # Pages seen by anonymous visitors are the same for everyone, so they are
+    # cached until a client is added, changed or deleted
+    cacheable = g.user is None and '_flashes' not in session
+    if cacheable:
+        after = page_cursor()
+        key = 'clients/all/%s/%s' % (generation('clients'), encode_cursor(after) if after else '')
+        page = cache.get(key)
+        if page is not None:
+            return page
+    clients, cursor = client_page(Client.query)
+    page = render_template('client_list.html', clients=clients, cursor=cursor)
+    if cacheable:
+        cache.set(key, page)
+    return page
 
 
 def available_client_owners():
@@ -62,13 +110,21 @@ def client_new():
 
 @app.route('/apps/<key>')
 def client_info(key):
-    client = Client.query.filter_by(key=key).first_or_404()
-    if client.user:
-        permassignments = UserClientPermissions.query.filter_by(client=client).all()
+    # Everything the page shows is loaded here with a fixed number of queries
+    client = Client.query.options(db.joinedload(Client.user), db.joinedload(Client.org)).filter_by(
+        key=key).first_or_404()
+    is_owner = client.owner_is(g.user)
+    if not is_owner:
+        permassignments = []
+    elif client.user:
+        permassignments = UserClientPermissions.query.options(db.joinedload(UserClientPermissions.user),
+            db.subqueryload(UserClientPermissions.items)).filter_by(client=client).all()
     else:
-        permassignments = TeamClientPermissions.query.filter_by(client=client).all()
-    resources = Resource.query.filter_by(client=client).order_by('name').all()
-    return render_template('client_info.html', client=client,
+        permassignments = TeamClientPermissions.query.options(db.joinedload(TeamClientPermissions.team),
+            db.subqueryload(TeamClientPermissions.items)).filter_by(client=client).all()
+    resources = Resource.query.options(db.subqueryload(Resource.actions)).filter_by(
+        client=client).order_by('name').all()
+    return render_template('client_info.html', client=client, is_owner=is_owner,
         permassignments=permassignments,
         resources=resources)
 
@@ -219,19 +275,19 @@ def permission_user_new(key):
         if client.user:
             permassign = UserClientPermissions.query.filter_by(user=form.user, client=client).first()
             if permassign:
-                perms.update(permassign.permissions.split(u' '))
+                perms.update(permassign.permissions)
             else:
                 permassign = UserClientPermissions(user=form.user, client=client)
                 db.session.add(permassign)
         else:
             permassign = TeamClientPermissions.query.filter_by(team=form.team, client=client).first()
             if permassign:
-                perms.update(permassign.permissions.split(u' '))
+                perms.update(permassign.permissions)
             else:
                 permassign = TeamClientPermissions(team=form.team, client=client)
                 db.session.add(permassign)
         perms.update(form.perms.data)
-        permassign.permissions = u' '.join(sorted(perms))
+        permassign.permissions = perms
         db.session.commit()
         if client.user:
             flash("Permissions have been assigned to user %s" % form.user.pickername, "info")
@@ -263,10 +319,9 @@ def permission_user_edit(key, userid):
     form.perms.choices = [(ap.name, u"%s – %s" % (ap.name, ap.title)) for ap in available_perms]
     if request.method == 'GET':
         if permassign:
-            form.perms.data = permassign.permissions.split(u' ')
+            form.perms.data = permassign.permissions
     if form.validate_on_submit():
-        form.perms.data.sort()
-        perms = u' '.join(form.perms.data)
+        perms = form.perms.data
         if not perms:
             db.session.delete(permassign)
         else:
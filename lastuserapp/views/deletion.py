@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+from flask import g, request, jsonify, abort
+
+from lastuserapp import app
+from lastuserapp.models import DeletionJob, DELETION_STATUS
+from lastuserapp.views import requires_login, render_message
+
+
+@app.route('/deletions/<int:id>')
+@requires_login
+def deletion_status(id):
+    """
+    Report the progress of a queued deletion. Returns JSON for XHR requests.
+    """
+    job = DeletionJob.query.get_or_404(id)
+    if job.user != g.user:
+        abort(403)
+    if request.is_xhr:
+        return jsonify(status={
+            DELETION_STATUS.QUEUED: 'queued',
+            DELETION_STATUS.RUNNING: 'running',
+            DELETION_STATUS.DONE: 'done',
+            DELETION_STATUS.FAILED: 'failed',
+            }[job.status], deleted=job.deleted)
+    if job.status == DELETION_STATUS.QUEUED:
+        message = u"Deletion of '%s' is waiting to start." % job.title
+    elif job.status == DELETION_STATUS.RUNNING:
+        message = u"Deleting '%s': %d records removed so far." % (job.title, job.deleted)
+    elif job.status == DELETION_STATUS.DONE:
+        message = u"'%s' has been deleted." % job.title
+    else:
+        message = u"Deletion of '%s' failed. Please contact support." % job.title
+    return render_message(title=u"Deleting '%s'" % job.title, message=message)
@@ -12,7 +12,8 @@ from lastuserapp.models import (db, Client, AuthCode, AuthToken, UserFlashMessag
 from lastuserapp.forms import AuthorizeForm
 from lastuserapp.utils import make_redirect_url, newsecret
 from lastuserapp.views import requires_login, requires_client_login
-from lastuserapp.views.resource import get_userinfo
+from lastuserapp.userinfo import get_userinfo
+from lastuserapp.notifications import notify_token
 
 # TODO: Construct this from the resources dict
 __internal_resources = [u'id', u'email', u'organizations', u'notice/send']
@@ -243,8 +244,8 @@ def oauth_make_token(user, client, scope):
     else:
         token = AuthToken(user=user, client=client, scope=scope, token_type='bearer')
         db.session.add(token)
-    # TODO: Look up Resources for items in scope; look up their providing clients apps,
-    # and notify each client app of this token
+    # Let the client apps providing resources in scope know of this token
+    notify_token(token)
     return token
 
 
@@ -311,7 +312,7 @@ def oauth_token():
     # Validations 3: auth code
     elif grant_type == 'authorization_code':
         authcode = AuthCode.query.filter_by(code=code, client=client).first()
-        if not authcode:
+        if not authcode or not authcode.user.active:
             return oauth_token_error('invalid_grant', "Unknown auth code")
         if authcode.created_at < (datetime.utcnow() - timedelta(minutes=1)):  # XXX: Time limit: 1 minute
             db.session.delete(authcode)
@@ -341,7 +342,7 @@ def oauth_token():
         if not username or not password:
             return oauth_token_error('invalid_request', "Username or password not provided")
         user = getuser(username)
-        if not user:
+        if not user or not user.active:
             return oauth_token_error('invalid_client', "No such user")  # XXX: invalid_client doesn't seem right
         if not user.password_is(password):
             return oauth_token_error('invalid_client', "Password mismatch")
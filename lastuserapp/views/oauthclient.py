@@ -8,7 +8,7 @@ from flask import request, session, redirect, render_template, flash, url_for, j
 from flask.ext.oauth import OAuth, OAuthException # OAuth 1.0a
 
 from lastuserapp import app
-from lastuserapp.models import db, UserExternalId, UserEmail, User
+from lastuserapp.models import db, UserExternalId, UserEmail, Name
 from lastuserapp.views import get_next_url, login_internal, register_internal
 from lastuserapp.utils import valid_username, get_gravatar_md5sum
 
@@ -172,7 +172,7 @@ def config_external_id(service, service_name, user, userid, username, fullname,
         # If the service provided a username that is valid for LastUser and not already in use, assign
         # it to this user
         if valid_username(username):
-            if User.query.filter_by(username=username).first() is None:
+            if Name.is_available(username, user):
                 user.username = username
         db.session.add(extid)
         db.session.commit()
@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
 
-from flask import g, render_template, url_for, abort, redirect
+from flask import g, request, render_template, url_for, abort, redirect
 
 from lastuserapp import app
 from lastuserapp.views import requires_login, render_form, render_redirect, render_delete
 from lastuserapp.forms.org import OrganizationForm, TeamForm
 from lastuserapp.models import db, Organization, Team
 
+#: Number of members listed per page on a team's member list
+TEAM_MEMBERS_PAGE_SIZE = 50
+
 # --- Routes: Organizations ---------------------------------------------------
 
 
@@ -35,16 +38,16 @@ def org_new():
 @requires_login
 def org_info(name):
     org = Organization.query.filter_by(name=name).first_or_404()
-    if g.user not in org.owners.users:
+    if not org.owner_is(g.user):
         abort(403)
-    return render_template('org_info.html', org=org)
+    return render_template('org_info.html', org=org, counts=org.team_member_counts())
 
 
 @app.route('/organizations/<name>/edit', methods=['GET', 'POST'])
 @requires_login
 def org_edit(name):
     org = Organization.query.filter_by(name=name).first_or_404()
-    if g.user not in org.owners.users:
+    if not org.owner_is(g.user):
         abort(403)
     form = OrganizationForm(obj=org)
     form.edit_obj = org
@@ -59,7 +62,7 @@ def org_edit(name):
 @requires_login
 def org_delete(name):
     org = Organization.query.filter_by(name=name).first_or_404()
-    if g.user not in org.owners.users:
+    if not org.owner_is(g.user):
         abort(403)
     return render_delete(org, title="Confirm delete", message="Delete organization '%s'? " % org.title,
         success="You have deleted organization '%s' and all its associated teams." % org.title,
@@ -70,7 +73,7 @@ def org_delete(name):
 @requires_login
 def team_list(name):
     org = Organization.query.filter_by(name=name).first_or_404()
-    if g.user not in org.owners.users:
+    if not org.owner_is(g.user):
         abort(403)
     # There's no separate teams page at the moment
     return redirect(url_for('org_info', name=org.name))
@@ -80,7 +83,7 @@ def team_list(name):
 @requires_login
 def team_new(name):
     org = Organization.query.filter_by(name=name).first_or_404()
-    if g.user not in org.owners.users:
+    if not org.owner_is(g.user):
         abort(403)
     form = TeamForm()
     if form.validate_on_submit():
@@ -96,23 +99,36 @@ def team_new(name):
 @requires_login
 def team_edit(name, userid):
     org = Organization.query.filter_by(name=name).first_or_404()
-    if g.user not in org.owners.users:
+    if not org.owner_is(g.user):
         abort(403)
     team = Team.query.filter_by(org=org, userid=userid).first_or_404()
     form = TeamForm(obj=team)
     form.edit_obj = team
     if form.validate_on_submit():
-        form.populate_obj(team)
+        team.title = form.title.data
+        team.sync_members(user.id for user in form.users.data)
         db.session.commit()
         return render_redirect(url_for('org_info', name=org.name), code=303)
     return render_form(form=form, title=u"Edit team: %s" % team.title, formid='team_edit', submit="Save", ajax=False)
 
 
+@app.route('/organizations/<name>/teams/<userid>/members')
+@requires_login
+def team_members(name, userid):
+    org = Organization.query.filter_by(name=name).first_or_404()
+    if not org.owner_is(g.user):
+        abort(403)
+    team = Team.query.filter_by(org=org, userid=userid).first_or_404()
+    page = request.args.get('page', 1, type=int)
+    members = team.members().paginate(page, TEAM_MEMBERS_PAGE_SIZE)
+    return render_template('team_members.html', org=org, team=team, members=members)
+
+
 @app.route('/organizations/<name>/teams/<userid>/delete', methods=['GET', 'POST'])
 @requires_login
 def team_delete(name, userid):
     org = Organization.query.filter_by(name=name).first_or_404()
-    if g.user not in org.owners.users:
+    if not org.owner_is(g.user):
         abort(403)
     team = Team.query.filter_by(org=org, userid=userid).first_or_404()
     if team == org.owners:
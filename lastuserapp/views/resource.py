@@ -1,37 +1,18 @@
 # -*- coding: utf-8 -*-
 
-from flask import jsonify, request, g
-
-from lastuserapp import app
-from lastuserapp.models import (getuser, User, Organization, AuthToken, Resource, ResourceAction,
-    UserClientPermissions, TeamClientPermissions)
-from lastuserapp.views import provides_resource, requires_client_login
+from flask import jsonify, request, g, Response, stream_with_context
+from sqlalchemy.exc import IntegrityError
 
 
-def get_userinfo(user, client, scope=[]):
-    userinfo = {'userid': user.userid,
-                'username': user.username,
-                'fullname': user.fullname}
-    if 'email' in scope:
-        userinfo['email'] = unicode(user.email)
-    if 'organizations' in scope:
-        userinfo['organizations'] = {
-            'owner': [{'userid': org.userid, 'name': org.name, 'title': org.title} for org in user.organizations_owned()],
-            'member': [{'userid': org.userid, 'name': org.name, 'title': org.title} for org in user.organizations()],
-            }
-        userinfo['teams'] = [{'userid': team.userid, 'title': team.title, 'org': team.org.userid} for team in user.teams]
-    if client.user:
-        perms = UserClientPermissions.query.filter_by(user=user, client=client).first()
-        if perms:
-            userinfo['permissions'] = perms.permissions.split(u' ')
-    else:
-        perms = TeamClientPermissions.query.filter_by(client=client).filter(
-            TeamClientPermissions.team_id.in_([team.id for team in user.teams])).all()
-        permsset = set()
-        for permob in perms:
-            permsset.update(permob.permissions.split(u' '))
-        userinfo['permissions'] = sorted(permsset)
-    return userinfo
+from lastuserapp import app, changefeed
+from lastuserapp.bulkexport import export_users, jsonl_lines, gzip_stream
+from lastuserapp.notifications import notify_revoked
+from lastuserapp.tokenusage import usage
+from lastuserapp.userinfo import get_userinfo
+from lastuserapp.models import (db, getuser, getusers, User, Organization, Team, AuthToken, Resource,
+    ResourceAction, UserClientPermissions, TeamClientPermissions, UserClientPermission, TeamClientPermission)
+from lastuserapp.views import provides_resource, requires_client_login
+from lastuserapp.utils import encode_cursor, decode_cursor
 
 
 def resource_error(error, description=None, uri=None):
@@ -71,8 +52,8 @@ def token_verify():
         return resource_error('no_token')
 
     authtoken = AuthToken.query.filter_by(token=token).first()
-    if not authtoken:
-        # No such auth token
+    if not authtoken or not authtoken.client.active or (authtoken.user and not authtoken.user.active):
+        # No such auth token, or its client or user is being deleted
         return api_result('error', error='no_token')
     if client_resource not in authtoken.scope:
         # Token does not grant access to this resource
@@ -95,6 +76,7 @@ def token_verify():
             return api_result('error', error='access_denied')
 
     # All validations passed. Token is valid for this client and scope. Return with information on the token
+    usage.record(authtoken)
     # TODO: Don't return validity. Set the HTTP cache headers instead.
     params = {'validity': 120}  # Period (in seconds) for which this assertion may be cached.
     if authtoken.user:
@@ -110,6 +92,24 @@ def token_verify():
     return api_result('ok', **params)
 
 
+@app.route('/api/1/token/revoke', methods=['POST'])
+@requires_client_login
+def token_revoke():
+    """
+    Revoke all tokens issued to the calling client, or only those of the user
+    given as userid. Returns the number of tokens revoked.
+    """
+    user = None
+    if request.form.get('userid'):
+        user = User.query.filter_by(userid=request.form['userid']).first()
+        if user is None:
+            return api_result('error', error='not_found')
+    notify_revoked(client=g.client, user=user)
+    count = AuthToken.revoke(client=g.client, user=user)
+    db.session.commit()
+    return api_result('ok', revoked=count)
+
+
 @app.route('/api/1/user/get_by_userid', methods=['POST'])
 @requires_client_login
 def user_get_by_userid():
@@ -158,6 +158,266 @@ def user_get():
         return api_result('error', error='not_found')
 
 
+@app.route('/api/1/user/export', methods=['POST'])
+@requires_client_login
+def user_export():
+    """
+    Stream all users with their email addresses, phone numbers, external ids
+    and team memberships as JSON lines. Only available to trusted clients.
+    The response is gzip-compressed if the client accepts it.
+    """
+    if not g.client.trusted:
+        return api_result('error', error='access_denied')
+    stream = jsonl_lines(export_users())
+    headers = {'Cache-Control': 'no-store', 'Pragma': 'no-cache'}
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        stream = gzip_stream(stream)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(stream), mimetype='application/x-ndjson', headers=headers)
+
+
+def batch_items(key):
+    """
+    Return the distinct values submitted for key, or an error response if
+    there are none or too many.
+    """
+    items = []
+    for item in request.form.getlist(key):
+        if item and item not in items:
+            items.append(item)
+    if not items:
+        return None, api_result('error', error='no_%s_provided' % key)
+    if len(items) > app.config.get('API_BATCH_LIMIT', 100):
+        return None, api_result('error', error='too_many_items')
+    return items, None
+
+
+def user_result(user):
+    return {'status': 'ok', 'type': 'user', 'userid': user.userid, 'name': user.username, 'title': user.fullname}
+
+
+def org_result(org):
+    return {'status': 'ok', 'type': 'organization', 'userid': org.userid, 'name': org.name, 'title': org.title}
+
+
+not_found_result = {'status': 'error', 'error': 'not_found'}
+
+
+@app.route('/api/1/user/get_by_userids', methods=['POST'])
+@requires_client_login
+def user_get_by_userids():
+    """
+    Batch version of user_get_by_userid. Accepts multiple userid parameters
+    and returns results keyed by userid.
+    """
+    userids, error = batch_items('userid')
+    if error:
+        return error
+    results = dict((user.userid, user_result(user)) for user in User.query.filter(User.userid.in_(userids)))
+    remaining = [userid for userid in userids if userid not in results]
+    if remaining:
+        results.update((org.userid, org_result(org))
+            for org in Organization.query.filter(Organization.userid.in_(remaining)))
+    return api_result('ok', results=dict((userid, results.get(userid, not_found_result)) for userid in userids))
+
+
+@app.route('/api/1/user/getall', methods=['POST'])
+@requires_client_login
+def user_getall():
+    """
+    Batch version of user_get. Accepts multiple name parameters (usernames,
+    email addresses or Twitter ids) and returns results keyed by name. Names
+    that do not match a user are also looked up as organization names.
+    """
+    names, error = batch_items('name')
+    if error:
+        return error
+    results = dict((name, user_result(user)) for name, user in getusers(names).items())
+    remaining = [name for name in names if name not in results and '@' not in name]
+    if remaining:
+        results.update((org.name, org_result(org))
+            for org in Organization.query.filter(Organization._name.in_(remaining)))
+    return api_result('ok', results=dict((name, results.get(name, not_found_result)) for name in names))
+
+
+@app.route('/api/1/permissions/batch', methods=['POST'])
+@requires_client_login
+def permissions_batch():
+    """
+    Return the permissions each of the given users has on the calling client,
+    including permissions assigned to their teams. Accepts multiple userid
+    parameters and returns results keyed by userid.
+    """
+    userids, error = batch_items('userid')
+    if error:
+        return error
+    users = dict((userid, id) for id, userid in
+        db.session.query(User.id, User.userid).filter(User.userid.in_(userids)))
+    permissions = g.client.permissions_for(users.values())
+    results = {}
+    for userid in userids:
+        if userid in users:
+            results[userid] = {'status': 'ok', 'permissions': sorted(permissions[users[userid]])}
+        else:
+            results[userid] = not_found_result
+    return api_result('ok', results=results)
+
+
+@app.route('/api/1/permissions/assign', methods=['POST'])
+@requires_client_login
+def permissions_assign():
+    """
+    Add, remove or set permissions for many users (or teams, for clients owned
+    by an organization) at once. Takes a JSON body of the form::
+
+        {"operations": [{"userid": "...", "action": "add", "permissions": ["..."]}, ...]}
+
+    All operations are applied in a single transaction. Returns a result for
+    each operation, in order, with the resulting permissions and whether
+    anything changed. Replaying a request makes no further changes.
+    """
+    data = request.json
+    operations = data.get('operations') if isinstance(data, dict) else None
+    if not operations or not isinstance(operations, list):
+        return api_result('error', error='no_operations_provided')
+    if len(operations) > app.config.get('API_BATCH_LIMIT', 100):
+        return api_result('error', error='too_many_items')
+    userids = list(set(op['userid'] for op in operations if isinstance(op, dict)
+        and isinstance(op.get('userid'), basestring)))
+    if g.client.user:
+        subjects = dict((userid, id) for id, userid in
+            db.session.query(User.id, User.userid).filter(User.userid.in_(userids)))
+    else:
+        subjects = dict((userid, id) for id, userid in db.session.query(Team.id, Team.userid).filter(
+            Team.org_id == g.client.org_id, Team.userid.in_(userids)))
+    available = g.client.available_permissions()
+
+    results = [None] * len(operations)
+    valid, changes = [], []
+    for index, op in enumerate(operations):
+        if not isinstance(op, dict) or not isinstance(op.get('userid'), basestring):
+            results[index] = {'status': 'error', 'error': 'invalid_userid'}
+        elif op['userid'] not in subjects:
+            results[index] = not_found_result
+        elif op.get('action') not in ('add', 'remove', 'set'):
+            results[index] = {'status': 'error', 'error': 'invalid_action'}
+        elif not isinstance(op.get('permissions'), list) or not all(
+                isinstance(name, basestring) and name in available for name in op['permissions']):
+            results[index] = {'status': 'error', 'error': 'invalid_permission'}
+        else:
+            valid.append(index)
+            changes.append((subjects[op['userid']], op['action'], set(op['permissions'])))
+    if changes:
+        try:
+            outcomes = g.client.apply_permissions(changes)
+            db.session.commit()
+        except IntegrityError:
+            # A replay of this request running alongside wrote the same rows
+            # first. They are visible now, so applying again finds them
+            db.session.rollback()
+            outcomes = g.client.apply_permissions(changes)
+            db.session.commit()
+        for index, (names, changed) in zip(valid, outcomes):
+            results[index] = {'status': 'ok', 'userid': operations[index]['userid'],
+                'permissions': sorted(names), 'changed': changed}
+    return api_result('ok', results=results)
+
+
+@app.route('/api/1/team/sync', methods=['POST'])
+@requires_client_login
+def team_sync():
+    """
+    Replace the members of a team in the organization that owns the calling
+    client. Takes a JSON body of the form::
+
+        {"team": "<team userid>", "members": ["<user userid>", ...]}
+
+    Only the difference from the current membership is written. Unknown
+    userids are ignored and listed in the response. The owners team can only
+    be synced by trusted clients.
+    """
+    if not g.client.org:
+        return api_result('error', error='access_denied')
+    data = request.json
+    if not isinstance(data, dict) or not isinstance(data.get('members'), list):
+        return api_result('error', error='no_members_provided')
+    members = [userid for userid in data['members'] if isinstance(userid, basestring)]
+    if len(members) > app.config.get('API_TEAM_SYNC_LIMIT', 100000):
+        return api_result('error', error='too_many_items')
+    team = Team.query.filter_by(org=g.client.org, userid=data.get('team')).first()
+    if team is None:
+        return api_result('error', error='not_found')
+    if team == g.client.org.owners and not g.client.trusted:
+        return api_result('error', error='access_denied')
+    users = User.ids_for(members)
+    if team == g.client.org.owners and not users:
+        return api_result('error', error='owners_required')
+    added, removed = team.sync_members(users.values())
+    db.session.commit()
+    return api_result('ok', added=len(added), removed=len(removed),
+        unknown=sorted(set(userid for userid in members if userid not in users)))
+
+
+@app.route('/api/1/permission/holders', methods=['POST'])
+@requires_client_login
+def permission_holders():
+    """
+    List the users (or teams, for clients owned by an organization) that have
+    been assigned a permission on the calling client. Results are paged; pass
+    the returned cursor as the after parameter to get the next page.
+    """
+    permission = request.form.get('permission')
+    if not permission:
+        return api_result('error', error='no_permission_provided')
+    after = None
+    if request.form.get('after'):
+        after = decode_cursor(request.form['after'])
+        if not after or len(after) != 1 or not isinstance(after[0], (int, long)):
+            return api_result('error', error='invalid_cursor')
+    limit = app.config.get('API_BATCH_LIMIT', 100)
+    if g.client.user:
+        item, assignment = UserClientPermission, UserClientPermissions
+        query = db.session.query(item.assignment_id, User).join(assignment,
+            assignment.id == item.assignment_id).join(User, User.id == assignment.user_id)
+    else:
+        item, assignment = TeamClientPermission, TeamClientPermissions
+        query = db.session.query(item.assignment_id, Team, Organization.userid).join(assignment,
+            assignment.id == item.assignment_id).join(Team, Team.id == assignment.team_id).join(
+            Organization, Organization.id == Team.org_id)
+    query = query.filter(item.client_id == g.client.id, item.name == permission)
+    if after:
+        query = query.filter(item.assignment_id > after[0])
+    rows = query.order_by(item.assignment_id).limit(limit + 1).all()
+    if g.client.user:
+        holders = [{'type': 'user', 'userid': user.userid, 'name': user.username, 'title': user.fullname}
+            for assignment_id, user in rows[:limit]]
+    else:
+        holders = [{'type': 'team', 'userid': team.userid, 'title': team.title, 'org': org_userid}
+            for assignment_id, team, org_userid in rows[:limit]]
+    cursor = encode_cursor([rows[limit - 1][0]]) if len(rows) > limit else None
+    return api_result('ok', permission=permission, holders=holders, cursor=cursor)
+
+
+@app.route('/api/1/changes', methods=['POST'])
+@requires_client_login
+def changes():
+    """
+    List users, organizations, teams and team memberships changed or deleted
+    since the cursor given as the after parameter, up to API_BATCH_LIMIT of
+    each. Without a cursor, everything is listed. Call again with the
+    returned cursor to continue; more is true if there are changes waiting.
+    The feed covers every account, so only trusted clients may read it.
+    """
+    if not g.client.trusted:
+        return api_result('error', error='access_denied')
+    feed = changefeed.changes(request.form.get('after'), app.config.get('API_BATCH_LIMIT', 100),
+        app.config.get('CHANGE_FEED_LAG', 60))
+    if feed is None:
+        return api_result('error', error='invalid_cursor')
+    result, cursor, more = feed
+    return api_result('ok', cursor=cursor, more=more, **result)
+
+
 # --- Token-based resource endpoints ------------------------------------------
 
 @app.route('/api/1/email')
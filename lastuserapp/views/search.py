@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+from flask import request, jsonify
+
+from lastuserapp import app
+from lastuserapp.models import User, UserEmail, Organization
+from lastuserapp.models.search import search as search_index
+from lastuserapp.utils import encode_cursor, decode_cursor
+from lastuserapp.views import requires_login
+
+#: Number of results per page of user lookups
+AUTOCOMPLETE_PAGE_SIZE = 20
+
+#: Number of results per page of search results
+SEARCH_PAGE_SIZE = 20
+
+
+@app.route('/search/users')
+@requires_login
+def user_autocomplete():
+    """
+    Return users whose name or username starts with the query, or whose email
+    address it is, one page at a time. Used by the user picker in team forms.
+    """
+    prefix = request.args.get('q', u'').strip()
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    if not prefix:
+        return jsonify(users=[], more=False)
+    users = User.autocomplete(prefix).offset((page - 1) * AUTOCOMPLETE_PAGE_SIZE).limit(
+        AUTOCOMPLETE_PAGE_SIZE + 1).all()
+    return jsonify(users=[{'userid': user.userid, 'label': user.pickername}
+            for user in users[:AUTOCOMPLETE_PAGE_SIZE]],
+        more=len(users) > AUTOCOMPLETE_PAGE_SIZE)
+
+
+@app.route('/search')
+@requires_login
+def search():
+    """
+    Search users and organizations by name, username or title. Results are
+    ranked, best match first. Pass the returned cursor as 'after' to get the
+    next page. A query that is a whole verified email address also finds
+    its user, listed first on the first page.
+    """
+    query = request.args.get('q', u'').strip()
+    kind = request.args.get('type')
+    if kind not in ('user', 'org'):
+        kind = None
+    after = None
+    if request.args.get('after'):
+        after = decode_cursor(request.args['after'])
+        if (after is None or len(after) != 2 or not isinstance(after[0], (int, long, float))
+                or not isinstance(after[1], (int, long))):
+            return jsonify(error='invalid_cursor'), 400
+    rows = search_index(query, kind=kind, limit=SEARCH_PAGE_SIZE, after=after)
+
+    user_ids = [row.ref_id for row in rows if row.kind == 'user']
+    org_ids = [row.ref_id for row in rows if row.kind == 'org']
+    users = dict((user.id, user) for user in User.query.filter(User.id.in_(user_ids))) if user_ids else {}
+    orgs = dict((org.id, org) for org in Organization.query.filter(Organization.id.in_(org_ids))) if org_ids else {}
+    results = []
+    if after is None and kind != 'org' and u'@' in query and len(query.split()) == 1:
+        user = User.query.join(UserEmail, UserEmail.user_id == User.id).filter(
+            UserEmail._email.in_(set([query, query.lower()]))).first()
+        if user is not None:
+            results.append({'type': 'user', 'userid': user.userid, 'name': user.username, 'title': user.fullname})
+            users.pop(user.id, None)
+    for row in rows:
+        if row.kind == 'user' and row.ref_id in users:
+            user = users[row.ref_id]
+            results.append({'type': 'user', 'userid': user.userid, 'name': user.username, 'title': user.fullname})
+        elif row.kind == 'org' and row.ref_id in orgs:
+            org = orgs[row.ref_id]
+            results.append({'type': 'organization', 'userid': org.userid, 'name': org.name, 'title': org.title})
+    if len(rows) == SEARCH_PAGE_SIZE:
+        cursor = encode_cursor([rows[-1].rank, rows[-1].id])
+    else:
+        cursor = None
+    return jsonify(results=results, cursor=cursor)
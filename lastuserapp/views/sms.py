@@ -5,86 +5,96 @@ Adds support for texting Indian mobile numbers
 """
 
 from pytz import UTC, timezone
-from urllib2 import urlopen, URLError
-from urllib import urlencode
 from datetime import datetime
 
-from flask import flash, request
+from flask import request
 from lastuserapp import app
-from lastuserapp.models import db, SMSMessage, SMS_STATUS
+from lastuserapp.models import db, SMSReport, SMS_STATUS
+from lastuserapp.smsdispatch import queue_message, stage_reports
 
 # SMS GupShup sends delivery reports with this timezone
 SMSGUPSHUP_TIMEZONE = timezone('Asia/Calcutta')
 
 
-def send_message(msg):
-    if msg.phone_number.startswith('+91'): # Indian number. Use SMS GupShup
-        if len(msg.phone_number) != 13:
-            raise ValueError, "Invalid Indian mobile number"
-        # All okay. Send!
-        # TODO: Also check if we have SMS GupShup credentials in settings.py
-        params = urlencode(dict(
-            method='SendMessage',
-            send_to=msg.phone_number[1:], # Number with leading +
-            msg=msg.message,
-            msg_type='TEXT',
-            format='text',
-            v='1.1',
-            auth_scheme='plain',
-            userid=app.config['SMS_SMSGUPSHUP_USER'],
-            password=app.config['SMS_SMSGUPSHUP_PASS'],
-            mask=app.config['SMS_SMSGUPSHUP_MASK']
-            ))
-        try:
-            response = urlopen('https://enterprise.smsgupshup.com/GatewayAPI/rest?%s' % params).read()
-            r_status, r_phone, r_id = [item.strip() for item in response.split('|')]
-            if r_status == 'success':
-                msg.status = SMS_STATUS.PENDING
-                msg.transaction_id = r_id
-        except URLError, e:
-            # FIXME: This function should not be sending messages to the UI
-            flash("Message could not be sent. Error: %s" % e)
-    else:
-        # Unsupported at this time
-        raise ValueError, "Unsupported phone number"
-
-
 def send_phone_verify_code(phoneclaim):
-    msg = SMSMessage(phone_number=phoneclaim.phone,
-        message="Verification code: %s. If you did not request this, please report to us at %s." % (
+    """
+    Queue a text message with the verification code for a phone number.
+    """
+    queue_message(phoneclaim.phone,
+        u"Verification code: %s. If you did not request this, please report to us at %s." % (
             phoneclaim.verification_code, app.config['SITE_SUPPORT_EMAIL']))
-    # Now send this
-    send_message(msg)
-    db.session.add(msg)
-
 
-@app.route('/report/smsgupshup')
-def report_smsgupshup():
-    externalId = request.args.get('externalId')
-    deliveredTS = request.args.get('deliveredTS')
-    status = request.args.get('status')
-    phoneNo = request.args.get('phoneNo')
-    cause = request.args.get('cause')
 
-    # Find a corresponding message and ensure the parameters match
-    msg = SMSMessage.query.filter_by(transaction_id = externalId).first()
-    if not msg:
-        return "No such message", 404
-    elif msg.phone_number != '+'+phoneNo:
-        return "Incorrect phone number", 404
+def parse_smsgupshup_report(values):
+    """
+    Validate a delivery report from SMS GupShup. Returns a report for
+    :func:`~lastuserapp.smsdispatch.stage_reports`, or raises ValueError.
+    """
+    transaction_id = unicode(values.get('externalId') or u'')
+    phone_number = unicode(values.get('phoneNo') or u'')
+    status = values.get('status')
+    columns = SMSReport.__table__.c
+    if not transaction_id:
+        raise ValueError("No message id")
+    if len(transaction_id) > columns.transaction_id.type.length:
+        raise ValueError("Invalid message id")
+    # The number is saved with a leading +
+    if not phone_number.isdigit() or len(phone_number) >= columns.phone_number.type.length:
+        raise ValueError("Invalid phone number")
+    if status == 'SUCCESS':
+        status = SMS_STATUS.DELIVERED
+    elif status == 'FAIL':
+        status = SMS_STATUS.FAILED
     else:
-        if status == 'SUCCESS':
-            msg.status = SMS_STATUS.DELIVERED
-        elif status == 'FAIL':
-            msg.status = SMS_STATUS.FAILED
-        else:
-            msg.status == SMS_STATUS.UNKNOWN
-        msg.fail_reason = cause
-        if deliveredTS:
-            deliveredTS = float(deliveredTS)/1000.0
+        status = SMS_STATUS.UNKNOWN
+    delivered = values.get('deliveredTS')
+    if delivered:
         # This delivery time is in IST, GMT+0530
         # Convert this into a naive UTC timestamp before saving
-        local_status_at = datetime.fromtimestamp(deliveredTS)
-        msg.status_at = local_status_at - SMSGUPSHUP_TIMEZONE.utcoffset(local_status_at)
+        try:
+            local_status_at = datetime.utcfromtimestamp(float(delivered) / 1000.0)
+        except (TypeError, ValueError, OverflowError):
+            # JSON reports may carry any value here
+            raise ValueError("Invalid delivery time")
+        status_at = local_status_at - SMSGUPSHUP_TIMEZONE.utcoffset(local_status_at)
+    else:
+        status_at = datetime.utcnow()
+    return {
+        'transaction_id': transaction_id,
+        'phone_number': u'+' + phone_number,
+        'status': status,
+        'status_at': status_at,
+        'fail_reason': values.get('cause') and unicode(values.get('cause'))[:25],
+        }
+
+
+@app.route('/report/smsgupshup', methods=['GET', 'POST'])
+def report_smsgupshup():
+    """
+    Accept delivery reports from SMS GupShup. A single report is sent as
+    request parameters. Several can be posted together as a JSON list of
+    objects with the same keys, up to SMS_REPORT_BATCH_SIZE at a time.
+    Reports are saved before they are acknowledged and applied shortly after
+    by the SMS worker.
+    """
+    if request.method == 'POST' and request.json is not None:
+        if not isinstance(request.json, list) or not all(isinstance(item, dict) for item in request.json):
+            return "Expected a list of reports", 400
+        if len(request.json) > app.config.get('SMS_REPORT_BATCH_SIZE', 500):
+            return "Too many reports", 400
+        accepted, rejected = [], 0
+        for values in request.json:
+            try:
+                accepted.append(parse_smsgupshup_report(values))
+            except ValueError:
+                rejected += 1
+        stage_reports(accepted)
+        db.session.commit()
+        return "Accepted %d, rejected %d" % (len(accepted), rejected)
+    try:
+        report = parse_smsgupshup_report(request.values)
+    except ValueError, e:
+        return unicode(e), 400
+    stage_reports([report])
     db.session.commit()
     return "Status updated"
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Maintenance commands for LastUser. Run with --help for a list.
+"""
+
+import gzip
+import sys
+from argparse import ArgumentParser, FileType
+
+
+def import_users(args):
+    from lastuserapp.bulkimport import UserImporter, read_jsonl, read_csv
+    if args.format == 'csv':
+        records = read_csv(args.infile)
+    else:
+        records = read_jsonl(args.infile)
+    importer = UserImporter(batch_size=args.batch_size, processes=args.processes, statefile=args.state)
+    importer.run(records, resume=args.resume)
+
+
+def export_users(args):
+    from lastuserapp.bulkexport import export_users, jsonl_lines
+    outfile = args.outfile
+    if args.gzip:
+        outfile = gzip.GzipFile(fileobj=outfile, mode='wb')
+    for line in jsonl_lines(export_users(batch_size=args.batch_size, passwords=args.passwords)):
+        outfile.write(line)
+    outfile.close()
+    args.outfile.close()
+
+
+def reindex(args):
+    from lastuserapp.models.search import rebuild_index
+    rebuild_index()
+
+
+def team_sync(args):
+    from lastuserapp.models import db, Team, User
+    team = Team.query.filter_by(userid=args.team).first()
+    if team is None:
+        raise SystemExit("No such team: %s" % args.team)
+    members = [line.strip() for line in args.infile if line.strip()]
+    users = User.ids_for(members)
+    unknown = set(members) - set(users)
+    if team == team.org.owners and not users:
+        raise SystemExit("The owners team cannot be left empty")
+    added, removed = team.sync_members(users.values())
+    db.session.commit()
+    print >> sys.stderr, "%d added, %d removed, %d unknown userids ignored" % (len(added), len(removed), len(unknown))
+
+
+def deletion_worker(args):
+    from lastuserapp.deletion import run_worker
+    run_worker(batch_size=args.batch_size, poll_interval=args.interval, once=args.once)
+
+
+def migrate(args):
+    from lastuserapp.migrations import migrate
+    migrate()
+
+
+def explain(args):
+    from lastuserapp.queryplan import check_plans
+    failures = check_plans()
+    if failures:
+        raise SystemExit("%d queries scan a whole table" % failures)
+
+
+def benchmark(args):
+    from lastuserapp.benchmark import use_database, run_benchmarks
+    use_database(args.database)
+    failures = run_benchmarks(args.names)
+    if failures:
+        raise SystemExit("%d benchmarks issue more statements as data grows" % failures)
+
+
+def revoke_tokens(args):
+    from lastuserapp.models import db, AuthToken, Client, User
+    from lastuserapp.notifications import notify_revoked
+    client = user = None
+    if args.client:
+        client = Client.query.filter_by(key=args.client).first()
+        if client is None:
+            raise SystemExit("No such client: %s" % args.client)
+    if args.user:
+        user = User.query.filter_by(userid=args.user).first()
+        if user is None:
+            raise SystemExit("No such user: %s" % args.user)
+    notify_revoked(client=client, user=user)
+    count = AuthToken.revoke(client=client, user=user)
+    db.session.commit()
+    print >> sys.stderr, "%d tokens revoked" % count
+
+
+def prune_tokens(args):
+    from lastuserapp.tokenusage import prune_tokens
+    prune_tokens(args.days, batch_size=args.batch_size, archive=args.archive)
+
+
+def notification_dispatcher(args):
+    from lastuserapp.notifications import run_dispatcher, purge_dead
+    if args.purge_dead:
+        print >> sys.stderr, "%d dead notices deleted" % purge_dead()
+    run_dispatcher(batch_size=args.batch_size, poll_interval=args.interval, once=args.once)
+
+
+def sms_worker(args):
+    from lastuserapp.smsdispatch import run_worker
+    run_worker(threads=args.threads, batch_size=args.batch_size, poll_interval=args.interval, once=args.once)
+
+
+def sms_stub_gateway(args):
+    from lastuserapp.smsdispatch import run_stub_gateway
+    run_stub_gateway(port=args.port, delay=args.delay)
+
+
+def main():
+    parser = ArgumentParser(description="LastUser maintenance commands")
+    commands = parser.add_subparsers()
+
+    command = commands.add_parser('migrate', help="Create the database or upgrade it to the latest schema")
+    command.set_defaults(func=migrate)
+
+    command = commands.add_parser('explain', help="Check that frequent queries use indexes")
+    command.set_defaults(func=explain)
+
+    command = commands.add_parser('benchmark', help="Check query counts and search times as data grows")
+    command.add_argument('names', nargs='*', help="Benchmarks to run (default: all)")
+    command.add_argument('--database', help="Scratch database URI (default: a temporary SQLite file)")
+    command.set_defaults(func=benchmark)
+
+    command = commands.add_parser('import', help="Import users from a JSON lines or CSV file")
+    command.add_argument('infile', type=FileType('rb'), help="Input file, or - for stdin")
+    command.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl')
+    command.add_argument('--batch-size', type=int, default=1000)
+    command.add_argument('--processes', type=int, default=None,
+        help="Password hashing processes (default: one per CPU)")
+    command.add_argument('--state', help="File to record progress in, for resuming")
+    command.add_argument('--resume', action='store_true',
+        help="Skip records committed by a previous run with the same --state file")
+    command.set_defaults(func=import_users)
+
+    command = commands.add_parser('export', help="Export users as JSON lines")
+    command.add_argument('outfile', type=FileType('wb'), help="Output file, or - for stdout")
+    command.add_argument('--gzip', action='store_true', help="Compress output with gzip")
+    command.add_argument('--passwords', action='store_true', help="Include password hashes")
+    command.add_argument('--batch-size', type=int, default=1000)
+    command.set_defaults(func=export_users)
+
+    command = commands.add_parser('reindex', help="Rebuild the search index for all users and organizations")
+    command.set_defaults(func=reindex)
+
+    command = commands.add_parser('team-sync', help="Replace the members of a team")
+    command.add_argument('team', help="Team userid")
+    command.add_argument('infile', type=FileType('r'), help="File with one member userid per line, or - for stdin")
+    command.set_defaults(func=team_sync)
+
+    command = commands.add_parser('deletion-worker', help="Carry out queued deletions")
+    command.add_argument('--batch-size', type=int, default=500)
+    command.add_argument('--interval', type=int, default=5, help="Seconds between checks for new jobs")
+    command.add_argument('--once', action='store_true', help="Exit when there are no more jobs")
+    command.set_defaults(func=deletion_worker)
+
+    command = commands.add_parser('notification-dispatcher', help="Post queued notices to client apps")
+    command.add_argument('--batch-size', type=int, default=500)
+    command.add_argument('--interval', type=int, default=5, help="Seconds between checks for due notices")
+    command.add_argument('--once', action='store_true', help="Exit when there are no more due notices")
+    command.add_argument('--purge-dead', action='store_true', help="Delete notices that have failed too often")
+    command.set_defaults(func=notification_dispatcher)
+
+    command = commands.add_parser('sms-worker', help="Send queued text messages")
+    command.add_argument('--threads', type=int, default=8, help="Messages sent at the same time")
+    command.add_argument('--batch-size', type=int, default=200)
+    command.add_argument('--interval', type=float, default=1, help="Seconds between checks for queued messages")
+    command.add_argument('--once', action='store_true', help="Exit when there are no more queued messages")
+    command.set_defaults(func=sms_worker)
+
+    command = commands.add_parser('sms-stub-gateway', help="Run a local SMS gateway that accepts every message")
+    command.add_argument('--port', type=int, default=8025)
+    command.add_argument('--delay', type=float, default=0, help="Seconds to wait before answering")
+    command.set_defaults(func=sms_stub_gateway)
+
+    command = commands.add_parser('revoke-tokens', help="Revoke all tokens of a client app, a user, or both")
+    command.add_argument('--client', help="Client key")
+    command.add_argument('--user', help="User userid")
+    command.set_defaults(func=revoke_tokens)
+
+    command = commands.add_parser('prune-tokens', help="Delete access tokens that have not been used recently")
+    command.add_argument('--days', type=int, default=90, help="Delete tokens unused for this many days")
+    command.add_argument('--archive', type=FileType('a'), help="Append deleted tokens to this file as JSON lines")
+    command.add_argument('--batch-size', type=int, default=1000)
+    command.set_defaults(func=prune_tokens)
+
+    args = parser.parse_args()
+    if args.func is revoke_tokens and not (args.client or args.user):
+        parser.error("revoke-tokens requires --client, --user or both")
+    if getattr(args, 'resume', False) and not args.state:
+        parser.error("--resume requires --state")
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,8 +2,8 @@
 # -*- coding: utf-8 -*-
 
 from lastuserapp import app
-from lastuserapp.models import db
+from lastuserapp.migrations import migrate
 
 if __name__=='__main__':
-    db.create_all()
+    migrate()
     app.run('0.0.0.0', port=7000, debug=True)